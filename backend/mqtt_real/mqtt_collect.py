@@ -7,30 +7,37 @@ broadcasts data.
 Data type collected are vehicle speed, vehicle count, and vehicle gaptime. To run, make sure a redis server is already
 running locally on the machine and then start script from terminal with 'python mqtt_collect.py'
 
-The main difficulty encountered and solved here is that a single detector records readings from multiple lanes.
-For example, det_1 may have 3 vehicle-speed readings on a three-lane road. For the purpose of this project, I
-wanted to aggregate those multiple readings of a same type into a single reading with the following scheme:
-vehicle-speed by avg speed across all lanes, vehicle-count by sum of all lanes, and gaptime by average across all lanes.
-
-Ao achieve this, the on_message callback function,associated with the mqtt client upon reception of a new message,
-operates on a dictionary called incoming_data of the form {det_id1:{},det_id2:{},det_id3:{},...} where the nested dict
-associated with each det_id key is of the form {vehicle-speed:[],vehicle-count:[],vehicle-gap-time,CreatedUtc:[]}
-
-det_id, reading_type, reading_value and timestamp is extracted from each new message. The timestamp is appended to the
-CreatedUtc list of the det_id's nested dictionary. If the newly appended timestamp is the same as existing timestamps
-in that list, then the new reading_value is also appended to the appropriate list in the det_id's nested dictionary.
-Upon reception of a message with a different timestamp than what's already in the det_id's CreateUtc list, then it is
-time to aggregate all the readings in the other lists according to the rules defined, write the aggregated value to
-the redis database under the appropriate det_id and value type, empty the list in the nested dict associated with
-the det_id/readinding_type, and reset the CreatedUtc list to a single element that's the new timestamp.
-
-Corresponding methods for performing the above tasks are identified below and also in ../src/backendtools.py
+A single detector records readings from multiple lanes, e.g. det-00773 has a topic for each of det-00773-01 and
+det-00773-02, listed comma separated in the topics column of ../../data/detectors-active.csv. Every lane topic of every
+reading type is subscribed to, and the messages go through the same backendtools.on_message as the simulated ones:
+the raw reading of each lane is kept by lanetools.py, while the json series, minute grid, rollups and archive
+(gridtools.py, archivetools.py) combine the lanes of a detector into a single reading per minute, the mean speed and
+gap time and the total count.
 
 To run this script, make sure to first set ../src on the PYTHONPATH environment variable then have a
-locally running redis server and launch from temrinal with 'python mqtt-collect.py'
+locally running redis server and launch from temrinal with 'python mqtt_collect.py'
+
+Several collectors can run at once on different hosts as hot standbys of each other with 'python mqtt_collect.py --ha',
+see ../src/hatools.py. With '--qos 1' the lane topics are subscribed with at-least-once delivery in a persistent
+session under a client id that is stable across restarts, the ingest accounting drops the redeliveries. With
+'--wal <directory>' every raw message, lane topics included, is first appended to a write-ahead log and the collector
+keeps running while redis is down. ../tools/replay_wal.py re-ingests the log through the same on_message after the
+outage, e.g. 'python replay_wal.py ../mqtt_real/wal --since 2021-01-15T08:00:00'
 """
 import backendtools
-import redis
+import profiletools
+import accountingtools
+import anomalytools
+import corridortools
+import registrytools
+import sheettools
+import lanetools
+import gridtools
+import archivetools
+import hatools
+import waltools
+import redistools
+import argparse
 
 broker = 'mqtt.cgmu.io'
 port = 1883
@@ -38,27 +45,86 @@ value_types = ["vehicle-gap-time", "vehicle-count", "vehicle-speed", "CreateUtc"
 data_template = {'vehicle-gap-time': [], 'vehicle-speed': [], 'vehicle-count': [], 'time': []}
 
 
-def main():
-    df = backendtools.read_csv('detectors-active.csv')
-    active_ids = df['id'].values.tolist()
-    active_topics = backendtools.extract_topics(df)
+def start(db, broker=broker, port=port, qos=0, client_id=None, ha=False, wal=None, profile_topic=False):
+    """
+    initializes the db entries of the active detectors and returns an mqtt client that's connected, subscribed to
+    every lane topic of their readings and ready to have its loop started
+
+    :param db: Redis instance from redis that readings are written to
+    :param broker (str):
+    :param port (int):
+    :param qos (int): 1 to subscribe with at-least-once delivery in a persistent session under `client_id`
+    :param client_id (str): defaults to backendtools.stable_client_id() when qos is 1, random otherwise
+    :param ha (bool): write idempotently, so that other collectors can consume the same topics as hot standbys, see
+    hatools.py
+    :param wal (WriteAheadLog): log the raw messages are appended to first, see waltools.py. the client then keeps
+    running when redis is unavailable, readings that weren't written can be replayed from the log
+    :param profile_topic (bool): also accept profiling requests on the public profiletools.control_topic
+    :return:
+    """
+    sheet = sheettools.load('detectors-active.csv')
+    active_ids = sheet['id']
+    reading_types = value_types[:-1]
+    active_topics = [(t + v, qos) for topics in sheet['topics'] for t in topics.split(",") for v in reading_types]
 
-    db = redis.Redis(host='localhost', port=6379, db=0)
     backendtools.initialize_db(db, active_ids, data_template)
-
-    # constructs the nested dict structure that's operated on by the on_message callback for aggregating
-    # mutliple readings of the same type for a given det_id
-    incoming_data = backendtools.initialize_incoming_data(active_ids, value_types)
-
-    client = backendtools.connect_mqtt(broker, port)
-
-    # passes in the incoming_data to the client so it can be operated on during the on_message callback
-    client.user_data_set([incoming_data, db])
-
+    backendtools.registry = registrytools.DetectorRegistry(db, data_template, sheettools.records(sheet))
+    backendtools.registry.register_all(active_ids)
+
+    # expects one reading per lane topic and reading type every minute from each detector
+    lanes = {i: len(t.split(",")) for i, t in zip(active_ids, sheet['topics'])}
+    backendtools.accounting = accountingtools.IngestAccounting(lanes, reading_types)
+    backendtools.anomaly = anomalytools.AnomalyDetector()
+    backendtools.anomaly.restore(db, active_ids)
+    backendtools.corridor = corridortools.CorridorTracker(active_ids, sheet['latitude'], sheet['longitude'])
+    backendtools.lanes = lanetools.LaneRecorder(db)
+    backendtools.grid = gridtools.GridRecorder(db)
+    backendtools.rollup = gridtools.RollupRecorder(db)
+    backendtools.archive = archivetools.ArchiveRecorder(db)
+    if ha:
+        backendtools.ha = hatools.IdempotentWriter(db, data_template)
+    backendtools.wal = wal
+
+    persistent = qos > 0
+    if persistent and client_id is None:
+        client_id = backendtools.stable_client_id()
+
+    client = backendtools.connect_mqtt(broker, port, client_id, clean_session=not persistent)
+    client.user_data_set(db)
+    if wal is not None:
+        # errors of on_message, e.g. redis being down, are logged instead of stopping the loop
+        client.suppress_exceptions = True
+        client.enable_logger()
     client.subscribe(active_topics)
+    if profile_topic:
+        client.subscribe(profiletools.control_topic)
 
     client.on_message = backendtools.on_message
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--broker", default=broker)
+    parser.add_argument("-p", type=int, default=port)
+    parser.add_argument("--qos", type=int, default=0, choices=[0, 1])
+    parser.add_argument("--client-id")
+    parser.add_argument("--ha", action="store_true", help="run next to other collectors of the same topics")
+    parser.add_argument("--wal", help="directory of a write-ahead log of the raw messages")
+    parser.add_argument("--wal-sync", choices=waltools.sync_policies, default="batch")
+    parser.add_argument("--wal-segment-mb", type=int, default=64)
+    parser.add_argument("--profile-topic", action="store_true",
+                        help="accept profiling requests published to the public control topic, SIGUSR1 always works")
+    args = parser.parse_args()
+
+    db = redistools.connect()
+    wal = None
+    if args.wal:
+        wal = waltools.WriteAheadLog(args.wal, args.wal_segment_mb * 1024 * 1024, sync=args.wal_sync)
+    client = start(db, args.broker, args.p, args.qos, args.client_id, args.ha, wal, args.profile_topic)
+    backendtools.profiler.install_signal()
     client.loop_forever()
 
+
 if __name__ == "__main__":
     main()
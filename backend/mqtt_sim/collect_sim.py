@@ -1,5 +1,18 @@
 import backendtools
-import redis
+import profiletools
+import accountingtools
+import anomalytools
+import corridortools
+import registrytools
+import sheettools
+import lanetools
+import gridtools
+import archivetools
+import hatools
+import waltools
+import shmtools
+import argparse
+import redistools
 
 broker = 'broker.hivemq.com'
 port = 1883
@@ -7,24 +20,127 @@ value_types = ["vehicle-gap-time", "vehicle-count", "vehicle-speed", "CreateUtc"
 data_template = {'vehicle-gap-time': [], 'vehicle-speed': [], 'vehicle-count': [], 'time': []}
 
 
-def main():
-    df = backendtools.read_csv("detectors-simulated.csv")
-    detector_topics = df['topics'].values.tolist()
-    detector_ids=df['id'].values.tolist()
+def start(db, broker=broker, port=port, qos=0, client_id=None, wildcard=False, ha=False, wal=None,
+          profile_topic=False):
+    """
+    initializes the db entries of the simulated detectors and returns an mqtt client that's connected, subscribed
+    to their topics and ready to have its loop started
+
+    :param db: Redis instance from redis (or a stand-in) that readings are written to
+    :param broker (str):
+    :param port (int):
+    :param qos (int): 1 to subscribe with at-least-once delivery in a persistent session under `client_id`
+    :param client_id (str): defaults to backendtools.stable_client_id() when qos is 1, random otherwise
+    :param wildcard (bool): subscribe to every detector topic with a single wildcard and register unseen detectors on
+    their first reading instead of subscribing only to the ones in the datasheet
+    :param ha (bool): write idempotently, so that other collectors can consume the same topics as hot standbys, see
+    hatools.py
+    :param wal (WriteAheadLog): log the raw messages are appended to first, see waltools.py. the client then keeps
+    running when redis is unavailable, readings that weren't written can be replayed from the log
+    :param profile_topic (bool): also accept profiling requests on the public profiletools.control_topic
+    :return:
+    """
+    sheet = sheettools.load("detectors-simulated.csv")
+    detector_topics = sheet['topics']
+    detector_ids = sheet['id']
     value_types = ["vehicle-gap-time", "vehicle-count", "vehicle-speed"]
     active_topics=[]
     for each_topic in detector_topics:
         for each_type in value_types:
-            active_topics.append((each_topic + each_type,0))
+            active_topics.append((each_topic + each_type,qos))
 
-    db = redis.Redis()
     backendtools.initialize_db(db, detector_ids, data_template)
+    backendtools.registry = registrytools.DetectorRegistry(db, data_template, sheettools.records(sheet))
+    backendtools.registry.register_all(detector_ids)
+    backendtools.accounting = accountingtools.IngestAccounting({i: 1 for i in detector_ids}, value_types)
+    backendtools.anomaly = anomalytools.AnomalyDetector()
+    backendtools.anomaly.restore(db, detector_ids)
+    backendtools.corridor = corridortools.CorridorTracker(detector_ids, sheet['latitude'], sheet['longitude'])
+    backendtools.lanes = lanetools.LaneRecorder(db)
+    backendtools.grid = gridtools.GridRecorder(db)
+    backendtools.rollup = gridtools.RollupRecorder(db)
+    backendtools.archive = archivetools.ArchiveRecorder(db)
+    if ha:
+        backendtools.ha = hatools.IdempotentWriter(db, data_template)
+    backendtools.wal = wal
+
+    persistent = qos > 0
+    if persistent and client_id is None:
+        client_id = backendtools.stable_client_id()
 
-    client = backendtools.connect_mqtt(broker, port)
+    client = backendtools.connect_mqtt(broker, port, client_id, clean_session=not persistent)
     client.user_data_set(db)
-    client.subscribe(active_topics)
+    if wal is not None:
+        # errors of on_message, e.g. redis being down, are logged instead of stopping the loop
+        client.suppress_exceptions = True
+        client.enable_logger()
+    if wildcard:
+        client.subscribe(backendtools.detector_wildcard, qos)
+    else:
+        client.subscribe(active_topics)
+    if profile_topic:
+        client.subscribe(profiletools.control_topic)
 
     client.on_message = backendtools.on_message
+    return client
+
+
+def start_shm(name, broker=broker, port=port, qos=0, client_id=None, profile_topic=False):
+    """
+    same as start, but writes the readings to the shared memory store `name` instead of redis, see shmtools.py. The
+    redis-only features (accounting, anomaly flags, corridor, registry) are off
+
+    :param name (str): name of the shared memory block the dashboard attaches to
+    :return:
+    """
+    sheet = sheettools.load("detectors-simulated.csv")
+    detector_ids = sheet['id']
+    value_types = ["vehicle-gap-time", "vehicle-count", "vehicle-speed"]
+    active_topics = [(t + v, qos) for t in sheet['topics'] for v in value_types]
+
+    store = shmtools.ShmStore.create(name, detector_ids)
+    shmtools.initialize_db(store, detector_ids, data_template)
+
+    persistent = qos > 0
+    if persistent and client_id is None:
+        client_id = backendtools.stable_client_id()
+
+    client = backendtools.connect_mqtt(broker, port, client_id, clean_session=not persistent)
+    client.user_data_set(store)
+    client.subscribe(active_topics)
+    if profile_topic:
+        client.subscribe(profiletools.control_topic)
+
+    client.on_message = shmtools.on_message
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--broker", default=broker)
+    parser.add_argument("-p", type=int, default=port)
+    parser.add_argument("--qos", type=int, default=0, choices=[0, 1])
+    parser.add_argument("--client-id")
+    parser.add_argument("--wildcard", action="store_true")
+    parser.add_argument("--ha", action="store_true", help="run next to other collectors of the same topics")
+    parser.add_argument("--wal", help="directory of a write-ahead log of the raw messages")
+    parser.add_argument("--wal-sync", choices=waltools.sync_policies, default="batch")
+    parser.add_argument("--wal-segment-mb", type=int, default=64)
+    parser.add_argument("--shm", help="name of a shared memory store to write to instead of redis")
+    parser.add_argument("--profile-topic", action="store_true",
+                        help="accept profiling requests published to the public control topic, SIGUSR1 always works")
+    args = parser.parse_args()
+
+    if args.shm:
+        client = start_shm(args.shm, args.broker, args.p, args.qos, args.client_id, args.profile_topic)
+    else:
+        db = redistools.connect()
+        wal = None
+        if args.wal:
+            wal = waltools.WriteAheadLog(args.wal, args.wal_segment_mb * 1024 * 1024, sync=args.wal_sync)
+        client = start(db, args.broker, args.p, args.qos, args.client_id, args.wildcard, args.ha, wal,
+                       args.profile_topic)
+    backendtools.profiler.install_signal()
     client.loop_forever()
 
 
@@ -1,18 +1,18 @@
 import random
 import time
 from paho.mqtt import client as mqtt_client
-import backendtools
+import sheettools
+import simtools
 import datetime
 import pytz
 import argparse
 import json
-import pandas as pd
 import numpy as np
 
 
-speed_sim = backendtools.OneTrough()
-gaptime_sim = backendtools.OneTrough()
-count_sim = backendtools.TwoPeaks()
+speed_sim = simtools.OneTrough()
+gaptime_sim = simtools.OneTrough()
+count_sim = simtools.TwoPeaks()
 
 def randomize():
     global speed_sim
@@ -92,8 +92,7 @@ def main():
     pause = int(args.t)
 
     # ================== setting up the topics =====================
-    df = backendtools.read_csv("detectors-simulated.csv")
-    ids = df['topics'].values.tolist()
+    ids = sheettools.load("detectors-simulated.csv")['topics']
     value_types = ["vehicle-gap-time", "vehicle-count", "vehicle-speed"]
     topics = []
     for each_id in ids:
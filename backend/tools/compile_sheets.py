@@ -0,0 +1,22 @@
+""" Datasheet Compiler
+
+Compiles the detector datasheets in ../../data to the compact json the collectors load, see
+../../src/sheettools.py. The collectors recompile a datasheet whose csv changed on their own, running this after
+editing a csv just saves them the work.
+
+To run, set ../../src on the PYTHONPATH and launch from terminal with 'python compile_sheets.py'
+"""
+import sheettools
+
+# the datasheets the collectors and the simulator read
+sheets = ["detectors-active.csv", "detectors-simulated.csv"]
+
+
+def main():
+    for fname in sheets:
+        sheet = sheettools.compile_sheet(fname)
+        print("{:<32} {:>4} detectors  {} columns".format(fname, len(sheet["id"]), len(sheet["columns"])))
+
+
+if __name__ == "__main__":
+    main()
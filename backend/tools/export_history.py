@@ -0,0 +1,46 @@
+""" Historic Reading Export
+
+Writes the readings of all detectors in a time range to a gzip csv, Arrow IPC or Parquet file, streaming them from
+redis a batch of detectors at a time (see ../../src/exporttools.py), and reports the throughput.
+
+To run, set ../../src on the PYTHONPATH and launch from terminal with e.g.
+'python export_history.py readings.parquet --format parquet --start 2021-01-15T08:00:00 --end 2021-01-15T09:00:00'
+"""
+import sys
+import argparse
+import redistools
+import exporttools
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output", help="file to write, - for stdout")
+    parser.add_argument("--format", choices=list(exporttools.formats), default="csv")
+    parser.add_argument("--source", choices=list(exporttools.sources), default="readings")
+    parser.add_argument("--start", help="first CreateUtc included, e.g. 2021-01-15T08:00:00")
+    parser.add_argument("--end", help="first CreateUtc excluded")
+    parser.add_argument("--host", help="defaults to MTL_REDIS_HOST or localhost")
+    parser.add_argument("-p", type=int, help="defaults to MTL_REDIS_PORT or 6379")
+    args = parser.parse_args()
+
+    db = redistools.connect(args.host, args.p)
+    stats = {}
+    stream = exporttools.export(db, args.format, args.source, args.start, args.end, stats)
+
+    if args.output == "-":
+        for data in stream:
+            sys.stdout.buffer.write(data)
+        out = sys.stderr
+    else:
+        with open(args.output, "wb") as f:
+            for data in stream:
+                f.write(data)
+        out = None
+
+    rate = stats["rows"] / stats["seconds"] if stats["seconds"] else 0
+    print("{} rows, {:.1f} kB in {:.2f} s, {:.0f} rows/s".format(
+        stats["rows"], stats["bytes"] / 1024, stats["seconds"], rate), file=out)
+
+
+if __name__ == "__main__":
+    main()
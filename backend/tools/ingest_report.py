@@ -0,0 +1,39 @@
+""" Ingest Data Quality Report
+
+Prints the expected versus received readings, duplicates, late arrivals and gaps counted by the collector's ingest
+accounting (see ../../src/accountingtools.py), for all detectors together and for each one. Everything is read from the
+single ingest:counters key, so it's cheap to run against a collector under load, e.g. with 'watch'.
+
+To run, set ../../src on the PYTHONPATH and launch from terminal with 'python ingest_report.py'
+"""
+import argparse
+import redistools
+import accountingtools
+
+
+def format_row(name, counts):
+    completeness = counts["completeness"]
+    completeness = "-" if completeness is None else "{:.1%}".format(completeness)
+    return "{:<8} {:>10} {:>10} {:>10} {:>10} {:>8} {:>8} {:>12}".format(
+        name, counts["expected"], counts["received"], counts["missing"], counts["duplicates"], counts["late"],
+        counts["gaps"], completeness)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", help="defaults to MTL_REDIS_HOST or localhost")
+    parser.add_argument("-p", type=int, help="defaults to MTL_REDIS_PORT or 6379")
+    args = parser.parse_args()
+
+    db = redistools.connect(args.host, args.p)
+    summary = accountingtools.summary(db)
+
+    print("{:<8} {:>10} {:>10} {:>10} {:>10} {:>8} {:>8} {:>12}".format(
+        "detector", "expected", "received", "missing", "duplicate", "late", "gaps", "completeness"))
+    for det_id in sorted(summary["detectors"]):
+        print(format_row(det_id, summary["detectors"][det_id]))
+    print(format_row("total", summary["total"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+""" Write-Ahead Log Replay
+
+Re-ingests the raw mqtt messages of a collector's write-ahead log (see ../../src/waltools.py) through the same
+backendtools.on_message the collector runs, e.g. to rebuild redis after an outage, or just reads them with --dry-run
+to measure how fast the log can be read.
+
+Replays are idempotent by default: readings go through hatools.IdempotentWriter, so readings already written by an
+earlier replay, or by a collector running with --ha in the last hour, are skipped rather than appended twice.
+
+To run, set ../../src on the PYTHONPATH and launch from terminal with e.g.
+'python replay_wal.py ../mqtt_sim/wal --since 2021-01-15T08:00:00'
+"""
+import os
+import sys
+import time
+import argparse
+import contextlib
+import backendtools
+import registrytools
+import anomalytools
+import lanetools
+import gridtools
+import archivetools
+import hatools
+import waltools
+import redistools
+
+data_template = {'vehicle-gap-time': [], 'vehicle-speed': [], 'vehicle-count': [], 'time': []}
+
+
+def prepare(db, dedup=True):
+    """
+    enables the derived state the collectors keep that can be rebuilt without a datasheet: registry, anomaly
+    statistics, lane rings, grid, rollups and archive. the corridor needs the detectors' coordinates and the ingest
+    accounting would count replayed readings as received twice, both are left out
+
+    :param db: Redis instance from redis
+    :param dedup (bool): write through hatools.IdempotentWriter
+    :return:
+    """
+    backendtools.registry = registrytools.DetectorRegistry(db, data_template)
+    backendtools.anomaly = anomalytools.AnomalyDetector()
+    backendtools.anomaly.restore(db, registrytools.read_registry(db))
+    backendtools.lanes = lanetools.LaneRecorder(db)
+    backendtools.grid = gridtools.GridRecorder(db)
+    backendtools.rollup = gridtools.RollupRecorder(db)
+    backendtools.archive = archivetools.ArchiveRecorder(db)
+    if dedup:
+        backendtools.ha = hatools.IdempotentWriter(db, data_template)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="directory of the write-ahead log")
+    parser.add_argument("--start", type=int, default=0, help="offset of the first message, 0 for the oldest kept")
+    parser.add_argument("--since", help="skip messages received before, e.g. 2021-01-15T08:00:00 (UTC)")
+    parser.add_argument("--dry-run", action="store_true", help="only read the log")
+    parser.add_argument("--no-dedup", action="store_true", help="append every reading, even if already written")
+    parser.add_argument("--verbose", action="store_true", help="print every reading like the collector does")
+    parser.add_argument("--host", help="defaults to MTL_REDIS_HOST or localhost")
+    parser.add_argument("-p", type=int, help="defaults to MTL_REDIS_PORT or 6379")
+    args = parser.parse_args()
+
+    since = lanetools.to_epoch(args.since) if args.since else None
+    messages = waltools.read(args.directory, args.start, since)
+
+    db = None
+    if not args.dry_run:
+        db = redistools.connect(args.host, args.p)
+        prepare(db, not args.no_dedup)
+
+    count, size, following = 0, 0, None
+    began = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+        for msg in messages:
+            if db is not None:
+                backendtools.on_message(None, db, msg)
+            count += 1
+            record = len(msg.topic.encode()) + len(msg.payload)
+            size += record
+            following = msg.offset + waltools.header.size + record
+    elapsed = time.perf_counter() - began
+
+    rate = count / elapsed if elapsed else 0
+    print("{} messages, {:.1f} MB in {:.2f} s, {:.0f} msgs/s".format(count, size / 1e6, elapsed, rate))
+    if backendtools.ha is not None:
+        print("{} readings written, {} already written".format(backendtools.ha.written, backendtools.ha.skipped))
+    if following is not None:
+        print("next offset {}, to continue from with --start".format(following))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+""" Forecast Worker
+
+Background process that produces 5, 15 and 30 minute forecasts of vehicle speed and vehicle count for every detector
+once per minute and stores them in redis under forecast:<det_id>, where the dashboard's historic scatter picks them up
+to draw a dashed forecast extension. See ../../src/forecasttools.py for the forecasting method.
+
+All detectors are forecast together in one vectorized pass, and nothing runs inside the Dash callbacks, so the cost of
+the dashboard stays the same however many detectors there are.
+
+To run, set ../../src on the PYTHONPATH, have the collector writing to a locally running redis server and launch from
+terminal with 'python forecast_worker.py'
+"""
+import json
+import time
+import argparse
+import redistools
+import registrytools
+import forecasttools
+
+value_types = ["vehicle-speed", "vehicle-count"]
+
+
+def forecast_round(db, window):
+    """
+    reads the readings of all detectors in one round trip, forecasts every reading type and writes the results back
+
+    :param db: Redis instance from redis
+    :param window (int): number of most recent readings the forecasts are fitted on
+    :return: number of detectors forecast
+    """
+    det_ids = registrytools.detector_keys(db)
+    if not det_ids:
+        return 0
+
+    readings = [json.loads(r) for r in db.mget(det_ids)]
+    base_times = [r["time"][-1] if r["time"] else None for r in readings]
+
+    forecasts = {}
+    for value_type in value_types:
+        matrix = forecasttools.to_matrix([r[value_type] for r in readings], window)
+        forecasts[value_type] = forecasttools.holt_forecast(matrix)
+
+    forecasttools.write_forecasts(db, det_ids, base_times, forecasts)
+    return len(det_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", help="defaults to MTL_REDIS_HOST or localhost")
+    parser.add_argument("-p", type=int, help="defaults to MTL_REDIS_PORT or 6379")
+    parser.add_argument("--period", type=float, default=60)
+    parser.add_argument("--window", type=int, default=120)
+    args = parser.parse_args()
+
+    db = redistools.connect(args.host, args.p)
+
+    while True:
+        start = time.perf_counter()
+        count = forecast_round(db, args.window)
+        elapsed = time.perf_counter() - start
+        print("forecast {} detectors in {:.1f} ms".format(count, 1000 * elapsed))
+        time.sleep(max(args.period - elapsed, 0))
+
+
+if __name__ == "__main__":
+    main()
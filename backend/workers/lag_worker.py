@@ -0,0 +1,107 @@
+""" Congestion Wave Lag Worker
+
+Background process that estimates, once per minute, how many minutes a change of speed takes to travel between each
+pair of adjacent stations along the corridor, from the cross-correlation of their speeds over the latest window, and
+stores the lags in redis under lag:latest and lag:history, where the dashboard's lag panel picks them up. See
+../../src/lagtools.py for the method.
+
+All segments are correlated together in one batch of FFTs over the aligned matrix of speeds, so a round of a corridor
+with hundreds of detectors costs a few milliseconds, and nothing runs inside the Dash callbacks.
+
+Stations are placed along the corridor with the coordinates their collector registered (meta:<det_id>), or those of
+the datasheet given with --sheet for detectors registered without them.
+
+To run, set ../../src on the PYTHONPATH, have the collector writing to a locally running redis server and launch from
+terminal with 'python lag_worker.py'
+"""
+import json
+import time
+import argparse
+import redistools
+import registrytools
+import sheettools
+import corridortools
+import gridtools
+import lagtools
+
+
+def corridor_stations(db, sheet):
+    """
+    :param db: Redis instance from redis
+    :param sheet (dict): compiled datasheet, see sheettools.py
+    :return: ids of the detectors with known coordinates, in their order along the corridor
+    """
+    det_ids = registrytools.detector_keys(db)
+    sheet_lats = dict(zip(sheet["id"], sheet["latitude"]))
+
+    stations, lats = [], []
+    for det_id, meta in zip(det_ids, registrytools.read_metadata(db, det_ids)):
+        lat = float(meta["latitude"]) if "latitude" in meta else sheet_lats.get(det_id)
+        if lat is not None and lat == lat:
+            stations.append(det_id)
+            lats.append(lat)
+
+    return [stations[i] for i in corridortools.corridor_order(lats)]
+
+
+def read_speeds(db, det_ids, window):
+    """
+    :return: speeds of `det_ids` on the grid of the latest `window` minutes, with the gaps interpolated
+    """
+    grid_db = gridtools.GridDB(db)
+    if grid_db.available():
+        return grid_db.grid(det_ids, "vehicle-speed", window, fill=True)
+
+    # written by a collector without a grid, put the json series on one
+    readings = [json.loads(r) for r in db.mget(det_ids)]
+    return gridtools.from_series([r["time"] for r in readings], [r["vehicle-speed"] for r in readings], window,
+                                 fill=True)
+
+
+def lag_round(db, sheet, window, max_lag):
+    """
+    estimates the lag of every segment of the corridor over the latest window and writes them to redis
+
+    :param db: Redis instance from redis
+    :param sheet (dict): compiled datasheet, see sheettools.py
+    :param window (int): minutes the speeds are correlated over
+    :param max_lag (int): largest lag in minutes
+    :return: number of segments
+    """
+    det_ids = corridor_stations(db, sheet)
+    if len(det_ids) < 2:
+        return 0
+
+    grid = read_speeds(db, det_ids, window)
+    if not grid["time"]:
+        return 0
+
+    lags, correlations = lagtools.segment_lags(grid["values"], max_lag)
+    segments = list(zip(det_ids[:-1], det_ids[1:]))
+    lagtools.write_lags(db, segments, grid["time"][-1], lags, correlations, window)
+    return len(segments)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", help="defaults to MTL_REDIS_HOST or localhost")
+    parser.add_argument("-p", type=int, help="defaults to MTL_REDIS_PORT or 6379")
+    parser.add_argument("--period", type=float, default=60)
+    parser.add_argument("--window", type=int, default=120, help="minutes correlated, at most 300")
+    parser.add_argument("--max-lag", type=int, default=15, help="largest lag in minutes")
+    parser.add_argument("--sheet", default="detectors-active.csv", help="datasheet in ../../data for coordinates")
+    args = parser.parse_args()
+
+    db = redistools.connect(args.host, args.p)
+    sheet = sheettools.load(args.sheet)
+
+    while True:
+        start = time.perf_counter()
+        count = lag_round(db, sheet, args.window, args.max_lag)
+        elapsed = time.perf_counter() - start
+        print("lags of {} segments in {:.1f} ms".format(count, 1000 * elapsed))
+        time.sleep(max(args.period - elapsed, 0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,395 @@
+""" Hot Path Benchmarks
+
+Times the code paths that run on every incoming mqtt message and on every dashboard refresh:
+
+- backendtools.on_message throughput with synthetic MQTTMessages
+- RedisDB.latest_readings / n_latest_readings latency for varying history lengths and detector counts, with and
+  without the client-side cache
+- CustomBar.set_data and CustomScatter.zoom_in figure build times
+- the full update_scatter callback from callbackcollection.init_callbacks, rendered and served from the render cache
+- the 24h heatmap matrix of gridtools.ShiftingMatrix, read in full versus shifted by a new 5 minute column
+- appends to and reads of the write-ahead log of waltools.py, and on_message fed from it
+- size of a detector-day in the compressed archive of archivetools.py versus json, and the decode of a day of all
+  detectors from it
+- the lags between adjacent stations of lagtools.py, with FFTs over all segments at once versus correlating each
+  segment directly
+- the frames of a time-travel replay (replaytools.py) played minute by minute from the archive, each read on its own
+  versus through the prefetcher
+
+Runs against fakeredis by default, or a locally spawned redis server with --redis-host (note that the selected db is
+flushed). Results are written to json so that runs from different commits can be compared with compare.py
+
+To run, set ../src on the PYTHONPATH and launch from terminal with 'python bench_hotpaths.py -o results.json'
+"""
+import json
+import time
+import datetime
+import shutil
+import tempfile
+import argparse
+import numpy as np
+
+import backendtools
+import frontendtools
+import layouttools
+import harnesstools
+import rendertools
+import gridtools
+import waltools
+import archivetools
+import replaytools
+import lagtools
+
+
+def bench_on_message(db, n_detectors, n_minutes):
+    ids = harnesstools.detector_ids(n_detectors)
+    msgs = harnesstools.make_messages(ids, n_minutes)
+
+    db.flushdb()
+    backendtools.initialize_db(db, ids, harnesstools.data_template)
+    backendtools.stages.reset()
+
+    with harnesstools.quiet():
+        start = time.perf_counter()
+        for msg in msgs:
+            backendtools.on_message(None, db, msg)
+        elapsed = time.perf_counter() - start
+
+    return {"detectors": n_detectors,
+            "messages": len(msgs),
+            "seconds": elapsed,
+            "msgs_per_s": len(msgs) / elapsed,
+            "stages": backendtools.stages.summary()}
+
+
+def bench_reads(db, n_detectors, history, n, repeat):
+    ids = harnesstools.detector_ids(n_detectors)
+    harnesstools.seed_db(db, ids, history)
+    rdb = frontendtools.RedisDB(client=db, local_cache=False)
+    cached = frontendtools.RedisDB(client=db, local_cache=True)
+
+    results = {"detectors": n_detectors,
+               "history": history,
+               "latest_readings": harnesstools.measure(lambda: rdb.latest_readings("vehicle-speed"), repeat),
+               "n_latest_readings": harnesstools.measure(lambda: rdb.n_latest_readings("vehicle-speed", n), repeat),
+               "latest_readings_cached": harnesstools.measure(lambda: cached.latest_readings("vehicle-speed"), repeat)}
+    cached.cache.close()
+    return results
+
+
+def bench_figures(n_detectors, n, repeat):
+    plot_config, _ = harnesstools.load_configs()
+    ids = harnesstools.detector_ids(n_detectors)
+    stations = ["station {}".format(i + 1) for i in range(n_detectors)]
+    values = [20 + (i * 7) % 60 for i in range(n_detectors)]
+
+    bar = layouttools.CustomBar(plot_config, "", layouttools.card(), "speed-live-graph")
+
+    labels = harnesstools.timestamps(n)
+    scatter = layouttools.CustomScatter(plot_config)
+    scatter.set_unit("kmh")
+    scatter.set_labels(labels)
+    scatter.update_primary_fig([20 + i % 60 for i in range(n)])
+    scatter.update_secondary_fig([30 + i % 40 for i in range(n)])
+
+    return {"detectors": len(ids),
+            "history": n,
+            "bar_set_data": harnesstools.measure(lambda: bar.set_data(values, stations, "kmh"), repeat),
+            "scatter_zoom_in": harnesstools.measure(lambda: scatter.zoom_in(n - int(0.1 * n), n), repeat)}
+
+
+def bench_update_scatter(db, n_detectors, history, n, repeat):
+    ids = harnesstools.detector_ids(n_detectors)
+    harnesstools.seed_db(db, ids, history)
+    rdb = frontendtools.RedisDB(client=db)
+
+    elements = harnesstools.make_elements(rdb, ids, n)
+    callbacks = harnesstools.init_headless_callbacks(elements)
+    n = elements["n"]
+
+    def tick():
+        with harnesstools.triggered("minute-interval.n_intervals"):
+            callbacks["update_scatter"](1, "speed", "station 1", "station 2", [n - int(0.1 * n), n - 1], None)
+
+    # seed_db leaves no data:version, so the render cache is bypassed and every tick renders
+    uncached = harnesstools.measure(tick, repeat)
+
+    # with a data version, every tick after the first is served from the render cache another worker would share
+    db.set(rendertools.version_key, 1)
+    cached = harnesstools.measure(tick, repeat)
+
+    return {"detectors": n_detectors,
+            "history": history,
+            "update_scatter": uncached,
+            "update_scatter_cached": cached}
+
+
+def bench_heatmap(db, n_detectors, repeat):
+    ids = harnesstools.detector_ids(n_detectors)
+    ring, step = gridtools.rollup_ring, gridtools.rollup_step
+    db.flushdb()
+
+    # a full day of rollups, written at once rather than reading by reading
+    end = 1610697600
+    rng = np.random.default_rng(0)
+    for bucket in gridtools.minutes(end, ring, step):
+        cells = np.zeros(n_detectors, dtype=gridtools.record)
+        cells["t"] = bucket
+        cells["v"] = rng.uniform(10, 90, n_detectors)
+        db.set(gridtools.rollup_template.format("vehicle-speed", bucket), cells.tobytes())
+    db.hset(gridtools.rollup_rows_key, mapping={det_id: i for i, det_id in enumerate(ids)})
+    db.set(gridtools.rollup_latest_key, end)
+    db.set(rendertools.version_key, 1)
+
+    full = harnesstools.measure(lambda: gridtools.ShiftingMatrix(db).matrix(ids, "vehicle-speed"), repeat)
+
+    matrix = gridtools.ShiftingMatrix(db)
+    matrix.matrix(ids, "vehicle-speed")
+
+    def tick():
+        db.incr(gridtools.rollup_latest_key, step)
+        db.incr(rendertools.version_key)
+        matrix.matrix(ids, "vehicle-speed")
+
+    shifted = harnesstools.measure(tick, repeat)
+    return {"detectors": n_detectors, "heatmap_full": full, "heatmap_shift": shifted}
+
+
+def bench_wal(db, n_detectors, n_minutes, sync):
+    ids = harnesstools.detector_ids(n_detectors)
+    msgs = harnesstools.make_messages(ids, n_minutes)
+    directory = tempfile.mkdtemp(prefix="bench-wal-")
+
+    try:
+        wal = waltools.WriteAheadLog(directory, sync=sync)
+        start = time.perf_counter()
+        for msg in msgs:
+            wal.append(msg.topic, msg.payload)
+        wal.close()
+        appended = time.perf_counter() - start
+
+        start = time.perf_counter()
+        replayed = list(waltools.read(directory))
+        read = time.perf_counter() - start
+
+        db.flushdb()
+        backendtools.initialize_db(db, ids, harnesstools.data_template)
+        with harnesstools.quiet():
+            start = time.perf_counter()
+            for msg in replayed:
+                backendtools.on_message(None, db, msg)
+            ingested = time.perf_counter() - start
+    finally:
+        shutil.rmtree(directory)
+
+    return {"detectors": n_detectors,
+            "messages": len(msgs),
+            "sync": sync,
+            "append_msgs_per_s": len(msgs) / appended,
+            "read_msgs_per_s": len(msgs) / read,
+            "replay_msgs_per_s": len(msgs) / ingested}
+
+
+def bench_archive(db, n_detectors, days, repeat):
+    ids = harnesstools.detector_ids(n_detectors)
+    chunk = 120
+    n = days * 1440 // chunk * chunk
+    db.flushdb()
+
+    # random walks of small integers one minute apart, like the detectors' readings
+    rng = np.random.default_rng(0)
+    start = 1610668800
+    times = start + 60 * np.arange(n)
+    created = harnesstools.timestamps(n, datetime.datetime(2021, 1, 15))
+    json_bytes = 0
+    pipe = db.pipeline(transaction=False)
+    for det_id in ids:
+        series = {"time": created}
+        for subj in harnesstools.value_types:
+            values = np.clip(40 + np.cumsum(rng.integers(-3, 4, n)), 0, 120).astype(float)
+            series[subj] = values.astype(int).tolist()
+            for i in range(0, n, chunk):
+                pipe.rpush(archivetools.chunk_template.format(det_id, subj),
+                           archivetools.encode_chunk(times[i:i + chunk], values[i:i + chunk]))
+                bounds = np.array([(times[i], times[i + chunk - 1])], dtype=archivetools.index_record)
+                pipe.rpush(archivetools.index_template.format(det_id, subj), bounds.tobytes())
+        serialized = json.dumps(series)
+        json_bytes += len(serialized)
+        # the last day as json, what a query would read without the archive
+        pipe.set("bench:json:{}".format(det_id), json.dumps({k: v[-1440:] for k, v in series.items()}))
+    pipe.execute()
+
+    pairs = [(det_id, subj) for det_id in ids for subj in harnesstools.value_types]
+    day = (start + (days - 1) * 86400, start + days * 86400)
+
+    # with a cache large enough for the day, and without one, e.g. the first query of an export
+    archive = archivetools.ArchiveDB(db, cache_size=len(pairs) * (1440 // chunk + 1))
+    archive_bytes = sum(archive.size(det_id, subj) for det_id in ids for subj in harnesstools.value_types)
+    query = harnesstools.measure(lambda: archive.read(pairs, *day), repeat)
+    query_cold = harnesstools.measure(lambda: archivetools.ArchiveDB(db).read(pairs, *day), repeat)
+    json_keys = ["bench:json:{}".format(det_id) for det_id in ids]
+    json_query = harnesstools.measure(lambda: [json.loads(raw) for raw in db.mget(json_keys)], repeat)
+    return {"detectors": n_detectors,
+            "days": days,
+            "json_bytes_per_detector_day": json_bytes / n_detectors / days,
+            "archive_bytes_per_detector_day": archive_bytes / n_detectors / days,
+            "archive_day_query": query,
+            "archive_day_query_cold": query_cold,
+            "json_day_query": json_query}
+
+
+def bench_lags(n_detectors, repeat, window=120, max_lag=15):
+    # a wave of slowdowns moving down the corridor, 2 minutes per station, plus noise
+    rng = np.random.default_rng(0)
+    wave = np.convolve(rng.normal(size=window + 2 * n_detectors + 16), np.ones(8) / 8, "same")
+    matrix = np.array([40 + 10 * wave[2 * n_detectors - 2 * i:][:window] for i in range(n_detectors)])
+    matrix += rng.normal(scale=0.5, size=matrix.shape)
+
+    def direct():
+        standardized = lagtools.standardize(matrix)
+        corr = np.empty((n_detectors - 1, 2 * max_lag + 1))
+        for i in range(n_detectors - 1):
+            full = np.correlate(standardized[i + 1], standardized[i], "full") / window
+            corr[i] = full[window - 1 - max_lag:window + max_lag]
+        return lagtools.estimate_lags(corr, max_lag)
+
+    lags, _ = lagtools.segment_lags(matrix, max_lag)
+    return {"detectors": n_detectors,
+            "window": window,
+            "median_lag": float(np.nanmedian(lags)),
+            "lags_fft": harnesstools.measure(lambda: lagtools.segment_lags(matrix, max_lag), repeat),
+            "lags_direct": harnesstools.measure(direct, repeat)}
+
+
+def bench_replay(db, n_detectors, minutes, pause=0.01):
+    """
+    plays `minutes` frames of the archive written by bench_archive one after the other, the way the replay-interval
+    steps through them at 60x, with `pause` seconds between two frames standing in for the interval
+    """
+    ids = harnesstools.detector_ids(n_detectors)
+    frames = replaytools.ReplayFrames(db, ids)
+    first, last = frames.bounds()
+    begin = first + (last - first) // 2
+
+    def uncached():
+        # every frame read from the archive on its own, what a tick would cost without the prefetcher
+        start = frames.block_start(begin)
+        return frames.frame(frames.load(start), start, begin)
+
+    cold = harnesstools.measure(uncached, 10)
+
+    prefetcher = replaytools.Prefetcher(frames)
+    samples = []
+    for t in range(begin, begin + minutes * 60, 60):
+        start = time.perf_counter()
+        prefetcher.frame(t)
+        samples.append((time.perf_counter() - start) * 1000)
+        time.sleep(pause)
+
+    samples.sort()
+    return {"detectors": n_detectors,
+            "frames": len(samples),
+            "frame_without_prefetch": cold,
+            "frame_median_ms": samples[len(samples) // 2],
+            "frame_p99_ms": samples[int(0.99 * (len(samples) - 1))],
+            "frame_max_ms": samples[-1],
+            "block_misses": prefetcher.misses}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", default="bench_results.json")
+    parser.add_argument("--redis-host")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--minutes", type=int, default=60)
+    parser.add_argument("--detectors", default="9,100,1000")
+    parser.add_argument("--histories", default="60,240,300")
+    args = parser.parse_args()
+
+    detector_counts = [int(i) for i in args.detectors.split(",")]
+    histories = [int(i) for i in args.histories.split(",")]
+    n = 240
+
+    db = harnesstools.make_db(args.redis_host, args.redis_port)
+
+    results = {"env": harnesstools.environment(),
+               "on_message": [],
+               "reads": [],
+               "figures": [],
+               "callbacks": [],
+               "heatmap": [],
+               "wal": [],
+               "archive": [],
+               "replay": [],
+               "lags": []}
+
+    for n_det in detector_counts:
+        results["on_message"].append(bench_on_message(db, n_det, args.minutes))
+        print("on_message      {:>5} detectors  {:>10.0f} msgs/s".format(n_det, results["on_message"][-1]["msgs_per_s"]))
+
+    for n_det in detector_counts:
+        for history in histories:
+            r = bench_reads(db, n_det, history, n, args.repeat)
+            results["reads"].append(r)
+            print("reads           {:>5} detectors  {:>4} history  {:>8.2f} ms latest  {:>8.2f} ms n_latest  "
+                  "{:>8.2f} ms latest cached".format(n_det, history, r["latest_readings"]["median_ms"],
+                                                     r["n_latest_readings"]["median_ms"],
+                                                     r["latest_readings_cached"]["median_ms"]))
+
+    for n_det in detector_counts:
+        for history in histories:
+            r = bench_figures(n_det, history, args.repeat)
+            results["figures"].append(r)
+            print("figures         {:>5} detectors  {:>4} history  {:>8.2f} ms bar  {:>8.2f} ms zoom".format(
+                n_det, history, r["bar_set_data"]["median_ms"], r["scatter_zoom_in"]["median_ms"]))
+
+    for n_det in detector_counts:
+        r = bench_update_scatter(db, n_det, max(histories), n, args.repeat)
+        results["callbacks"].append(r)
+        print("update_scatter  {:>5} detectors  {:>8.2f} ms  {:>8.2f} ms cached".format(
+            n_det, r["update_scatter"]["median_ms"], r["update_scatter_cached"]["median_ms"]))
+
+    for n_det in detector_counts:
+        r = bench_heatmap(db, n_det, args.repeat)
+        results["heatmap"].append(r)
+        print("heatmap         {:>5} detectors  {:>8.2f} ms full  {:>8.2f} ms shifted".format(
+            n_det, r["heatmap_full"]["median_ms"], r["heatmap_shift"]["median_ms"]))
+
+    for n_det in detector_counts:
+        r = bench_lags(n_det, args.repeat)
+        results["lags"].append(r)
+        print("lags            {:>5} detectors  {:>8.2f} ms fft  {:>8.2f} ms direct  {:>6.2f} min median lag".format(
+            n_det, r["lags_fft"]["median_ms"], r["lags_direct"]["median_ms"], r["median_lag"]))
+
+    for sync in waltools.sync_policies:
+        r = bench_wal(db, max(detector_counts), args.minutes, sync)
+        results["wal"].append(r)
+        print("wal {:<6}      {:>5} detectors  {:>10.0f} appends/s  {:>10.0f} reads/s  {:>8.0f} replayed/s".format(
+            sync, r["detectors"], r["append_msgs_per_s"], r["read_msgs_per_s"], r["replay_msgs_per_s"]))
+
+    for n_det in detector_counts:
+        r = bench_archive(db, n_det, 7, args.repeat)
+        results["archive"].append(r)
+        print("archive         {:>5} detectors  {:>8.0f} B json  {:>8.0f} B archived per detector-day  "
+              "{:>8.2f} ms day query  {:>8.2f} ms cold  {:>8.2f} ms as json".format(
+                  n_det, r["json_bytes_per_detector_day"], r["archive_bytes_per_detector_day"],
+                  r["archive_day_query"]["median_ms"], r["archive_day_query_cold"]["median_ms"],
+                  r["json_day_query"]["median_ms"]))
+
+        # replays the archive bench_archive just wrote
+        r = bench_replay(db, n_det, 240)
+        results["replay"].append(r)
+        print("replay          {:>5} detectors  {:>8.2f} ms frame without prefetch  {:>8.3f} ms median  "
+              "{:>8.3f} ms p99  {:>8.2f} ms max  {} misses".format(
+                  n_det, r["frame_without_prefetch"]["median_ms"], r["frame_median_ms"], r["frame_p99_ms"],
+                  r["frame_max_ms"], r["block_misses"]))
+
+    with open(args.o, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print("results written to {}".format(args.o))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+""" Shared Memory Store Benchmark
+
+Checks and times the shared memory backend of ../src/shmtools.py with a writer and a reader in separate processes, the
+way the collector and the dashboard use it:
+
+- a writer process appends readings to every detector as fast as it can, each reading being its own sequence number
+- the main process reads snapshots with ShmDB meanwhile, and checks that every series it gets is a run of consecutive
+  sequence numbers, i.e. that no snapshot is torn by a concurrent write
+- the same reads are timed against RedisDB on fakeredis (or --redis-host) for comparison
+
+To run, set ../src on the PYTHONPATH and launch from terminal with 'python bench_shm.py --detectors 100'
+"""
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+import frontendtools
+import harnesstools
+import shmtools
+
+store_name = "mtl-traffic-bench"
+
+
+def write(name, det_ids, stop, written):
+    store = shmtools.ShmStore.attach(name)
+    created = harnesstools.timestamps(1)[0]
+    seq = 0
+    while not stop.is_set():
+        for det_id in det_ids:
+            store.append(det_id, "vehicle-speed", seq, created)
+        seq += 1
+    written.value = seq * len(det_ids)
+    store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--detectors", type=int, default=100)
+    parser.add_argument("--history", type=int, default=240)
+    parser.add_argument("-d", type=float, default=5, help="seconds of concurrent reading and writing")
+    parser.add_argument("--redis-host")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    args = parser.parse_args()
+
+    ids = harnesstools.detector_ids(args.detectors)
+    store = shmtools.ShmStore.create(store_name, ids)
+    db = shmtools.ShmDB(store_name)
+
+    stop = multiprocessing.Event()
+    written = multiprocessing.Value("q", 0)
+    writer = multiprocessing.Process(target=write, args=(store_name, ids, stop, written))
+    writer.start()
+
+    reads, torn, latencies = 0, 0, []
+    deadline = time.perf_counter() + args.d
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        series = db.n_latest_readings("vehicle-speed", args.history)
+        latencies.append(1000 * (time.perf_counter() - start))
+        reads += 1
+        for s in series:
+            if len(s) > 1 and np.any(np.diff(s) != 1):
+                torn += 1
+
+    stop.set()
+    writer.join()
+
+    print("shm    {} detectors  {} writes/s while reading, {} snapshots, {} torn".format(
+        args.detectors, int(written.value / args.d), reads, torn))
+    print("shm    n_latest_readings  median {:.3f} ms".format(np.median(latencies)))
+
+    redis_db = harnesstools.make_db(args.redis_host, args.redis_port)
+    harnesstools.seed_db(redis_db, ids, args.history)
+    rdb = frontendtools.RedisDB(client=redis_db, local_cache=False)
+    r = harnesstools.measure(lambda: rdb.n_latest_readings("vehicle-speed", args.history), 20)
+    print("redis  n_latest_readings  median {:.3f} ms".format(r["median_ms"]))
+
+    db.store.close()
+    store.destroy()
+
+
+if __name__ == "__main__":
+    main()
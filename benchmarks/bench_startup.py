@@ -0,0 +1,96 @@
+""" Collector Startup Benchmark
+
+Times the cold start of the collector entry points in fresh interpreters, the way a restart on an edge host pays it:
+
+- wall time of the whole process, interpreter start included
+- time spent importing the entry point, and loading its detector datasheet (see sheettools.py)
+- resident memory once imported, the baseline the collector runs from
+- which of the dashboard's heavy dependencies (pandas, scipy, plotly, dash) got imported along, there should be none
+
+A bare interpreter is measured as well for reference. Results are written to json so that runs from different commits
+can be compared with compare.py
+
+To run, set ../src on the PYTHONPATH and launch from terminal with 'python bench_startup.py -o startup.json'
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+import harnesstools
+
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+entry_points = {"python": (None, None),
+                "collect_sim": (os.path.join(basedir, "backend", "mqtt_sim"), "detectors-simulated.csv"),
+                "mqtt_collect": (os.path.join(basedir, "backend", "mqtt_real"), "detectors-active.csv")}
+heavy_modules = ["pandas", "scipy", "plotly", "dash"]
+
+# run in the child interpreter, prints its measurements as json
+probe = """
+import sys, time, json
+began = time.perf_counter()
+name, sheet = sys.argv[1], sys.argv[2]
+if name != "python":
+    __import__(name)
+imported = time.perf_counter()
+if sheet:
+    import sheettools
+    sheettools.load(sheet)
+loaded = time.perf_counter()
+
+rss = 0
+with open("/proc/self/status") as f:
+    for line in f:
+        if line.startswith("VmRSS:"):
+            rss = int(line.split()[1]) * 1024
+print(json.dumps({"import_s": imported - began, "sheet_s": loaded - imported, "rss_bytes": rss,
+                  "heavy": [m for m in %r if m in sys.modules]}))
+""" % heavy_modules
+
+
+def measure(name, repeat):
+    directory, sheet = entry_points[name]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in [os.path.join(basedir, "src"), directory or "",
+                                                    env.get("PYTHONPATH", "")] if p)
+
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", probe, name, sheet or ""], env=env, cwd=directory or basedir,
+                             stdout=subprocess.PIPE, check=True).stdout
+        wall = time.perf_counter() - start
+        runs.append(dict(json.loads(out), wall_s=wall))
+
+    return {"entry_point": name,
+            "wall_ms": statistics.median(r["wall_s"] for r in runs) * 1000,
+            "import_ms": statistics.median(r["import_s"] for r in runs) * 1000,
+            "sheet_ms": statistics.median(r["sheet_s"] for r in runs) * 1000,
+            "rss_mb": statistics.median(r["rss_bytes"] for r in runs) / 2 ** 20,
+            "heavy_modules": runs[-1]["heavy"]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", default="startup_results.json")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    results = {"env": harnesstools.environment(), "startup": []}
+    for name in entry_points:
+        r = measure(name, args.repeat)
+        results["startup"].append(r)
+        print("{:<14} {:>8.1f} ms wall  {:>8.1f} ms import  {:>6.2f} ms sheet  {:>6.1f} MB rss  heavy: {}".format(
+            name, r["wall_ms"], r["import_ms"], r["sheet_ms"], r["rss_mb"], ", ".join(r["heavy_modules"]) or "none"))
+
+    with open(args.o, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print("results written to {}".format(args.o))
+
+
+if __name__ == "__main__":
+    main()
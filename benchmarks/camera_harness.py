@@ -0,0 +1,149 @@
+""" Camera Proxy Harness
+
+Exercises cameratools.CameraProxy against a local stand-in for the city's camera server, so the proxy can be checked
+and timed without network access:
+
+- the stand-in serves generated jpegs for any GEN<id>.jpeg, with an ETag and Last-Modified, answers conditional GETs
+  with 304 and adds a configurable delay to every response to mimic the city's server
+- a first refresh of every camera downloads the images, a second one must only get 304s
+- the /camera/<id>.jpeg route is requested through Flask's test client, once plainly and once with the ETag it
+  returned, which must give a 304
+- a second proxy on the same redis, as another gunicorn worker would run, serves the thumbnails without fetching and
+  only one of the two takes the refreshing lease
+- the carousel latency is compared between fetching straight from the stand-in and serving from the warm proxy
+
+To run, set ../src on the PYTHONPATH and launch from terminal with 'python camera_harness.py --delay 0.3'
+"""
+import io
+import time
+import argparse
+import threading
+import statistics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from flask import Flask
+from PIL import Image
+
+import sheettools
+import cameratools
+import harnesstools
+
+
+def make_image(cam_id, version):
+    img = Image.new("RGB", (640, 480), ((int(cam_id) * 37) % 255, (version * 91) % 255, 120))
+    out = io.BytesIO()
+    img.save(out, format="JPEG")
+    return out.getvalue()
+
+
+class StandIn(BaseHTTPRequestHandler):
+    # shared by all handlers: delay in seconds, image version (bumping it changes every image), request counters
+    delay = 0.0
+    version = 1
+    counts = {"200": 0, "304": 0}
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        cam_id = self.path.split("GEN")[-1].split(".")[0]
+        etag = '"{}-{}"'.format(cam_id, self.version)
+
+        if self.headers.get("If-None-Match") == etag:
+            StandIn.counts["304"] += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        body = make_image(cam_id, self.version)
+        StandIn.counts["200"] += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", "Mon, 15 Mar 2021 12:00:00 GMT")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--delay", type=float, default=0.3, help="seconds the stand-in takes to answer")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    StandIn.delay = args.delay
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    link = "http://127.0.0.1:{}/Circulation-Cameras/GEN{{}}.jpeg".format(server.server_address[1])
+
+    cam_ids = [str(i) for i in sheettools.load("detectors-active.csv")["id_camera"]]
+    db = harnesstools.make_db()
+    proxy = cameratools.CameraProxy(cam_ids, db, link=link, workers=args.workers, name="worker-1")
+
+    start = time.perf_counter()
+    answered = proxy.refresh_all()
+    cold = time.perf_counter() - start
+    print("first refresh   {}/{} cameras in {:.2f} s, {} downloads".format(
+        answered, len(proxy.camera_ids), cold, StandIn.counts["200"]))
+    assert answered == len(proxy.camera_ids)
+
+    start = time.perf_counter()
+    proxy.refresh_all()
+    warm = time.perf_counter() - start
+    print("second refresh  {:.2f} s, {} not modified".format(warm, StandIn.counts["304"]))
+    assert StandIn.counts["304"] == len(proxy.camera_ids)
+
+    app = Flask(__name__)
+    proxy.register(app)
+    client = app.test_client()
+
+    r = client.get(cameratools.proxy_link.format(cam_ids[0]))
+    assert r.status_code == 200 and r.mimetype == "image/jpeg"
+    thumb = Image.open(io.BytesIO(r.data))
+    print("served          {} bytes, {}x{} thumbnail, {}".format(len(r.data), thumb.width, thumb.height,
+                                                                 r.headers["Cache-Control"]))
+
+    r2 = client.get(cameratools.proxy_link.format(cam_ids[0]), headers={"If-None-Match": r.headers["ETag"]})
+    assert r2.status_code == 304
+    assert client.get(cameratools.proxy_link.format("0")).status_code == 404
+
+    # another worker serves what the first one fetched, and leaves the refreshing to it
+    downloads = StandIn.counts["200"] + StandIn.counts["304"]
+    other = cameratools.CameraProxy(cam_ids, db, link=link, workers=args.workers, name="worker-2")
+    other_app = Flask("other")
+    other.register(other_app)
+    r4 = other_app.test_client().get(cameratools.proxy_link.format(cam_ids[0]))
+    assert r4.status_code == 200 and r4.headers["ETag"] == r.headers["ETag"]
+    assert StandIn.counts["200"] + StandIn.counts["304"] == downloads
+    assert proxy.lead() and not other.lead()
+    print("second worker   served from redis, lease held by the first")
+
+    # a new image on the city's side is picked up by the next refresh and changes the proxy's etag
+    StandIn.version += 1
+    proxy.refresh_all()
+    r3 = client.get(cameratools.proxy_link.format(cam_ids[0]), headers={"If-None-Match": r.headers["ETag"]})
+    assert r3.status_code == 200
+
+    # clicking through the carousel: straight from the city's server vs from the warm proxy
+    direct, proxied = [], []
+    for cam_id in cam_ids:
+        start = time.perf_counter()
+        requests.get(link.format(cam_id))
+        direct.append(1000 * (time.perf_counter() - start))
+
+        start = time.perf_counter()
+        client.get(cameratools.proxy_link.format(cam_id))
+        proxied.append(1000 * (time.perf_counter() - start))
+
+    print("carousel        median {:.1f} ms direct, {:.2f} ms from the proxy".format(
+        statistics.median(direct), statistics.median(proxied)))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+""" Benchmark Comparison
+
+Compares two result files written by bench_hotpaths.py (or bench_startup.py), e.g. from the commit before and after a change, and prints
+the ratio of new over old median timings (throughput for on_message). Ratios above the threshold are flagged.
+
+Launch from terminal with 'python compare.py old.json new.json'
+"""
+import json
+import argparse
+
+
+def flatten(results):
+    """
+    turns the nested result file into a flat {name: (value, higher_is_better)} dict so two runs can be matched up
+
+    :param results (dict): content of a json file written by bench_hotpaths.py
+    :return:
+    """
+    flat = {}
+    for r in results.get("on_message", []):
+        flat["on_message/{}".format(r["detectors"])] = (r["msgs_per_s"], True)
+
+    for r in results.get("startup", []):
+        for k in ["wall_ms", "import_ms", "rss_mb"]:
+            flat["startup/{}/{}".format(r["entry_point"], k)] = (r[k], False)
+
+    for r in results.get("wal", []):
+        for k in ["append_msgs_per_s", "read_msgs_per_s", "replay_msgs_per_s"]:
+            flat["wal/{}/{}/{}".format(r["sync"], k, r["detectors"])] = (r[k], True)
+
+    for r in results.get("archive", []):
+        flat["archive/bytes_per_detector_day/{}".format(r["detectors"])] = (r["archive_bytes_per_detector_day"], False)
+        flat["archive/day_query/{}".format(r["detectors"])] = (r["archive_day_query"]["median_ms"], False)
+
+    for r in results.get("replay", []):
+        for k in ["frame_median_ms", "frame_p99_ms"]:
+            flat["replay/{}/{}".format(k, r["detectors"])] = (r[k], False)
+
+    for r in results.get("lags", []):
+        flat["lags/fft/{}".format(r["detectors"])] = (r["lags_fft"]["median_ms"], False)
+
+    for section in ["reads", "figures", "callbacks"]:
+        for r in results.get(section, []):
+            for k, v in r.items():
+                if isinstance(v, dict) and "median_ms" in v:
+                    name = "{}/{}/{}/{}".format(section, k, r["detectors"], r["history"])
+                    flat[name] = (v["median_ms"], False)
+
+    return flat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=1.10)
+    args = parser.parse_args()
+
+    with open(args.old, "r") as f:
+        old = json.load(f)
+    with open(args.new, "r") as f:
+        new = json.load(f)
+
+    print("{} -> {}".format(old["env"]["commit"], new["env"]["commit"]))
+
+    old_flat = flatten(old)
+    new_flat = flatten(new)
+    regressions = 0
+
+    for name in sorted(set(old_flat) & set(new_flat)):
+        old_value, higher_is_better = old_flat[name]
+        new_value, _ = new_flat[name]
+
+        # express every ratio as cost, so > 1 always means slower
+        if higher_is_better:
+            ratio = old_value / new_value
+        else:
+            ratio = new_value / old_value
+
+        flag = ""
+        if ratio > args.threshold:
+            flag = "REGRESSION"
+            regressions += 1
+
+        print("{:<50}  {:>12.3f}  {:>12.3f}  {:>6.2f}x  {}".format(name, old_value, new_value, ratio, flag))
+
+    print("{} regression(s) above {:.2f}x".format(regressions, args.threshold))
+
+
+if __name__ == "__main__":
+    main()
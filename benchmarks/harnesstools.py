@@ -0,0 +1,282 @@
+"""Benchmark Harness Utilities
+
+Helpers shared by the benchmark and harness scripts in this folder: building synthetic mqtt messages that look like
+the ones published by the detectors, seeding a stand-in redis database with history, and wiring up the dashboard's
+wrapper classes and callbacks without starting a Dash server.
+
+Like the rest of the project, ../src is expected to be on the PYTHONPATH.
+
+"""
+import os
+import sys
+import json
+import time
+import datetime
+import contextlib
+import statistics
+
+import dash
+import redis
+from paho.mqtt import client as mqtt_client
+
+import frontendtools
+import gridtools
+import layouttools
+import callbackcollection
+
+topic_root = "worldcongress2017/pilot_resologi/odtf1/ca/qc/mtl/mobil/traf/detector/det1/det-{}/"
+value_types = ["vehicle-gap-time", "vehicle-count", "vehicle-speed"]
+data_template = {'vehicle-gap-time': [], 'vehicle-speed': [], 'vehicle-count': [], 'time': []}
+
+assetdir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, "frontend", "assets"))
+
+
+def make_db(host=None, port=6379):
+    """
+    returns a redis client to run against. without a host, an in-process fakeredis server is used so that nothing
+    needs to be running locally
+
+    :param host (str): host of a locally spawned redis server, or None for fakeredis
+    :param port (int):
+    :return:
+    """
+    if host is not None:
+        return redis.Redis(host=host, port=port, db=0)
+
+    try:
+        import fakeredis
+    except ImportError:
+        raise ImportError("fakeredis is required when no --redis-host is given, install with 'pip install fakeredis'")
+
+    return fakeredis.FakeRedis()
+
+
+def detector_ids(n_detectors):
+    return ["{:05d}".format(773 + i) for i in range(n_detectors)]
+
+
+def timestamps(n, start=None):
+    if start is None:
+        start = datetime.datetime(2021, 1, 15, 8, 0, 0)
+    return [(start + datetime.timedelta(minutes=i)).strftime("%Y-%m-%dT%H:%M:%S") for i in range(n)]
+
+
+def make_message(det_id, subj, value, created):
+    """
+    builds a paho MQTTMessage carrying the same payload pub_sim.py publishes for a detector reading
+
+    :param det_id (str): detector id, e.g. 00773
+    :param subj (str): one of value_types
+    :param value (int): the reading
+    :param created (str): CreateUtc timestamp of the reading
+    :return:
+    """
+    msg = mqtt_client.MQTTMessage(topic=(topic_root.format(det_id) + subj).encode())
+    msg.payload = json.dumps({"CreateUtc": created,
+                              "Desc": subj,
+                              "ExpiryUtc": created,
+                              "Format": "ODNF1",
+                              "Status": "Good",
+                              "Unit": "",
+                              "Value": value}).encode()
+    return msg
+
+
+def make_messages(ids, n_minutes):
+    msgs = []
+    for i, created in enumerate(timestamps(n_minutes)):
+        for det_id in ids:
+            for subj in value_types:
+                msgs.append(make_message(det_id, subj, 20 + (i * 7) % 60, created))
+    return msgs
+
+
+def seed_db(db, ids, history):
+    """
+    writes `history` synthetic readings per detector in the same json layout the collectors produce
+
+    :param db: Redis or fakeredis client
+    :param ids (list): detector ids
+    :param history (int): number of readings per reading type
+    :return:
+    """
+    db.flushdb()
+    times = timestamps(history)
+    for k, det_id in enumerate(ids):
+        data = {subj: [20 + (i * 7 + k) % 60 for i in range(history)] for subj in value_types}
+        data['time'] = times
+        db.set(det_id, json.dumps(data))
+
+
+def load_configs():
+    with open(os.path.join(assetdir, "bar_config.json"), "r") as jfile:
+        plot_config = json.load(jfile)
+    with open(os.path.join(assetdir, "slider_config.json"), "r") as jfile:
+        slider_config = json.load(jfile)
+    return plot_config, slider_config
+
+
+class HeadlessApp:
+    def __init__(self):
+        """
+        stand-in for dash.Dash that only records the functions registered through app.callback, so that the callbacks
+        defined in callbackcollection.init_callbacks can be called directly as plain functions
+        """
+        self.callbacks = {}
+
+    def callback(self, *args, **kwargs):
+        def register(fn):
+            self.callbacks[fn.__name__] = fn
+            return fn
+
+        return register
+
+    def clientside_callback(self, *args, **kwargs):
+        # runs in the browser, there is nothing to call headlessly
+        pass
+
+
+class _TriggeredContext:
+    def __init__(self, prop_id):
+        self.triggered = [{"prop_id": prop_id, "value": None}]
+
+
+@contextlib.contextmanager
+def triggered(prop_id):
+    """
+    stands in for dash.callback_context while a callback is called outside of a request, as if the callback was
+    triggered by `prop_id`, e.g. "minute-interval.n_intervals"
+    """
+    original = dash.callback_context
+    dash.callback_context = _TriggeredContext(prop_id)
+    try:
+        yield
+    finally:
+        dash.callback_context = original
+
+
+def detector_sheet(ids):
+    """
+    synthetic detector datasheet with the columns of detectors-active.csv the dashboard uses, the detectors spread
+    on a grid around Rue Notre-Dame
+    """
+    import pandas as pd
+
+    side = max(int(len(ids) ** 0.5), 1)
+    return pd.DataFrame({"id": ids,
+                         "corner_st2": ids,
+                         "latitude": [45.54 + 0.002 * (i // side) for i in range(len(ids))],
+                         "longitude": [-73.54 + 0.002 * (i % side) for i in range(len(ids))],
+                         "id_camera": [0] * len(ids)})
+
+
+def make_elements(db, ids, n):
+    """
+    mirrors the setup of ../frontend/dash-app.py and returns the elements dict passed to init_callbacks
+
+    :param db (RedisDB):
+    :param ids (list): detector ids, used for the station names
+    :param n (int): number of historic readings shown in the scatter
+    :return:
+    """
+    plot_config, slider_config = load_configs()
+    stations = ["station {}".format(i + 1) for i in range(len(ids))]
+
+    hist_grid = db.grid("vehicle-speed", n)
+    hist_utc = hist_grid["time"]
+    hist_data = gridtools.as_lists(hist_grid["values"], hist_grid["mask"])
+    n = len(hist_utc)
+
+    scatter = layouttools.CustomScatter(plot_config)
+    slider = layouttools.CustomSlider(default_range=int(0.1 * n), min_gap=int(0.05 * n))
+
+    scatter.set_unit("kmh")
+    scatter.set_labels(hist_utc)
+    scatter.update_primary_fig(hist_data[0])
+    scatter.update_secondary_fig(hist_data[1 % len(ids)])
+    slider.set_labels(hist_utc)
+
+    table = layouttools.CustomTable(plot_config, "detector metrics summary", layouttools.card())
+    table.set_data(frontendtools.generate_table_data({"corner_st2": ids},
+                                                     db.latest_readings("vehicle-speed"),
+                                                     db.latest_readings("vehicle-count"),
+                                                     db.latest_readings("vehicle-gap-time")))
+
+    elements = {
+        "spinner": layouttools.CountdownSpinner(plot_config, "", layouttools.card(), "pie-graph"),
+        "timestamp": layouttools.TimeStamp(plot_config, "", layouttools.card()),
+        "slider-config": slider_config,
+        "n": n,
+        "slider": slider,
+        "scatter": scatter,
+        "db": db,
+        "station": stations,
+        "speedbar": layouttools.CustomBar(plot_config, "", layouttools.card(), "speed-live-graph"),
+        "countbar": layouttools.CustomBar(plot_config, "", layouttools.card(), "count-live-graph"),
+        "gapbar": layouttools.CustomBar(plot_config, "", layouttools.card(), "gap-live-graph"),
+        "table": table,
+        "countdown-duration": 15,
+        "cam-ids": {s: 0 for s in stations},
+        "cam-link": "{}",
+        "streets": {s: i for s, i in zip(stations, ids)},
+        "map": layouttools.LiveMap(detector_sheet(ids)),
+        "heatmap": layouttools.CustomHeatmap(plot_config, "", layouttools.card()),
+        "replay": layouttools.ReplayControls(plot_config, db.replay_bounds()),
+        "lag": layouttools.CustomLagChart(plot_config, "", layouttools.card())
+    }
+    return elements
+
+
+def init_headless_callbacks(elements):
+    app = HeadlessApp()
+    callbackcollection.init_callbacks(app, elements)
+    return app.callbacks
+
+
+def measure(fn, repeat=20, warmup=2):
+    """
+    calls fn repeatedly and returns summary statistics of the wall time per call in milliseconds
+
+    :param fn: callable taking no arguments
+    :param repeat (int):
+    :param warmup (int): untimed calls made first
+    :return:
+    """
+    for _ in range(warmup):
+        fn()
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+
+    return {"min_ms": min(samples),
+            "median_ms": statistics.median(samples),
+            "mean_ms": statistics.mean(samples),
+            "max_ms": max(samples),
+            "repeat": repeat}
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    silences the per-message prints of the collector so the terminal isn't part of what is measured
+    """
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+
+def environment():
+    commit = None
+    try:
+        import subprocess
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        pass
+
+    return {"commit": commit,
+            "python": sys.version.split()[0],
+            "created": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}
@@ -0,0 +1,256 @@
+""" Local MQTT Broker Stand-in
+
+A minimal in-process MQTT 3.1.1 broker so the publisher and collectors can be exercised without network access to
+broker.hivemq.com or mqtt.cgmu.io. It understands just enough of the protocol for paho-mqtt clients: CONNECT,
+PUBLISH at QoS 0 and 1, SUBSCRIBE/UNSUBSCRIBE with + and # wildcards, PINGREQ and DISCONNECT. Retained messages,
+wills, authentication and queueing for disconnected persistent sessions are not supported.
+
+Can be used from another script with LocalBroker(port).start(), or run on its own with 'python localbroker.py -p 1883'
+"""
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def topic_matches(topic_filter, topic):
+    """
+    checks a topic against a subscription filter that may contain the + (single level) and # (multi level) wildcards
+
+    :param topic_filter (str): e.g. worldcongress2017/.../traf/detector/#
+    :param topic (str):
+    :return:
+    """
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[i]:
+            return False
+
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length = length // 128
+        if length > 0:
+            byte |= 0x80
+        encoded.append(byte)
+        if length == 0:
+            return bytes(encoded)
+
+
+def encode_string(s):
+    s = s.encode()
+    return struct.pack("!H", len(s)) + s
+
+
+def read_string(data, pos):
+    length = struct.unpack("!H", data[pos:pos + 2])[0]
+    return data[pos + 2:pos + 2 + length].decode(), pos + 2 + length
+
+
+class _Session:
+    def __init__(self, client_id, sock):
+        self.client_id = client_id
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.next_mid = 0
+
+    def send(self, packet):
+        with self.lock:
+            self.sock.sendall(packet)
+
+    def publish(self, topic, payload, qos):
+        with self.lock:
+            header = encode_string(topic)
+            if qos > 0:
+                self.next_mid = self.next_mid % 65535 + 1
+                header += struct.pack("!H", self.next_mid)
+            body = header + payload
+            self.sock.sendall(bytes([(PUBLISH << 4) | (qos << 1)]) + encode_length(len(body)) + body)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def _read_exact(self, n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("client closed connection")
+            data.extend(chunk)
+        return bytes(data)
+
+    def _read_packet(self):
+        header = self._read_exact(1)[0]
+        multiplier = 1
+        length = 0
+        while True:
+            byte = self._read_exact(1)[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0F, self._read_exact(length)
+
+    def handle(self):
+        broker = self.server.broker
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        session = None
+
+        try:
+            while True:
+                ptype, flags, body = self._read_packet()
+
+                if ptype == CONNECT:
+                    _, pos = read_string(body, 0)
+                    pos += 4
+                    client_id, _ = read_string(body, pos)
+                    session = _Session(client_id, self.request)
+                    broker.register(session)
+                    session.send(bytes([CONNACK << 4, 2, 0, 0]))
+
+                elif ptype == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic, pos = read_string(body, 0)
+                    if qos > 0:
+                        mid = body[pos:pos + 2]
+                        pos += 2
+                        session.send(bytes([PUBACK << 4, 2]) + mid)
+                    broker.route(topic, body[pos:], qos)
+
+                elif ptype == SUBSCRIBE:
+                    mid = body[0:2]
+                    pos = 2
+                    granted = []
+                    while pos < len(body):
+                        topic_filter, pos = read_string(body, pos)
+                        qos = min(body[pos], 1)
+                        pos += 1
+                        broker.subscribe(session, topic_filter, qos)
+                        granted.append(qos)
+                    session.send(bytes([SUBACK << 4]) + encode_length(2 + len(granted)) + mid + bytes(granted))
+
+                elif ptype == UNSUBSCRIBE:
+                    mid = body[0:2]
+                    pos = 2
+                    while pos < len(body):
+                        topic_filter, pos = read_string(body, pos)
+                        broker.unsubscribe(session, topic_filter)
+                    session.send(bytes([UNSUBACK << 4, 2]) + mid)
+
+                elif ptype == PINGREQ:
+                    session.send(bytes([PINGRESP << 4, 0]))
+
+                elif ptype == DISCONNECT:
+                    break
+
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if session is not None:
+                broker.unregister(session)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class LocalBroker:
+    def __init__(self, host="127.0.0.1", port=1883):
+        """
+        in-process MQTT broker stand-in. Every client connection is served by its own thread and published messages
+        are forwarded to the matching subscriptions of every connected client
+
+        :param host (str):
+        :param port (int): use 0 to pick any free port, the chosen one is available as .port after start()
+        """
+        self.host = host
+        self.port = port
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.routed = 0
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        self.server = _Server((self.host, self.port), _Handler)
+        self.server.broker = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def register(self, session):
+        with self.lock:
+            self.sessions[session.client_id] = session
+
+    def unregister(self, session):
+        with self.lock:
+            if self.sessions.get(session.client_id) is session:
+                del self.sessions[session.client_id]
+
+    def subscribe(self, session, topic_filter, qos):
+        with self.lock:
+            session.subscriptions[topic_filter] = qos
+
+    def unsubscribe(self, session, topic_filter):
+        with self.lock:
+            session.subscriptions.pop(topic_filter, None)
+
+    def route(self, topic, payload, qos):
+        with self.lock:
+            targets = []
+            for session in self.sessions.values():
+                granted = [q for f, q in session.subscriptions.items() if topic_matches(f, topic)]
+                if granted:
+                    targets.append((session, min(qos, max(granted))))
+
+        for session, out_qos in targets:
+            try:
+                session.publish(topic, payload, out_qos)
+                self.routed += 1
+            except OSError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", type=int, default=1883)
+    parser.add_argument("--host", default="127.0.0.1")
+    args = parser.parse_args()
+
+    broker = LocalBroker(args.host, args.p).start()
+    print("local broker listening on {}:{}".format(broker.host, broker.port))
+    broker.thread.join()
+
+
+if __name__ == "__main__":
+    main()
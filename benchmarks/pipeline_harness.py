@@ -0,0 +1,301 @@
+""" Offline End-to-End Pipeline Harness
+
+Runs the whole pipeline on the local machine without network access:
+
+    pub_sim-style publisher -> localbroker.LocalBroker -> collect_sim collector -> redis -> dashboard callbacks
+
+The publisher sends simulated readings for the detectors in detectors-simulated.csv at a configurable rate, the
+collector is started through collect_sim.start exactly as it is in production, and the minute-interval callbacks from
+callbackcollection.init_callbacks are invoked headlessly at a fixed period while ingest is running.
+
+Reported are the sustained ingest throughput, message loss (published but never handled by the collector), freshness
+(time from publish to the reading being written to redis), the callback latencies and the size of what each callback
+sends to a browser. Redis is an in-process
+fakeredis unless --redis-host points to a locally spawned server (note that its db is flushed).
+
+To run, set ../src on the PYTHONPATH and launch from terminal with 'python pipeline_harness.py --rate 500 -d 30'
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import statistics
+
+import dash
+from plotly.utils import PlotlyJSONEncoder
+from paho.mqtt import client as mqtt_client
+
+import frontendtools
+import harnesstools
+import sheettools
+from localbroker import LocalBroker
+
+simdir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, "backend", "mqtt_sim"))
+sys.path.insert(0, simdir)
+
+import pub_sim
+import collect_sim
+
+
+class IngestProbe:
+    def __init__(self, on_message):
+        """
+        wraps the collector's on_message callback to count the handled messages and measure their freshness from
+        the PublishedAt field the harness adds to each payload (the collector itself ignores unknown fields)
+
+        :param on_message: the callback assigned by collect_sim.start
+        """
+        self.on_message = on_message
+        self.received = 0
+        self.seen = set()
+        self.duplicates = 0
+        self.freshness = []
+        self.lock = threading.Lock()
+
+    def __call__(self, client, userdata, msg):
+        self.on_message(client, userdata, msg)
+        done = time.time()
+
+        payload = json.loads(msg.payload.decode())
+        with self.lock:
+            self.received += 1
+            seq = payload["HarnessSeq"]
+            if seq in self.seen:
+                self.duplicates += 1
+            self.seen.add(seq)
+            self.freshness.append(done - payload["PublishedAt"])
+
+
+def make_topics():
+    sheet = sheettools.load("detectors-simulated.csv")
+    topics = []
+    for each_topic in sheet['topics']:
+        for each_type in harnesstools.value_types:
+            topics.append(each_topic + each_type)
+    return topics
+
+
+def publish(client, topics, rate, duration, counter, qos=0):
+    """
+    publishes pub_sim messages round-robin over the topics at `rate` messages per second for `duration` seconds
+
+    :param client: connected paho client
+    :param topics (list):
+    :param rate (float): messages per second
+    :param duration (float): seconds
+    :param counter (dict): receives the number of published messages under 'published'
+    :param qos (int):
+    :return:
+    """
+    interval = 1.0 / rate
+    start = time.perf_counter()
+    next_send = start
+    seq = counter["published"]
+
+    while time.perf_counter() - start < duration:
+        t = topics[seq % len(topics)]
+        pub_sim.randomize()
+
+        if "speed" in t:
+            msg = pub_sim.generate_msg("Average-vehicle-speed-for-vehicles", "Km/h", pub_sim.speed_sim)
+        elif "count" in t:
+            msg = pub_sim.generate_msg("Number-of-vehicles-during-the-integration-interval", "", pub_sim.count_sim)
+        else:
+            msg = pub_sim.generate_msg("Vehicle-average-gap-time", "1/10sec", pub_sim.gaptime_sim)
+
+        msg["HarnessSeq"] = seq
+        msg["PublishedAt"] = time.time()
+        client.publish(t, json.dumps(msg), qos)
+        seq += 1
+        counter["published"] = seq
+
+        next_send += interval
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def payload_size(outputs):
+    """
+    bytes of json a callback's outputs take on the wire, outputs left as dash.no_update aren't sent
+    """
+    if not isinstance(outputs, (list, tuple)):
+        outputs = [outputs]
+    sent = [o for o in outputs if o is not dash.no_update]
+    return len(json.dumps(sent, cls=PlotlyJSONEncoder))
+
+
+def poll_dashboard(db, period, stop, latencies, errors, sizes):
+    """
+    calls the minute-interval callbacks every `period` seconds, the way each open dashboard would, until `stop` is set
+
+    :param db: redis client shared with the collector
+    :param period (float): seconds between refreshes
+    :param stop (Event):
+    :param latencies (dict): callback name -> list of latencies in ms, filled in place
+    :param errors (dict): callback name -> number of calls that raised, filled in place
+    :param sizes (dict): callback name -> list of payload sizes in bytes, filled in place
+    :return:
+    """
+    rdb = frontendtools.RedisDB(client=db)
+    elements = harnesstools.make_elements(rdb, rdb.keys, 240)
+    callbacks = harnesstools.init_headless_callbacks(elements)
+    n = elements["n"]
+    window = [max(n - int(0.1 * n), 0), n - 1]
+
+    # the scatter-sent store, as kept by the browser between ticks
+    browser = {"scatter-sent": None}
+
+    def scatter_tick():
+        outputs = callbacks["update_scatter"](1, "speed", "station 1", "station 2", window, browser["scatter-sent"])
+        if outputs[2] is not dash.no_update:
+            browser["scatter-sent"] = outputs[2]
+        return outputs
+
+    calls = {
+        "update_barplots_and_table": lambda: callbacks["update_barplots_and_table"](1, None),
+        "update_timestamp": lambda: callbacks["update_timestamp"](1, None),
+        "update_scatter": scatter_tick,
+        "update_slider": lambda: callbacks["update_slider"](window, 1),
+        "update_heatmap": lambda: callbacks["update_heatmap"](1, "speed"),
+        "update_lags": lambda: callbacks["update_lags"](1),
+    }
+
+    while not stop.wait(period):
+        for name, call in calls.items():
+            start = time.perf_counter()
+            try:
+                with harnesstools.triggered("minute-interval.n_intervals"):
+                    outputs = call()
+            except Exception:
+                errors[name] = errors.get(name, 0) + 1
+                continue
+            latencies.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+            sizes.setdefault(name, []).append(payload_size(outputs))
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def summarize_ms(values):
+    if not values:
+        return None
+    return {"median_ms": statistics.median(values),
+            "p95_ms": percentile(values, 0.95),
+            "max_ms": max(values),
+            "calls": len(values)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=200, help="published messages per second")
+    parser.add_argument("-d", type=float, default=20, help="seconds of publishing")
+    parser.add_argument("--drain", type=float, default=5, help="seconds to wait for in-flight messages")
+    parser.add_argument("--dashboard-period", type=float, default=1.0)
+    parser.add_argument("--qos", type=int, default=0, choices=[0, 1])
+    parser.add_argument("--redis-host")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("-o", default="pipeline_results.json")
+    args = parser.parse_args()
+
+    broker = LocalBroker(port=0).start()
+
+    db = harnesstools.make_db(args.redis_host, args.redis_port)
+    db.flushdb()
+
+    collector = collect_sim.start(db, "127.0.0.1", broker.port, args.qos)
+    probe = IngestProbe(collector.on_message)
+    collector.on_message = probe
+    collector.loop_start()
+
+    publisher = mqtt_client.Client("harness-publisher")
+    publisher.connect("127.0.0.1", broker.port)
+    publisher.loop_start()
+
+    # give the subscriptions time to land before publishing
+    time.sleep(1)
+
+    # seed one round of readings so the dashboard has something to build its figures from
+    counter = {"published": 0}
+    topics = make_topics()
+    with harnesstools.quiet():
+        publish(publisher, topics, args.rate, len(topics) / args.rate, counter, args.qos)
+        time.sleep(1)
+
+    stop = threading.Event()
+    latencies = {}
+    errors = {}
+    sizes = {}
+    dashboard = threading.Thread(target=poll_dashboard,
+                                 args=(db, args.dashboard_period, stop, latencies, errors, sizes), daemon=True)
+
+    with harnesstools.quiet():
+        received_before = probe.received
+        published_before = counter["published"]
+        dashboard.start()
+
+        start = time.perf_counter()
+        publish(publisher, topics, args.rate, args.d, counter, args.qos)
+        publish_seconds = time.perf_counter() - start
+
+        deadline = time.perf_counter() + args.drain
+        while probe.received < counter["published"] and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        ingest_seconds = time.perf_counter() - start
+
+        stop.set()
+        dashboard.join()
+
+    publisher.loop_stop()
+    publisher.disconnect()
+    collector.loop_stop()
+    collector.disconnect()
+    broker.stop()
+
+    published = counter["published"] - published_before
+    received = probe.received - received_before
+    unique = len(probe.seen)
+
+    results = {"env": harnesstools.environment(),
+               "config": {"rate": args.rate, "duration_s": args.d, "topics": len(topics), "qos": args.qos,
+                          "dashboard_period_s": args.dashboard_period},
+               "published": published,
+               "received": received,
+               "lost": counter["published"] - unique,
+               "duplicates": probe.duplicates,
+               "loss_ratio": (counter["published"] - unique) / counter["published"],
+               "publish_rate": published / publish_seconds,
+               "ingest_rate": received / ingest_seconds,
+               "freshness": {"median_ms": 1000 * statistics.median(probe.freshness),
+                             "p95_ms": 1000 * percentile(probe.freshness, 0.95),
+                             "max_ms": 1000 * max(probe.freshness)},
+               "callbacks": {k: summarize_ms(v) for k, v in latencies.items()},
+               "payload_bytes": {k: {"first": v[0], "median": statistics.median(v)} for k, v in sizes.items()},
+               "callback_errors": errors}
+
+    print("published {} msgs at {:.0f} msgs/s, ingested {:.0f} msgs/s".format(
+        published, results["publish_rate"], results["ingest_rate"]))
+    print("lost {} ({:.2%}), duplicates {}".format(results["lost"], results["loss_ratio"], results["duplicates"]))
+    print("freshness median {:.1f} ms, p95 {:.1f} ms, max {:.1f} ms".format(
+        results["freshness"]["median_ms"], results["freshness"]["p95_ms"], results["freshness"]["max_ms"]))
+    for name, summary in results["callbacks"].items():
+        print("{:<26} median {:>8.2f} ms  p95 {:>8.2f} ms  ({} calls)  payload first {} B, median {} B".format(
+            name, summary["median_ms"], summary["p95_ms"], summary["calls"], results["payload_bytes"][name]["first"],
+            results["payload_bytes"][name]["median"]))
+    for name, count in errors.items():
+        print("{:<26} raised {} time(s)".format(name, count))
+
+    with open(args.o, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print("results written to {}".format(args.o))
+
+
+if __name__ == "__main__":
+    main()
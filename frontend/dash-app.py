@@ -14,8 +14,15 @@ Main information conveyed are the current vehicle speed, count, and gaptime at e
 over 24hrs for each detector is also available in scatter plot form, along with option to compare against a second
 detector and the option for switching between reading types.
 
+Any past moment the collector archived (two weeks by default) can be replayed with the controls above the heatmap:
+scrub to it with the slider and play it forward at up to 300x, the bars, table, timestamp card and map then show the
+readings of that moment until going back to live. Below the heatmap, the lag panel shows how many minutes a change of
+speed takes to travel between adjacent stations, as estimated by ../backend/workers/lag_worker.py.
+
 A bonus feature, not related to mqtt data, is the ability to access live traffic cam feed at the location
-of the detectors. Note that these camera feeds update at ~5 minute intervals.
+of the detectors. Note that these camera feeds update at ~5 minute intervals. The images are fetched in the background
+by one of the server's workers, shared with the others through redis and served as thumbnails from /camera/<id>.jpeg
+(see ../src/cameratools.py), so viewers' browsers don't hit the city's server.
 
 As for Dash:
 Certain graphic elements are improved by using dash-bootstrap-components. The staggered layout is implemented with
@@ -28,6 +35,10 @@ managment for updating the plots much easier. Though whether it is a necessary p
 To run this dashboard, make sure to set ../src on the PYTHONPATH environment variable and launch from temrinal
 with 'python dash-app.py'
 
+The dashboard can also be served by several processes, e.g. 'gunicorn -w 4 -b 0.0.0.0:8080 dash-app:server' from this
+directory. Rendered figures and tables are cached in redis under the data version written by the collector, so a render
+done by one worker is reused by all of them (see ../src/rendertools.py).
+
 """
 import dash
 import layouttools
@@ -36,6 +47,11 @@ from dash.dependencies import Input, Output, State
 
 import frontendtools
 import callbackcollection
+import cameratools
+import apitools
+import gridtools
+import shmtools
+import os
 import pandas as pd
 import json
 from layouttools import *
@@ -47,7 +63,7 @@ countdown_duration = 15
 s_freq = 1010
 m_freq=s_freq*countdown_duration
 
-cam_link = "http://www1.ville.montreal.qc.ca/Circulation-Cameras/GEN{}.jpeg"
+cam_link = cameratools.proxy_link
 
 with open("./assets/bar_config.json", "r") as jfile:
     plot_config = json.load(jfile)
@@ -71,25 +87,39 @@ sinterval = dcc.Interval(
     interval=s_freq,
     n_intervals=0)
 
-# read detector datasheet
-df = pd.read_csv("../data/detectors-active.csv")
+# connect to redis, uses wrapper class for pyredis's Redis class from frontend_utils. on a single host without redis,
+# MTL_SHM_STORE names the shared memory store the collector writes to instead (collect_sim.py --shm)
+if os.environ.get("MTL_SHM_STORE"):
+    db = shmtools.ShmDB(os.environ["MTL_SHM_STORE"])
+else:
+    db = frontendtools.RedisDB()
+
+# read detector datasheet, keeping only the detectors in the db (which may include detectors discovered by the collector
+# that aren't in the datasheet)
+df = pd.read_csv("../data/detectors-active.csv", dtype={"id": str})
+df = db.detector_sheet(df)
 stations = ["station {}".format(i + 1) for i in range(len(df))]
-cam_ids = df["id_camera"].values.tolist()
+cam_ids = [None if pd.isna(i) else str(int(float(i))) for i in df["id_camera"].values.tolist()]
+if db.db is not None:
+    camera_proxy = cameratools.CameraProxy(cam_ids, db.db)
+else:
+    # no redis to share the thumbnails through with the shared memory store, browsers load the city's images directly
+    camera_proxy = None
+    cam_link = cameratools.camera_link
 cam_ids = {s: i for s, i in zip(stations, cam_ids)}
 streets = df["corner_st2"].values.tolist()
 streets = {s: st for s, st in zip(stations, streets)}
 
-# connect to redis, uses wrapper class for pyredis's Redis class from frontend_utils
-db = frontendtools.RedisDB()
-
 # get readings
 speed_values = db.latest_readings("vehicle-speed")
 count_values = db.latest_readings("vehicle-count")
 gap_values = db.latest_readings("vehicle-gap-time")
-timestamp = db.latest_readings("time")[0]
+timestamp = next((t for t in db.latest_readings("time") if t is not None), None)
 
-hist_data = db.n_latest_readings("vehicle-speed", n)
-hist_utc = db.n_latest_readings("time", n)[0]
+# the scatter shows the stations on a shared grid of minutes, see ../src/gridtools.py
+hist_grid = db.grid("vehicle-speed", n)
+hist_data = gridtools.as_lists(hist_grid["values"], hist_grid["mask"])
+hist_utc = hist_grid["time"]
 hist_dict = {s: l for s, l in zip(stations, hist_data)}
 
 n=len(hist_utc)
@@ -114,6 +144,8 @@ gap_card = left_column.get_subpanel_by_id("vgap").children
 refresh_card = right_column.get_subpanel_by_id("stat-3").children
 timestamp_card = right_column.get_subpanel_by_id('stat-4').children
 hist_card = right_column.get_subpanel_by_id("hist-pane").children
+heat_card = right_column.get_subpanel_by_id("heat-pane").children
+lag_card = right_column.get_subpanel_by_id("lag-pane").children
 table_card = left_column.get_subpanel_by_id("aux").children
 
 # populate cards with texts and/or maps and plots with wrapper definitions or classes from layout_utils
@@ -121,7 +153,8 @@ table_card = left_column.get_subpanel_by_id("aux").children
 title_card.children = layouttools.make_title()
 spinner = CountdownSpinner(plot_config, "seconds to next update", refresh_card, "pie-graph")
 ts = TimeStamp(plot_config, "readings as of ", timestamp_card)
-ts.update_time(timestamp)
+if timestamp is not None:
+    ts.update_time(timestamp)
 
 camera_card.children = layouttools.make_modal(plot_config, stations)
 
@@ -129,17 +162,18 @@ table = CustomTable(plot_config, "detector metrics summary", table_card)
 table_data = frontendtools.generate_table_data(df, speed_values, count_values, gap_values)
 table.set_data(table_data)
 
-map_fig, map_data = layouttools.init_map(df)
-map_card.figure = map_fig
-map_fig.update_layout(paper_bgcolor="gray", margin=dict(l=0, r=0, b=0, t=0))
+live_map = LiveMap(df)
+live_map.fig.update_layout(paper_bgcolor="gray", margin=dict(l=0, r=0, b=0, t=0))
+map_card.figure = live_map.fig
 
 speedbar = CustomBar(plot_config, "speed dectected", speed_card, "speed-live-graph")
 countbar = CustomBar(plot_config, "vehicles counted", count_card, "count-live-graph")
 gapbar = CustomBar(plot_config, "gap time between vehicles", gap_card, "gap-live-graph")
 
-speedbar.set_data(speed_values, stations, "kmh")
-countbar.set_data(count_values, stations, "cars")
-gapbar.set_data(gap_values, stations, "s")
+# detectors registered without readings yet are drawn as 0, as in the callbacks
+speedbar.set_data([0 if v is None else v for v in speed_values], stations, "kmh")
+countbar.set_data([0 if v is None else v for v in count_values], stations, "cars")
+gapbar.set_data([0 if v is None else v for v in gap_values], stations, "s")
 
 # the historic scatter plot is more involved with the choice to choose 2 stations and a data type to compare
 # initially start with station1, station2, and vehicle speed
@@ -165,10 +199,23 @@ scatter.zoom_in(zoom_start,zoom_end)
 
 slider.set_labels(hist_utc)
 
-hist_card.children = [cardheader, dropdown.layout, slider.layout, scatter.graph]
+hist_card.children = [cardheader, dropdown.layout, slider.layout, scatter.graph, scatter.store]
+
+# time-travel replay of the bars, table, timestamp and map from the collector's archive (see ../src/replaytools.py),
+# its controls sit above the heatmap
+replay = ReplayControls(plot_config, db.replay_bounds())
+
+# every station at once over the last 24h, from the 5 minute rollups written by the collector (see ../src/gridtools.py)
+heatmap = CustomHeatmap(plot_config, "all stations over the last 24 hours - 5 minute means", heat_card,
+                        controls=replay.layout)
+heat_matrix = db.heatmap("vehicle-speed")
+heatmap.set_data(heat_matrix["values"], heat_matrix["time"], stations, "kmh")
+
+# minutes a change of speed takes between adjacent stations, written by ../backend/workers/lag_worker.py
+lag_chart = CustomLagChart(plot_config, "congestion wave lag between adjacent stations - last 2 hours", lag_card)
 
 # assign populated layout to app, along with interval components for updating
-app.layout = html.Div([layout, minterval, sinterval])
+app.layout = html.Div([layout, minterval, sinterval, live_map.store, replay.store, replay.timer])
 
 # current way to pass objects so that they can be used by callback methods in the callbackcollection.py module
 # probably a better way exists, to be investigated in future
@@ -189,11 +236,27 @@ elements = {
     "countdown-duration": countdown_duration,
     'cam-ids': cam_ids,
     "cam-link": cam_link,
-    "streets": streets
+    "streets": streets,
+    "map": live_map,
+    "heatmap": heatmap,
+    "replay": replay,
+    "lag": lag_chart
 }
 
 callbackcollection.init_callbacks(app, elements)
 
+# flask server for wsgi servers such as gunicorn
+server = app.server
+
+if camera_proxy is not None:
+    camera_proxy.register(server)
+    # started in every gunicorn worker, only the one holding the lease fetches from the city's server
+    camera_proxy.start()
+
+# json endpoints for consumers of the data, see ../src/apitools.py
+api = apitools.QueryAPI(db, df)
+api.register(server)
+
 
 def main():
     parser=argparse.ArgumentParser()
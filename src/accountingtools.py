@@ -0,0 +1,162 @@
+"""Ingest Accounting Utilities
+
+Keeps track of the quality of the data received over mqtt: how many readings were expected versus received for each
+detector, and how many of them were duplicates, arrived late or were never received at all (gaps in the per-detector
+minute sequence).
+
+Each detector is expected to publish one reading per lane and per reading type every minute. A reading is a duplicate
+if the same (detector, lane, reading type, CreateUtc) was already received, e.g. a QoS 1 redelivery, and late if its
+minute is older than the newest minute already received for that detector. When a detector's newest minute advances by
+more than one, the skipped minutes are counted as gaps.
+
+Counters are accumulated in memory and flushed every few seconds with HINCRBY to a single redis hash, ingest:counters,
+so a data quality summary of all detectors costs one HGETALL no matter the load. Fields are the totals ("received",
+"expected", ...) and the same per detector ("00773:received", ...).
+
+"""
+import time
+import datetime
+
+counters_key = "ingest:counters"
+fields = ["expected", "received", "duplicates", "late", "gaps"]
+
+
+def minute_of(created):
+    """
+    :param created (str): CreateUtc timestamp of a reading, e.g. 2021-01-15T08:00:00
+    :return: minutes since epoch as an int
+    """
+    stamp = datetime.datetime.strptime(created[:16], "%Y-%m-%dT%H:%M")
+    return int(stamp.replace(tzinfo=datetime.timezone.utc).timestamp()) // 60
+
+
+class IngestAccounting:
+    def __init__(self, lanes, value_types, horizon=60, flush_every=5):
+        """
+        :param lanes (dict): number of lane topics of each detector, {det_id: n_lanes}. Unknown detectors are
+        assumed to have a single lane
+        :param value_types (list): reading types every lane publishes each minute
+        :param horizon (int): minutes of received readings remembered for duplicate detection
+        :param flush_every (float): seconds between flushes of the counters to redis
+        """
+        self.lanes = lanes
+        self.value_types = value_types
+        self.horizon = horizon
+        self.flush_every = flush_every
+
+        self.last_minute = {}
+        self.seen = {}
+        self.pending = {}
+        self.minute_cache = {}
+        self.last_flush = time.perf_counter()
+
+    def _count(self, det_id, field, amount=1):
+        self.pending[field] = self.pending.get(field, 0) + amount
+        key = det_id + ":" + field
+        self.pending[key] = self.pending.get(key, 0) + amount
+
+    def _minute(self, created):
+        prefix = created[:16]
+        minute = self.minute_cache.get(prefix)
+        if minute is None:
+            if len(self.minute_cache) > 4 * self.horizon:
+                self.minute_cache = {}
+            minute = minute_of(created)
+            self.minute_cache[prefix] = minute
+        return minute
+
+    def record(self, det_id, lane, subj, created):
+        """
+        accounts for a newly received reading
+
+        :param det_id (str):
+        :param lane (str): lane of the detector the reading is from
+        :param subj (str): reading type
+        :param created (str): CreateUtc of the reading
+        :return: "duplicate", "late" or "ok"
+        """
+        minute = self._minute(created)
+        seen = self.seen.setdefault(det_id, {})
+        reading_id = (lane, subj, created)
+
+        if reading_id in seen.get(minute, ()):
+            self._count(det_id, "duplicates")
+            return "duplicate"
+
+        seen.setdefault(minute, set()).add(reading_id)
+        self._count(det_id, "received")
+
+        last = self.last_minute.get(det_id)
+        per_minute = self.lanes.get(det_id, 1) * len(self.value_types)
+
+        if last is None:
+            self.last_minute[det_id] = minute
+            self._count(det_id, "expected", per_minute)
+            return "ok"
+
+        if minute < last:
+            self._count(det_id, "late")
+            return "late"
+
+        if minute > last:
+            self._count(det_id, "expected", (minute - last) * per_minute)
+            if minute - last > 1:
+                self._count(det_id, "gaps", minute - last - 1)
+            self.last_minute[det_id] = minute
+
+            for old in [m for m in seen if m < minute - self.horizon]:
+                del seen[old]
+
+        return "ok"
+
+    def due(self):
+        return time.perf_counter() - self.last_flush >= self.flush_every
+
+    def flush(self, db):
+        """
+        adds the counts accumulated since the last flush to the ingest:counters hash in a single round trip
+
+        :param db: Redis instance from redis
+        :return:
+        """
+        self.last_flush = time.perf_counter()
+        if not self.pending:
+            return
+
+        pipe = db.pipeline(transaction=False)
+        for field, amount in self.pending.items():
+            pipe.hincrby(counters_key, field, amount)
+        pipe.execute()
+        self.pending = {}
+
+    def discard(self):
+        """
+        drops the counts accumulated since the last flush, e.g. on a standby collector whose counts another collector
+        reports, see hatools.py
+        """
+        self.last_flush = time.perf_counter()
+        self.pending = {}
+
+
+def summary(db):
+    """
+    reads the ingest:counters hash back into totals and per detector counters, with the number of missing readings
+    and the completeness ratio derived from them
+
+    :param db: Redis instance from redis
+    :return: {"total": {field: int, ...}, "detectors": {det_id: {field: int, ...}}}
+    """
+    raw = {k.decode(): int(v) for k, v in db.hgetall(counters_key).items()}
+
+    total = {f: raw.get(f, 0) for f in fields}
+    detectors = {}
+    for k, v in raw.items():
+        if ":" in k:
+            det_id, field = k.split(":", 1)
+            detectors.setdefault(det_id, {f: 0 for f in fields})[field] = v
+
+    for counts in [total] + list(detectors.values()):
+        counts["missing"] = max(counts["expected"] - counts["received"], 0)
+        counts["completeness"] = counts["received"] / counts["expected"] if counts["expected"] else None
+
+    return {"total": total, "detectors": detectors}
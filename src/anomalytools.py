@@ -0,0 +1,141 @@
+"""Streaming Anomaly Detection Utilities
+
+Keeps rolling statistics for every (detector, reading type) as readings arrive and flags readings that deviate
+sharply from them, e.g. a sudden collapse of the speed at Pie-IX, without ever rescanning the history.
+
+Each update is O(1): Welford's algorithm maintains the long-run mean and variance, and an exponentially weighted moving
+average (EWMA) tracks the recent level. A reading is flagged when it's more than `threshold` long-run standard
+deviations away from the EWMA, once at least `warmup` readings have been seen.
+
+The flag, z-score and the statistics themselves are written by the collector to a hash per detector,
+anomaly:<det_id>, with one json field per reading type, in the same round trip as the reading. The dashboard only
+reads the flags back, it never computes statistics at request time, and a restarted collector resumes from the stored
+statistics.
+
+"""
+import json
+import math
+
+key_template = "anomaly:{}"
+
+
+class RollingStats:
+    def __init__(self, alpha=0.1):
+        """
+        Welford mean/variance plus an EWMA over a stream of readings
+
+        :param alpha (float): smoothing factor of the EWMA, higher reacts faster
+        """
+        self.alpha = alpha
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.ewma = None
+
+    def std(self):
+        if self.n < 2:
+            return 0.0
+        return math.sqrt(self.m2 / (self.n - 1))
+
+    def score(self, value):
+        """
+        z-score of a value against the recent level and long-run spread, before the value is added
+        """
+        std = self.std()
+        if self.ewma is None or std == 0:
+            return 0.0
+        return (value - self.ewma) / std
+
+    def update(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+        if self.ewma is None:
+            self.ewma = float(value)
+        else:
+            self.ewma += self.alpha * (value - self.ewma)
+
+    def to_dict(self):
+        return {"n": self.n, "mean": self.mean, "m2": self.m2, "ewma": self.ewma}
+
+    @classmethod
+    def from_dict(cls, d, alpha=0.1):
+        stats = cls(alpha)
+        stats.n = d["n"]
+        stats.mean = d["mean"]
+        stats.m2 = d["m2"]
+        stats.ewma = d["ewma"]
+        return stats
+
+
+class AnomalyDetector:
+    def __init__(self, threshold=3.0, alpha=0.1, warmup=30):
+        """
+        :param threshold (float): number of standard deviations from the EWMA beyond which a reading is flagged
+        :param alpha (float): smoothing factor of the EWMA
+        :param warmup (int): readings needed before anything is flagged
+        """
+        self.threshold = threshold
+        self.alpha = alpha
+        self.warmup = warmup
+        self.stats = {}
+
+    def update(self, pipe, det_id, subj, value, time):
+        """
+        scores the reading against the statistics so far, adds it to them and queues the write of the flag and
+        statistics on `pipe`
+
+        :param pipe: redis pipeline the reading itself is written with
+        :param det_id (str):
+        :param subj (str): reading type
+        :param value (float):
+        :param time (str): CreateUtc of the reading
+        :return: True if the reading is flagged
+        """
+        key = (det_id, subj)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = RollingStats(self.alpha)
+            self.stats[key] = stats
+
+        z = stats.score(value)
+        flag = stats.n >= self.warmup and abs(z) > self.threshold
+        stats.update(value)
+
+        entry = stats.to_dict()
+        entry.update({"flag": int(flag), "z": round(z, 3), "std": stats.std(), "time": time})
+        pipe.hset(key_template.format(det_id), subj, json.dumps(entry))
+        return flag
+
+    def restore(self, db, det_ids):
+        """
+        resumes the statistics stored by a previous run of the collector
+
+        :param db: Redis instance from redis
+        :param det_ids (list):
+        :return:
+        """
+        for det_id in det_ids:
+            for subj, raw in db.hgetall(key_template.format(det_id)).items():
+                self.stats[(det_id, subj.decode())] = RollingStats.from_dict(json.loads(raw), self.alpha)
+
+
+def read_flags(db, det_ids, value_type):
+    """
+    latest anomaly flag of each detector for a reading type, in the order of det_ids
+
+    :param db: Redis instance from redis
+    :param det_ids (list):
+    :param value_type (str):
+    :return: list of bools
+    """
+    pipe = db.pipeline(transaction=False)
+    for det_id in det_ids:
+        pipe.hget(key_template.format(det_id), value_type)
+
+    flags = []
+    for raw in pipe.execute():
+        flags.append(raw is not None and json.loads(raw)["flag"] == 1)
+    return flags
@@ -0,0 +1,216 @@
+"""Read-Only Query API Utilities
+
+JSON endpoints on the dashboard's flask server, for consumers that want the data rather than the Dash UI:
+
+    /api/v1/detectors                           detector ids with their corner streets and coordinates
+    /api/v1/latest/<reading type>               latest reading of every detector
+    /api/v1/series/<det_id>/<reading type>?n=60 last n readings of a detector, with their times
+    /api/v1/rollup/<reading type>?minutes=15    mean, min and max of every detector over the last minutes, at most 300
+    /api/v1/lanes/<reading type>?how=mean&n=60  readings combined from the raw lane readings, see lanetools.py
+    /api/v1/export/<source>?format=csv&start=&end=
+                                                bulk history streamed as gzip csv, arrow or parquet, see exporttools.py
+
+Reading types are vehicle-speed, vehicle-count and vehicle-gap-time.
+
+Responses are read from the dashboard's own RedisDB and cached through rendertools.RenderCache under the data version,
+so a response is built once per sensor update and shared by all workers. Each carries a strong ETag made of the data
+version and the request, and a request whose If-None-Match matches gets a 304 without the data being read at all:
+clients polling between two sensor updates cost a single redis GET. Exports are streamed as they're encoded and aren't
+cached.
+
+"""
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from flask import Response, request
+
+import rendertools
+import exporttools
+
+prefix = "/api/v1"
+value_types = ["vehicle-speed", "vehicle-count", "vehicle-gap-time"]
+# minutes the collector's grid holds, see gridtools.GridRecorder
+grid_minutes = 300
+
+
+class QueryAPI:
+    def __init__(self, db, sheet=None, max_n=1440):
+        """
+        :param db: frontendtools.RedisDB (or shmtools.ShmDB) the dashboard reads from
+        :param sheet (DataFrame): detector datasheet in the order of db.keys, see RedisDB.detector_sheet. detectors
+        appended to db.keys later are added to it
+        :param max_n (int): largest number of readings a request may ask for
+        """
+        self.db = db
+        self.sheet = sheet
+        self.max_n = max_n
+        self.cache = rendertools.RenderCache(db.db)
+
+    def _respond(self, render):
+        """
+        answers the current request with the json of render(), or a 304 if the client already has it
+
+        :param render (callable): builds the payload, raises LookupError for unknown detectors or reading types
+        :return: flask Response
+        """
+        version = self.cache.version()
+        if version is not None:
+            digest = hashlib.sha1(request.full_path.encode()).hexdigest()[:16]
+            etag = '"{}-{}"'.format(version, digest)
+            if request.headers.get("If-None-Match") == etag:
+                return Response(status=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+        try:
+            payload = self.cache.get("api", request.full_path, render)
+        except LookupError as e:
+            return Response(json.dumps({"error": str(e)}), status=404, mimetype="application/json")
+
+        body = json.dumps(payload)
+        if version is None:
+            # no data version to tell responses apart, e.g. with the shared memory store
+            etag = '"{}"'.format(hashlib.sha1(body.encode()).hexdigest()[:16])
+            if request.headers.get("If-None-Match") == etag:
+                return Response(status=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+        return Response(body, mimetype="application/json",
+                        headers={"ETag": etag, "Cache-Control": "no-cache", "Access-Control-Allow-Origin": "*"})
+
+    def _check_type(self, value_type):
+        if value_type not in value_types:
+            raise LookupError("unknown reading type {}, expected one of {}".format(value_type, value_types))
+
+    def _arg(self, name, default):
+        try:
+            return min(max(int(request.args.get(name, default)), 1), self.max_n)
+        except ValueError:
+            return default
+
+    def detectors(self):
+        def render():
+            keys = list(self.db.keys)
+            sheet = self.sheet
+            if sheet is not None and len(sheet) < len(keys):
+                # detectors registered since the dashboard started, see RedisDB.refresh_keys
+                added = self.db.detector_sheet(sheet.iloc[:0], keys[len(sheet):])
+                sheet = self.sheet = pd.concat([sheet, added], ignore_index=True)
+
+            detectors = []
+            for i, det_id in enumerate(keys):
+                entry = {"id": det_id}
+                if sheet is not None:
+                    row = sheet.iloc[i]
+                    for column in ["corner_st1", "corner_st2", "latitude", "longitude"]:
+                        # detectors missing from the datasheet have NaN fields, which aren't valid json
+                        entry[column] = None if pd.isna(row[column]) else row[column]
+                    entry["latitude"] = entry["latitude"] and float(entry["latitude"])
+                    entry["longitude"] = entry["longitude"] and float(entry["longitude"])
+                detectors.append(entry)
+            return {"detectors": detectors}
+
+        return self._respond(render)
+
+    def latest(self, value_type):
+        def render():
+            self._check_type(value_type)
+            values = self.db.n_latest_readings(value_type, 1)
+            times = self.db.n_latest_readings("time", 1)
+            return {"type": value_type,
+                    "readings": {k: {"time": t[-1] if t else None, "value": v[-1] if v else None}
+                                 for k, t, v in zip(self.db.keys, times, values)}}
+
+        return self._respond(render)
+
+    def series(self, det_id, value_type):
+        n = self._arg("n", 60)
+
+        def render():
+            self._check_type(value_type)
+            if det_id not in self.db.keys:
+                raise LookupError("unknown detector {}".format(det_id))
+
+            i = self.db.keys.index(det_id)
+            values = self.db.n_latest_readings(value_type, n)[i]
+            times = self.db.n_latest_readings("time", n)[i]
+
+            # a reading type may be a reading ahead of the times while a minute is being collected
+            k = min(len(values), len(times))
+            return {"id": det_id, "type": value_type, "time": times[len(times) - k:], "values": values[len(values) - k:]}
+
+        return self._respond(render)
+
+    def rollup(self, value_type):
+        minutes = min(self._arg("minutes", 15), grid_minutes)
+
+        def render():
+            self._check_type(value_type)
+            # the minutes of the grid rather than the latest list entries, which don't say which minute they're of, so
+            # that every detector is rolled up over the same minutes
+            grid = self.db.grid(value_type, minutes)
+            values, mask = grid["values"], grid["mask"]
+
+            counts = mask.sum(axis=1)
+            sums = np.where(mask, values, 0).sum(axis=1)
+            means = np.divide(sums, counts, out=np.zeros(len(counts)), where=counts > 0)
+            lows = np.where(mask, values, np.inf).min(axis=1, initial=np.inf)
+            highs = np.where(mask, values, -np.inf).max(axis=1, initial=-np.inf)
+
+            rollups = {}
+            for k, count, mean, low, high in zip(self.db.keys, counts.tolist(), means.tolist(), lows.tolist(),
+                                                 highs.tolist()):
+                rollups[k] = None if count == 0 else {"mean": round(mean, 2), "min": low, "max": high,
+                                                      "readings": count}
+            return {"type": value_type, "minutes": minutes, "start": grid["time"][0] if grid["time"] else None,
+                    "end": grid["time"][-1] if grid["time"] else None, "rollups": rollups}
+
+        return self._respond(render)
+
+    def lanes(self, value_type):
+        n = self._arg("n", 60)
+        how = request.args.get("how", "mean")
+
+        def render():
+            self._check_type(value_type)
+            if not hasattr(self.db, "lane_readings"):
+                raise LookupError("raw lane readings are only kept in redis")
+            try:
+                return {"type": value_type, "how": how, "detectors": self.db.lane_readings(value_type, how, n)}
+            except ValueError as e:
+                raise LookupError(str(e))
+
+        return self._respond(render)
+
+    def export(self, source):
+        fmt = request.args.get("format", "csv")
+        if self.db.db is None:
+            return Response(json.dumps({"error": "exports read from redis"}), status=404, mimetype="application/json")
+        if source not in exporttools.sources:
+            error = "unknown export source {}, expected one of {}".format(source, list(exporttools.sources))
+            return Response(json.dumps({"error": error}), status=404, mimetype="application/json")
+
+        try:
+            stream = exporttools.export(self.db.db, fmt, source, request.args.get("start"), request.args.get("end"))
+        except ImportError as e:
+            return Response(json.dumps({"error": str(e)}), status=404, mimetype="application/json")
+        except ValueError as e:
+            # a bad format or time range, answered before any of the stream is sent
+            return Response(json.dumps({"error": str(e)}), status=400, mimetype="application/json")
+
+        mimetype, extension = exporttools.formats[fmt]
+        return Response(stream, mimetype=mimetype,
+                        headers={"Content-Disposition": "attachment; filename={}{}".format(source, extension),
+                                 "Access-Control-Allow-Origin": "*"})
+
+    def register(self, server):
+        """
+        adds the api routes to a flask server, e.g. the `server` attribute of a Dash app
+
+        :param server (Flask):
+        :return:
+        """
+        server.add_url_rule(prefix + "/detectors", "api-detectors", self.detectors)
+        server.add_url_rule(prefix + "/latest/<value_type>", "api-latest", self.latest)
+        server.add_url_rule(prefix + "/series/<det_id>/<value_type>", "api-series", self.series)
+        server.add_url_rule(prefix + "/rollup/<value_type>", "api-rollup", self.rollup)
+        server.add_url_rule(prefix + "/lanes/<value_type>", "api-lanes", self.lanes)
+        server.add_url_rule(prefix + "/export/<source>", "api-export", self.export)
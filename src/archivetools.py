@@ -0,0 +1,433 @@
+"""Long Retention Series Utilities
+
+The json series of a detector only hold its last few hours of readings, and weeks of them as json would cost redis
+~35 bytes per reading. Readings are small numbers coming in every 60 s, so the archive keeps them compressed instead,
+in chunks of `chunk` readings per detector and reading type:
+
+- archive:<det_id>:<reading type>, a list of sealed chunks, oldest first, trimmed to the latest `keep` chunks
+- archive:index:<det_id>:<reading type>, a list of the first and last time of each chunk (int32 epoch seconds), so that
+  a range query only reads the chunks it needs
+- archive:head:<det_id>:<reading type>, the readings of the chunk being filled, appended as packed `head_record`s
+  (int32 epoch seconds, float64 reading) until there are `chunk` of them and they're sealed into a chunk
+
+The archive holds one reading per detector and minute. The lanes of a detector are combined like on the minute grid
+(lanetools.MinuteCombiner): the first lane of a minute appends its record, the following ones rewrite that record in
+place with the lanes combined so far, rounded to `max_decimals`. A full head is only sealed when the next minute comes
+in, so the record of the last minute can still be rewritten. A lane reporting a minute after the next minute was
+archived is left out rather than archived as a second reading of its minute.
+
+A chunk is a header packed with `header` followed by varints:
+
+    kind            uint8    0: values are scaled integers, 1: values are raw float64
+    decimals        uint8    values were multiplied by 10**decimals to make them integers
+    count           uint16   readings in the chunk
+    first, last     int32    epoch seconds of the first and last reading
+    runs            uint16   runs of equal time deltas
+    time bytes      uint16   bytes of the time varints
+
+    times           runs pairs of zigzag varints: a delta between two readings, and the number of times it repeats
+    values          count zigzag varints of the deltas of the scaled values, or count float64 for kind 1
+
+Readings 60 s apart have a single run of 60 s deltas, their times cost 3 bytes for the whole chunk, and the deltas of
+integer readings mostly fit in a byte: a reading costs ~1 byte instead of ~35 bytes of json.
+
+Range queries read the indexes and heads of all the detectors asked for in one round trip, then the chunks overlapping
+the range in a second one, and decode all the chunks at once: the varints of every chunk are decoded in a single
+vectorized pass, and the deltas are summed back with segmented cumulative sums.
+
+Sealed chunks never change, so ArchiveDB keeps the ones it decoded in a bounded LRU cache and only fetches and decodes
+the chunks it doesn't hold yet. A repeated query (a dashboard scrubbing through replay, an export going over the same
+days) then costs a single round trip for the indexes and heads. A cold query still reads and decodes every chunk, and
+is about twice as slow as reading the last day of json with a single MGET and json.loads: the archive trades that
+first read for holding weeks of readings in a tenth of the memory of json. The readings of each
+pair come out in time order unless some were archived out of order, so the final sort is skipped when it isn't needed.
+
+"""
+import struct
+import threading
+import collections
+import numpy as np
+import lanetools
+
+chunk_template = "archive:{}:{}"
+head_template = "archive:head:{}:{}"
+index_template = "archive:index:{}:{}"
+index_record = np.dtype([("first", "<i4"), ("last", "<i4")])
+header = struct.Struct("<BBHiiHH")
+# the same header, to read those of many chunks at once
+header_record = np.dtype([("kind", "u1"), ("decimals", "u1"), ("count", "<u2"), ("first", "<i4"), ("last", "<i4"),
+                          ("runs", "<u2"), ("time_bytes", "<u2")])
+head_record = np.dtype([("t", "<i4"), ("v", "<f8")])
+head_packer = struct.Struct("<id")
+max_decimals = 3
+
+
+def _zigzag(values):
+    return (values << 1) ^ (values >> 63)
+
+
+def _varints(values):
+    """
+    :param values (ndarray): uint64
+    :return: bytes of the LEB128 varints of `values`
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        lengths += rest > 0
+        rest >>= np.uint64(7)
+
+    # the 7 bit groups of every value, lowest first, with the continuation bit set on all but the last of each value
+    ends = np.cumsum(lengths)
+    group = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - lengths, lengths)
+    out = ((np.repeat(values, lengths) >> (7 * group).astype(np.uint64)) & np.uint64(0x7f)).astype(np.uint8)
+    out[group < np.repeat(lengths - 1, lengths)] |= 0x80
+    return out.tobytes()
+
+
+def _decode_varints(buf):
+    """
+    :param buf (bytes): concatenated varints
+    :return: int64 array of the zigzag decoded values
+    """
+    b = np.frombuffer(buf, dtype=np.uint8)
+    if len(b) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    ends = np.flatnonzero(b < 0x80)
+    starts = np.r_[0, ends[:-1] + 1]
+    shifts = (np.arange(len(b)) - np.repeat(starts, ends - starts + 1)) * 7
+    # the 7 bit groups of a varint don't overlap, so summing them is the same as or-ing them
+    u = np.add.reduceat((b & 0x7f).astype(np.uint64) << shifts.astype(np.uint64), starts)
+    return (u >> np.uint64(1)).astype(np.int64) ^ -(u & np.uint64(1)).astype(np.int64)
+
+
+def _segmented_cumsum(values, starts):
+    """
+    cumulative sums restarting at each of `starts`, the first index of each segment
+    """
+    total = np.cumsum(values)
+    before = np.r_[0, total[starts[1:] - 1]] if len(starts) else np.zeros(0, dtype=values.dtype)
+    lengths = np.diff(np.r_[starts, len(values)])
+    return total - np.repeat(before, lengths)
+
+
+def _decimals(values):
+    for decimals in range(max_decimals + 1):
+        scaled = values * 10 ** decimals
+        if np.all(np.abs(scaled - np.round(scaled)) < 1e-6) and np.all(np.abs(scaled) < 2 ** 52):
+            return decimals
+    return None
+
+
+def encode_chunk(times, values):
+    """
+    :param times (ndarray): int epoch seconds of the readings
+    :param values (ndarray): float readings
+    :return: bytes of the chunk
+    """
+    times = np.asarray(times, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+
+    deltas = np.diff(times)
+    starts = np.flatnonzero(np.r_[True, deltas[1:] != deltas[:-1]]) if len(deltas) else np.zeros(0, dtype=np.int64)
+    runs = np.diff(np.r_[starts, len(deltas)])
+    pairs = np.column_stack([_zigzag(deltas[starts]), _zigzag(runs)]).ravel()
+    time_bytes = _varints(pairs.astype(np.uint64))
+
+    decimals = _decimals(values)
+    if decimals is None:
+        kind, body = 1, values.tobytes()
+        decimals = 0
+    else:
+        scaled = np.round(values * 10 ** decimals).astype(np.int64)
+        kind, body = 0, _varints(_zigzag(np.diff(scaled, prepend=0)).astype(np.uint64))
+
+    return header.pack(kind, decimals, len(times), times[0], times[-1], len(runs), len(time_bytes)) + time_bytes + body
+
+
+def decode_chunks(chunks):
+    """
+    decodes any number of chunks at once
+
+    :param chunks (list): bytes of chunks
+    :return: (int64 epoch seconds, float64 values) of all their readings, in the order of the chunks
+    """
+    if not chunks:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+    heads = np.frombuffer(b"".join(c[:header.size] for c in chunks), dtype=header_record)
+    counts = heads["count"].astype(np.int64)
+    starts = np.r_[0, np.cumsum(counts)[:-1]]
+    time_ends = (header.size + heads["time_bytes"].astype(np.int64)).tolist()
+    kinds = heads["kind"].tolist()
+
+    # the varints of all chunks, times first, then the values of the chunks of scaled integers
+    buf = b"".join(c[header.size:e] for c, e in zip(chunks, time_ends))
+    buf += b"".join(c[e:] for c, e, k in zip(chunks, time_ends, kinds) if k == 0)
+    decoded = _decode_varints(buf)
+
+    # the runs of deltas of all chunks expanded, with a 0 in front of each chunk, and summed into offsets from its
+    # first time
+    n_times = 2 * int(heads["runs"].sum())
+    pairs = decoded[:n_times].reshape(-1, 2)
+    steps = np.zeros(int(counts.sum()), dtype=np.int64)
+    following = np.ones(len(steps), dtype=bool)
+    following[starts] = False
+    steps[following] = np.repeat(pairs[:, 0], pairs[:, 1])
+    offsets = _segmented_cumsum(steps, starts)
+    times = np.repeat(heads["first"].astype(np.int64), counts) + offsets
+
+    values = np.empty(len(steps), dtype=np.float64)
+    scaled = heads["kind"] == 0
+    if scaled.any():
+        scaled_starts = np.r_[0, np.cumsum(counts[scaled])[:-1]]
+        integers = _segmented_cumsum(decoded[n_times:], scaled_starts)
+        factors = np.repeat(10.0 ** heads["decimals"][scaled].astype(np.float64), counts[scaled])
+        values[np.repeat(scaled, counts)] = integers / factors
+    for i in np.flatnonzero(~scaled):
+        values[starts[i]:starts[i] + counts[i]] = np.frombuffer(chunks[i], dtype=np.float64, offset=time_ends[i])
+    return times, values
+
+
+class ArchiveRecorder:
+    def __init__(self, db, chunk=120, keep=336):
+        """
+        :param db: Redis instance from redis, read once to resume the chunks being filled by a previous run, and when
+        a chunk is sealed
+        :param chunk (int): readings per chunk, 2h of readings at one per minute
+        :param keep (int): chunks kept per detector and reading type, 4 weeks by default
+        """
+        self.db = db
+        self.chunk = chunk
+        self.keep = keep
+        self.combiner = lanetools.MinuteCombiner()
+
+        # minute of the last record of each head, whose record the other lanes of the minute rewrite
+        self.last = {}
+
+        # readings in the head of each detector and reading type
+        self.counts = {}
+        keys = list(db.scan_iter(match=head_template.format("*", "*")))
+        pipe = db.pipeline(transaction=False)
+        for key in keys:
+            pipe.strlen(key)
+        for key, size in zip(keys, pipe.execute()):
+            _, _, det_id, subj = key.decode().split(":")
+            self.counts[(det_id, subj)] = size // head_record.itemsize
+
+    def update(self, pipe, det_id, subj, reading, time):
+        """
+        queues the archiving of a reading on `pipe`, with the write of a sealed chunk every `chunk` minutes
+
+        :param pipe: redis pipeline the reading itself is written with
+        :param det_id (str):
+        :param subj (str): reading type
+        :param reading (float):
+        :param time (str): CreateUtc of the reading
+        :return:
+        """
+        head = head_template.format(det_id, subj)
+        t = lanetools.to_epoch(time)
+        minute = t // 60 * 60
+        value, lanes = self.combiner.update(det_id, subj, reading, minute)
+        packed = head_packer.pack(t, round(value, max_decimals))
+        count = self.counts.get((det_id, subj), 0)
+
+        if lanes > 1:
+            if self.last.get((det_id, subj)) == minute and count:
+                pipe.setrange(head, head_record.itemsize * (count - 1), packed)
+            return
+        self.last[(det_id, subj)] = minute
+
+        if count >= self.chunk:
+            # the chunk is sealed from the head in redis rather than from memory, so that readings this collector
+            # didn't write itself (another collector's, see hatools.py) are sealed once and exactly once
+            raw = self.db.get(head) or b""
+            count = len(raw) // head_record.itemsize
+            if count >= self.chunk:
+                records = np.frombuffer(raw, dtype=head_record)
+                key = chunk_template.format(det_id, subj)
+                index = index_template.format(det_id, subj)
+                pipe.rpush(key, encode_chunk(records["t"], records["v"]))
+                pipe.rpush(index, np.array([(records["t"].min(), records["t"].max())], dtype=index_record).tobytes())
+                pipe.ltrim(key, -self.keep, -1)
+                pipe.ltrim(index, -self.keep, -1)
+                pipe.delete(head)
+                count = 0
+
+        pipe.append(head, packed)
+        self.counts[(det_id, subj)] = count + 1
+
+
+class ArchiveDB:
+    def __init__(self, db, cache_size=16384):
+        """
+        :param db: Redis instance from redis
+        :param cache_size (int): decoded sealed chunks kept in memory, ~1.5 kB each. the default holds a day of
+        ~450 detectors and 3 reading types
+        """
+        self.db = db
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, entries):
+        with self.lock:
+            for key, entry in entries:
+                self.cache[key] = entry
+                self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def read(self, pairs, start=None, end=None):
+        """
+        reads the archived readings of several detectors and reading types in two round trips and one decode, the
+        chunks already decoded by an earlier read are taken from the cache instead, and with all of them cached the
+        second round trip is skipped
+
+        :param pairs (list): (det_id, reading type) tuples
+        :param start (int): first epoch second included, or None from the oldest reading kept
+        :param end (int): first epoch second excluded, or None up to the latest reading
+        :return: (index in `pairs`, int64 epoch seconds, float64 values) of the readings in the range, sorted by pair
+        and time
+        """
+        pipe = self.db.pipeline(transaction=False)
+        for det_id, value_type in pairs:
+            pipe.lrange(index_template.format(det_id, value_type), 0, -1)
+            pipe.get(head_template.format(det_id, value_type))
+        raws = pipe.execute()
+        indexes, heads = raws[0::2], raws[1::2]
+
+        # the chunks overlapping the range of each pair, found for all pairs at once and looked up in the cache by
+        # their pair and bounds
+        lengths = np.array([len(index) for index in indexes], dtype=np.int64)
+        bounds = np.frombuffer(b"".join(b"".join(index) for index in indexes), dtype=index_record)
+        overlap = np.ones(len(bounds), dtype=bool)
+        if start is not None:
+            overlap &= bounds["last"] >= start
+        if end is not None:
+            overlap &= bounds["first"] < end
+        owner = np.repeat(np.arange(len(pairs)), lengths)[overlap]
+        position = (np.arange(len(bounds)) - np.repeat(np.cumsum(lengths) - lengths, lengths))[overlap]
+
+        # (position, key, entry) of the overlapping chunks of each pair, entry None when it has to be fetched
+        wanted = [[] for _ in pairs]
+        with self.lock:
+            for i, p, first, last in zip(owner.tolist(), position.tolist(), bounds["first"][overlap].tolist(),
+                                         bounds["last"][overlap].tolist()):
+                key = (pairs[i][0], pairs[i][1], first, last)
+                entry = self.cache.get(key)
+                if entry is not None:
+                    self.cache.move_to_end(key)
+                wanted[i].append((p, key, entry))
+
+        # the span of the chunks missing from the cache, usually the newest ones or all of them
+        pipe = self.db.pipeline(transaction=False)
+        fetched = []
+        for i, (det_id, value_type) in enumerate(pairs):
+            missing = [p for p, _, entry in wanted[i] if entry is None]
+            if missing:
+                pipe.lrange(chunk_template.format(det_id, value_type), missing[0], missing[-1])
+                fetched.append((i, missing[0]))
+        raws = pipe.execute() if fetched else []
+
+        chunks, slots = [], []
+        for (i, first), raw in zip(fetched, raws):
+            for offset, chunk in enumerate(raw):
+                slots.append((i, first + offset))
+                chunks.append(chunk)
+
+        # each chunk decoded along with its bounds, which must match those of the index it's cached under
+        times, values = decode_chunks(chunks)
+        decoded = {}
+        if chunks:
+            sizes = np.frombuffer(b"".join(c[2:4] for c in chunks), dtype="<u2").astype(np.int64)
+            splits = np.cumsum(sizes)[:-1]
+            firsts = np.minimum.reduceat(times, np.r_[0, splits]).tolist()
+            lasts = np.maximum.reduceat(times, np.r_[0, splits]).tolist()
+            decoded = dict(zip(slots, zip(np.split(times, splits), np.split(values, splits), firsts, lasts)))
+
+        # the readings of each pair in chunk order followed by its head
+        parts_t, parts_v, counts, stored = [], [], [], []
+        for i, head in enumerate(heads):
+            count = 0
+            for p, key, entry in wanted[i]:
+                if entry is None:
+                    entry = decoded.get((i, p))
+                    if entry is None or entry[2:] != key[2:]:
+                        # the list was trimmed between the two round trips and the chunk moved
+                        continue
+                    entry = entry[:2]
+                    stored.append((key, entry))
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                parts_t.append(entry[0])
+                parts_v.append(entry[1])
+                count += len(entry[0])
+            if head:
+                records = np.frombuffer(head, dtype=head_record)
+                parts_t.append(records["t"].astype(np.int64))
+                parts_v.append(records["v"])
+                count += len(records)
+            counts.append(count)
+        self._store(stored)
+
+        if not parts_t:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        owners = np.repeat(np.arange(len(pairs)), counts)
+        times = np.concatenate(parts_t)
+        values = np.concatenate(parts_v)
+
+        mask = np.ones(len(times), dtype=bool)
+        if start is not None:
+            mask &= times >= start
+        if end is not None:
+            mask &= times < end
+        owners, times, values = owners[mask], times[mask], values[mask]
+
+        # readings replayed after an outage (see waltools.py) may have been archived after newer ones
+        if np.any((np.diff(times) < 0) & (np.diff(owners) == 0)):
+            order = np.lexsort((times, owners))
+            owners, times, values = owners[order], times[order], values[order]
+        return owners, times, values
+
+    def series(self, det_id, value_type, start=None, end=None):
+        """
+        :return: (int64 epoch seconds, float64 values) of the archived readings of a detector in a range, see read
+        """
+        _, times, values = self.read([(det_id, value_type)], start, end)
+        return times, values
+
+    def span(self, pairs):
+        """
+        :param pairs (list): (det_id, reading type) tuples
+        :return: (first, last) epoch seconds of the readings archived for any of `pairs`, or None if there are none
+        """
+        pipe = self.db.pipeline(transaction=False)
+        for det_id, value_type in pairs:
+            pipe.lindex(index_template.format(det_id, value_type), 0)
+            pipe.lindex(index_template.format(det_id, value_type), -1)
+            pipe.getrange(head_template.format(det_id, value_type), 0, head_record.itemsize - 1)
+            pipe.getrange(head_template.format(det_id, value_type), -head_record.itemsize, -1)
+        raws = pipe.execute()
+
+        firsts = [np.frombuffer(r, dtype=index_record)["first"][0] for r in raws[0::4] if r]
+        lasts = [np.frombuffer(r, dtype=index_record)["last"][0] for r in raws[1::4] if r]
+        firsts += [np.frombuffer(r, dtype=head_record)["t"][0] for r in raws[2::4] if r]
+        lasts += [np.frombuffer(r, dtype=head_record)["t"][0] for r in raws[3::4] if r]
+        if not firsts:
+            return None
+        return int(min(firsts)), int(max(lasts))
+
+    def size(self, det_id, value_type):
+        """
+        :return: bytes of the sealed chunks, their index and the chunk being filled of a detector's reading type
+        """
+        chunks = self.db.lrange(chunk_template.format(det_id, value_type), 0, -1)
+        return sum(len(c) for c in chunks) + index_record.itemsize * len(chunks) + \
+            (self.db.strlen(head_template.format(det_id, value_type)) or 0)
@@ -3,17 +3,97 @@ this is a collection of utility methods to aid in extracting data from incoming
 locally running redis server. see ../backend/mqtt_collect.py's description for more details on the overall ideas
 involved
 
+it's imported by the collectors and kept free of pandas and the like so that they start fast: the detector datasheets
+are read with sheettools.py and the reading simulators of pub_sim.py are in simtools.py
+
 """
-import pandas as pd
 import random
 from paho.mqtt import client as mqtt_client
-import os
 import json
-import numpy as np
-from scipy.interpolate import interp1d
+import socket
+import profiletools
+import rendertools
+import lanetools
+
+# always-on per-stage timers of the message path in on_message, and the profiler that can be started on demand with
+# a signal or a message on profiletools.control_topic. see profiletools.py
+stages = profiletools.StageTimers()
+profiler = profiletools.OnDemandProfiler()
+
+# ingest accounting of expected/received/duplicate/late readings, enabled by the collectors by assigning an
+# accountingtools.IngestAccounting instance. see accountingtools.py
+accounting = None
+
+# streaming anomaly detection with O(1) updates per reading, enabled by the collectors by assigning an
+# anomalytools.AnomalyDetector instance. see anomalytools.py
+anomaly = None
+
+# incremental travel time along the corridor from the speed readings, enabled by the collectors by assigning a
+# corridortools.CorridorTracker instance. see corridortools.py
+corridor = None
+
+# discovery of detectors seen for the first time, needed when subscribed with detector_wildcard. enabled by the
+# collectors by assigning a registrytools.DetectorRegistry instance. see registrytools.py
+registry = None
+
+# raw reading of every lane, next to the aggregated series. enabled by the collectors by assigning a
+# lanetools.LaneRecorder instance. see lanetools.py
+lanes = None
+
+# every reading in the cell of its minute on a grid shared by all detectors. enabled by the collectors by assigning a
+# gridtools.GridRecorder instance. see gridtools.py
+grid = None
+
+# 5 minute means of every detector over the last 24h. enabled by the collectors by assigning a
+# gridtools.RollupRecorder instance. see gridtools.py
+rollup = None
+
+# weeks of every detector's readings in compressed chunks, for historic queries beyond the json series. enabled by
+# the collectors by assigning an archivetools.ArchiveRecorder instance. see archivetools.py
+archive = None
+
+# idempotent writes of the readings, so that several collectors can consume the same topics as hot standbys of each
+# other. enabled by the collectors by assigning a hatools.IdempotentWriter instance. see hatools.py
+ha = None
+
+# on-disk log every raw message is appended to before anything is written to redis, so that readings received while
+# redis is unavailable can be replayed. enabled by the collectors by assigning a waltools.WriteAheadLog instance. see
+# waltools.py
+wal = None
+
+# the json series hold one reading per detector, reading type and minute, the lanes of a minute combined into it as
+# they arrive (see lanetools.MinuteCombiner), and the minute of the latest entry of each series so that later lanes
+# rewrite it rather than append
+combiner = lanetools.MinuteCombiner()
+series_minutes = {}
+
+# single subscription covering every detector topic, as an alternative to subscribing to each one listed in a datasheet
+detector_wildcard = "worldcongress2017/pilot_resologi/odtf1/ca/qc/mtl/mobil/traf/detector/#"
+reading_types = ("vehicle-gap-time", "vehicle-count", "vehicle-speed")
+
+
+def stable_client_id(role="collector"):
+    """
+    client id that stays the same across restarts of a process on the same host, so that a persistent session
+    (clean_session=False) is resumed by the broker instead of having QoS 1 messages queued for a client that never
+    comes back. the random ids of the original implementation could also collide between processes
+
+    :param role (str): distinguishes several processes on the same host, e.g. collector-a and collector-b
+    :return:
+    """
+    return "mtl-traffic-{}-{}".format(role, socket.gethostname())
 
 
-def connect_mqtt(broker, port) -> mqtt_client:
+def connect_mqtt(broker, port, client_id=None, clean_session=True) -> mqtt_client:
+    """
+    :param broker (str):
+    :param port (int):
+    :param client_id (str): defaults to a random id, use stable_client_id() together with clean_session=False for
+    a persistent session
+    :param clean_session (bool): False to have the broker keep the subscriptions and queue QoS 1 messages while the
+    client is disconnected
+    :return:
+    """
     def on_connect(client, userdata, flags, rc):
         if rc == 0:
             print("Connected to Broker")
@@ -21,8 +101,9 @@ def connect_mqtt(broker, port) -> mqtt_client:
         else:
             print("Failed to Connect, error code {}".format(rc))
 
-    client_id = "id-{}".format(random.randint(0, 1000))
-    client = mqtt_client.Client(client_id)
+    if client_id is None:
+        client_id = "id-{}".format(random.randint(0, 1000))
+    client = mqtt_client.Client(client_id, clean_session=clean_session)
     client.on_connect = on_connect
     client.connect(broker, port)
     return client
@@ -30,39 +111,147 @@ def connect_mqtt(broker, port) -> mqtt_client:
 
 def on_message(client, userdata, msg):
     """
-    the callback function that's triggered everytime the client receivees a new mqtt message. see the desc in
-    mqtt_collect.py for the main idea behind aggregating multiple readings of the same time for a given detector.
+    the callback function that's triggered everytime the client receivees a new mqtt message, from the simulated
+    detectors (collect_sim.py) or the lanes of the real ones (mqtt_collect.py)
 
     :param client:
-    :param userdata (list): custom data passed by user for performing necessary tasks. In this case, userdata is
-    [dict, Redis] where the dict is of the form {det_id1:{reading_type1:[],reading_type2:[]...},det_id2:{}...} and
-    Redis is a Redis instance from redis tha's connected to a server on the local machine
+    :param userdata: Redis instance from redis tha's connected to a server on the local machine, set by the collector
+    with client.user_data_set
     :param msg:
     :return:
+
+    with a write-ahead log, the raw message of a detector topic is appended to it first, see waltools.py
+
+    each stage of the message path is timed by the module level `stages`, whose summary of the last minute is
+    printed and written to the collector:stages key every minute. messages on profiletools.control_topic start the
+    on-demand profiler instead
     """
-    det_id = extract_detector_id(msg.topic)
+    if msg.topic == profiletools.control_topic:
+        profiler.handle_control(msg.payload)
+        return
+
+    parsed = parse_topic(msg.topic)
+    if parsed is None:
+        # e.g. a topic of some other kind of device caught by the wildcard subscription
+        return
+    det_id, lane, subj = parsed
+
+    stages.start()
+    if wal is not None:
+        wal.append(msg.topic, msg.payload)
+        stages.lap("wal")
 
     value_dict = json.loads(msg.payload.decode())
     reading = value_dict["Value"]
     time = value_dict['CreateUtc']
-    subj = extractor_detection_type(msg.topic)
+    stages.lap("decode")
+
+    if registry is not None:
+        registry.ensure(det_id)
+        stages.lap("registry")
+
+    if accounting is not None:
+        status = accounting.record(det_id, lane, subj, time)
+        if accounting.due():
+            # with standbys, every collector counts the same stream and only the holder of the lease reports it
+            if ha is None or ha.lead():
+                accounting.flush(userdata)
+            else:
+                accounting.discard()
+        stages.lap("accounting")
+
+        # a redelivered reading (QoS 1) or one sent twice by the detector was already written
+        if status == "duplicate":
+            stages.stop()
+            return
+
+    # the reading of the detector for the minute, from its lanes so far
+    minute = lanetools.to_epoch(time) // 60 * 60
+    value, _ = combiner.update(det_id, subj, reading, minute)
+    if isinstance(reading, int) and value == int(value):
+        value = int(value)
+    stages.lap("combine")
+
+    if ha is not None:
+        # the reading is appended by a script that redis runs atomically, and only if no other collector did. the
+        # writes of the derived state are dropped as well when it did, the in-memory state is still updated
+        written = ha.append(det_id, lane, subj, reading, time)
+        stages.lap("ha-append")
 
-    maxsize = 300
-    minsize = 240
+        print("{:<6}  {:<4}  {:<20}  {:<16}".format(det_id, reading, time, subj))
+        stages.lap("log")
 
-    existing_data = json.loads(userdata.get(det_id))
-    existing_sizes = [len(existing_data[k]) for k in existing_data]
-    if min(existing_sizes) == maxsize:
-        for k in existing_data:
-            existing_data[k] = existing_data[k][(len(existing_data[k]) - minsize + 1):]
+        pipe = userdata.pipeline(transaction=False) if written else ha.discard
+    else:
+        maxsize = 300
+        minsize = 240
 
-    existing_data[subj].append(reading)
-    if time not in existing_data['time']:
-        existing_data['time'].append(time)
+        raw_data = userdata.get(det_id)
+        stages.lap("redis-get")
 
-    print("{:<6}  {:<4}  {:<20}  {:<16}".format(det_id, reading, time, subj))
+        existing_data = json.loads(raw_data)
+        stages.lap("json-load")
 
-    userdata.set(det_id, json.dumps(existing_data))
+        existing_sizes = [len(existing_data[k]) for k in existing_data]
+        if min(existing_sizes) == maxsize:
+            for k in existing_data:
+                existing_data[k] = existing_data[k][(len(existing_data[k]) - minsize + 1):]
+
+        last = series_minutes.get((det_id, subj))
+        if last == minute and existing_data[subj]:
+            existing_data[subj][-1] = value
+        elif last is None or minute > last:
+            series_minutes[(det_id, subj)] = minute
+            existing_data[subj].append(value)
+            if time not in existing_data['time']:
+                existing_data['time'].append(time)
+        # otherwise a lane of a minute older than the latest entry, which only the grid, rollups and archive take in
+        stages.lap("update")
+
+        print("{:<6}  {:<4}  {:<20}  {:<16}".format(det_id, reading, time, subj))
+        stages.lap("log")
+
+        serialized = json.dumps(existing_data)
+        stages.lap("json-dump")
+
+        # everything derived from the reading goes out in the same round trip as the reading itself
+        pipe = userdata.pipeline(transaction=False)
+        pipe.set(det_id, serialized)
+
+    if anomaly is not None:
+        anomaly.update(pipe, det_id, subj, reading, time)
+        stages.lap("anomaly")
+
+    if corridor is not None and subj == "vehicle-speed":
+        corridor.update(pipe, det_id, value, time)
+        stages.lap("corridor")
+
+    if lanes is not None:
+        lanes.update(pipe, det_id, lane, subj, reading, time)
+        stages.lap("lanes")
+
+    if grid is not None:
+        grid.update(pipe, det_id, subj, reading, time)
+        stages.lap("grid")
+
+    if rollup is not None:
+        rollup.update(pipe, det_id, subj, reading, time)
+        stages.lap("rollup")
+
+    if archive is not None:
+        archive.update(pipe, det_id, subj, reading, time)
+        stages.lap("archive")
+
+    # tells the dashboard's render cache that renders made before this reading are stale
+    pipe.incr(rendertools.version_key)
+    pipe.execute()
+    stages.lap("redis-set")
+    stages.stop()
+
+    if stages.due():
+        stages.report(userdata)
+        stages.reset()
+    profiler.tick()
 
 
 def initialize_db(db, active_ids, data_template):
@@ -81,51 +270,41 @@ def initialize_db(db, active_ids, data_template):
             db.set(each_id, json.dumps(data_template))
 
 
+def parse_topic(topic):
+    """
+    splits a detector topic such as .../traf/detector/det1/det-00773-02/vehicle-speed into its parts
+
+    :param topic (str):
+    :return: (det_id, lane, reading type), or None if the topic isn't a reading of a detector
+    """
+    levels = topic.split("/")
+    if len(levels) != 12 or not levels[10].startswith("det-") or levels[11] not in reading_types:
+        return None
+
+    parts = levels[10].split("-")
+    if len(parts) > 2:
+        return parts[1], parts[2], levels[11]
+    return parts[1], "01", levels[11]
+
+
 def extract_detector_id(topic):
     raw_id = topic.split("/")[10]
     det_id = raw_id.split("-")[1]
     return det_id
 
 
+def extract_lane(topic):
+    """
+    lane of the detector a topic is for, e.g. 02 for .../det-00773-02/vehicle-speed. topics of the simulated detectors
+    have no lane and are reported as lane 01
+    """
+    raw_id = topic.split("/")[10]
+    parts = raw_id.split("-")
+    if len(parts) > 2:
+        return parts[2]
+    return "01"
+
+
 def extractor_detection_type(topic):
     t = topic.split("/")[-1]
     return t
-
-
-def read_csv(fname):
-    curdir = os.path.dirname(__file__)
-    basedir = os.path.abspath(os.path.join(curdir, os.pardir))
-    datadir = os.path.join(basedir, "data")
-    df = pd.read_csv(datadir + "/{}".format(fname), dtype={'id': str})
-    return df
-
-
-class TwoPeaks:
-    def __init__(self):
-        self.minval = None
-        self.maxval = None
-        self.wl = np.pi / 15
-        self.noise = None
-        self.amplitude=None
-
-    def set_params(self, minval, maxval):
-        self.minval = minval
-        self.maxval = maxval
-        self.amplitude = (self.maxval - self.minval) / 2
-
-    def generate(self, x):
-        self.noise = np.random.randint(0, 0.25 * self.maxval, dtype=np.int16)
-        val = self.amplitude * np.sin(self.wl * (x - self.minval)) + self.amplitude + self.minval
-        val += self.noise
-        return int(val)
-
-
-class OneTrough (TwoPeaks):
-    def __init__(self):
-        super().__init__()
-
-    def generate(self, x):
-        self.noise = np.random.randint(0, 0.25 * self.maxval, dtype=np.int16)
-        val = self.amplitude * np.sin(0.5 * self.wl * (x + 2 * self.minval)) + self.amplitude + self.minval
-        val += self.noise
-        return int(val)
@@ -3,9 +3,15 @@
 Callbacks that are triggered at 60 second (with the exception of the 1s for the countdown) for refreshing the
 plots of the dashboard with newly written data from the Redis database
 
+While a replay is on (see replaytools.py), the bars, table, timestamp and map show the frame at the replay's playhead
+instead, which the replay-interval advances every half second while playing
+
 """
 import dash
+import threading
 import frontendtools
+import rendertools
+import gridtools
 import dash_html_components as html
 from dash.dependencies import Input, Output, State
 
@@ -34,6 +40,31 @@ def init_callbacks(app, elements):
     cam_ids = elements['cam-ids']
     cam_link = elements['cam-link']
     streets = elements['streets']
+    live_map = elements['map']
+    heatmap = elements['heatmap']
+    replay = elements['replay']
+    lag_chart = elements['lag']
+
+    # renders are shared between the dashboard's processes through redis, see rendertools.py
+    cache = rendertools.RenderCache(db.db)
+
+    # the camera carousel goes around the stations of the modal's dropdown, the ones the dashboard started with
+    n_cameras = len(stations)
+    stations_lock = threading.Lock()
+
+    def sync_stations():
+        """
+        adds the detectors registered since the dashboard started (see RedisDB.refresh_keys) to the stations and the
+        table, after the existing ones. the map and the dropdowns keep the stations the dashboard started with
+        """
+        with stations_lock:
+            added = db.refresh_keys()
+            if not added:
+                return
+            sheet = db.detector_sheet(live_map.df.iloc[:0], added)
+            table.df = frontendtools.extend_table_data(table.df, sheet)
+            stations.extend("station {}".format(len(stations) + i + 1) for i in range(len(added)))
+            print("added {} stations to the dashboard".format(len(added)))
 
     @app.callback(Output("pie-graph", "figure"),
                   Input("second-interval", "n_intervals"))
@@ -49,91 +80,331 @@ def init_callbacks(app, elements):
         return spinner.fig
 
 
+    @app.callback(
+        [Output("replay-state", "data"),
+         Output("replay-interval", "disabled"),
+         Output("replay-play", "children")],
+        [Input("replay-play", "n_clicks"),
+         Input("replay-live", "n_clicks"),
+         Input("replay-slider", "value"),
+         Input("replay-speed", "value"),
+         Input("replay-interval", "n_intervals")],
+        [State("replay-state", "data"),
+         State("replay-slider", "max")]
+    )
+    def update_replay(_play, _live, scrubbed, speed, _tick, state, latest):
+        """
+        moves the replay's playhead: scrubbing with the slider, play/pause, back to live, and the ticks of the
+        replay-interval, which advance it by `speed` seconds per second while playing. Playback reaching the latest
+        archived minute goes back to live
+        :param scrubbed (int): epoch minute of the slider
+        :param speed (int): playback speed
+        :param state (dict): {"time": epoch seconds of the playhead or None when live, "playing": bool, "speed": int}
+        :param latest (int): epoch minute of the latest archived readings
+        :return:
+        """
+        ctx = dash.callback_context
+        trigger = ctx.triggered[0]["prop_id"]
+
+        state = dict(state or {"time": None, "playing": False}, speed=speed)
+
+        if "replay-live" in trigger:
+            state.update(time=None, playing=False)
+        elif "replay-slider" in trigger:
+            state["time"] = scrubbed * 60
+        elif "replay-play" in trigger:
+            if state["time"] is None:
+                state["time"] = scrubbed * 60
+            state["playing"] = not state["playing"]
+        elif "replay-interval" in trigger and state["playing"]:
+            state["time"] += speed * replay.interval / 1000
+            if state["time"] >= (latest + 1) * 60:
+                state.update(time=None, playing=False)
+
+        return state, not state["playing"], "pause" if state["playing"] else "play"
+
+    @app.callback(
+        [Output("replay-slider", "min"),
+         Output("replay-slider", "max"),
+         Output("replay-slider", "marks")],
+        Input("minute-interval", "n_intervals")
+    )
+    def update_replay_bounds(_):
+        """
+        stretches the replay slider over the minutes the archive holds, which keep growing while the page is open
+        :param _:
+        :return:
+        """
+        return replay.set_bounds(db.replay_bounds())
+
+    def replay_frame(state):
+        """
+        :param state (dict): data of the replay-state Store
+        :return: frame at the playhead, see replaytools.py, or None when live
+        """
+        if state is None or state["time"] is None:
+            return None
+        return db.replay_frame(state["time"])
+
+    def shown(values):
+        # minutes a detector has no reading for are drawn as 0
+        return [0 if v is None else v for v in values]
+
+    def fitted(values):
+        # readings of detectors added after the stations were last synced are left out until the next sync
+        values = list(values)[:len(stations)]
+        return values + [None] * (len(stations) - len(values))
+
+    @app.callback(
+        Output("replay-position", "children"),
+        Input("replay-state", "data")
+    )
+    def update_replay_position(state):
+        frame = replay_frame(state)
+        return replay.describe(state, None if frame is None else frame["utc"])
+
     @app.callback(
         [Output('speed-live-graph', "figure"),
          Output('count-live-graph', "figure"),
          Output("gap-live-graph", "figure"),
          Output("table-div", "children")
          ],
-        Input("minute-interval", "n_intervals")
+        [Input("minute-interval", "n_intervals"),
+         Input("replay-state", "data")]
     )
-    def update_barplots_and_table(_):
-        new_speed_values = db.latest_readings("vehicle-speed")
-        new_count_values = db.latest_readings("vehicle-count")
-        new_gap_values = db.latest_readings("vehicle-gap-time")
-
-        speedbar.set_data(new_speed_values, stations, "kmh")
-        countbar.set_data(new_count_values, stations, "cars")
-        gapbar.set_data(new_gap_values, stations, "s")
+    def update_barplots_and_table(_, state):
+        sync_stations()
+        frame = replay_frame(state)
+        if frame is not None:
+            # no anomaly flags are kept for past readings
+            return cache.get("bars-replay", frame["time"],
+                             lambda: render_barplots_and_table(frame["vehicle-speed"], frame["vehicle-count"],
+                                                               frame["vehicle-gap-time"], None, None, None))
+
+        def render():
+            # anomaly flags are computed by the collector as readings arrive, here they are only read back
+            return render_barplots_and_table(db.latest_readings("vehicle-speed"), db.latest_readings("vehicle-count"),
+                                             db.latest_readings("vehicle-gap-time"), db.latest_flags("vehicle-speed"),
+                                             db.latest_flags("vehicle-count"), db.latest_flags("vehicle-gap-time"))
+
+        return cache.get("bars", None, render)
+
+    def render_barplots_and_table(new_speed_values, new_count_values, new_gap_values, speed_flags, count_flags,
+                                  gap_flags):
+        new_speed_values, new_count_values, new_gap_values = map(fitted, [new_speed_values, new_count_values,
+                                                                          new_gap_values])
+        speedbar.set_data(shown(new_speed_values), stations, "kmh", speed_flags)
+        countbar.set_data(shown(new_count_values), stations, "cars", count_flags)
+        gapbar.set_data(shown(new_gap_values), stations, "s", gap_flags)
 
         table.df["speed (kmh)"] = new_speed_values
         table.df["count (cars)"] = new_count_values
         table.df["gap time (s)"] = new_gap_values
+        table.set_flags({"speed (kmh)": speed_flags or [], "count (cars)": count_flags or [],
+                         "gap time (s)": gap_flags or []})
 
         table.refresh()
 
         return speedbar.fig, countbar.fig, gapbar.fig, table.table
 
     @app.callback(
-        Output("timestamp-text", "children"),
-        Input("minute-interval", "n_intervals")
+        [Output("timestamp-text", "children"),
+         Output("corridor-text", "children")],
+        [Input("minute-interval", "n_intervals"),
+         Input("replay-state", "data")]
     )
-    def update_timestamp(_):
-        new_timestamp = db.latest_readings("time")[0]
-        ts.update_time(new_timestamp)
-        return ts.stamp
+    def update_timestamp(_, state):
+        frame = replay_frame(state)
+        if frame is not None:
+            return cache.get("timestamp-replay", frame["time"], lambda: render_replay_timestamp(frame))
+        return cache.get("timestamp", None, render_timestamp)
+
+    def render_replay_timestamp(frame):
+        ts.update_time(frame["utc"])
+        return ts.stamp, "replay, not live"
+
+    def render_timestamp():
+        new_timestamp = next((t for t in db.latest_readings("time") if t is not None), None)
+        if new_timestamp is not None:
+            ts.update_time(new_timestamp)
+        ts.update_corridor(db.corridor()["total"])
+        return ts.stamp, ts.corridor_stamp
 
     @app.callback(
-        Output("hist-plot", "figure"),
+        [Output("hist-plot", "figure"),
+         Output("hist-plot", "extendData"),
+         Output("scatter-sent", "data")],
         [Input("minute-interval", "n_intervals"),
          Input("drop-0","value"),
          Input("drop-1","value"),
          Input("drop-2","value"),
          Input("cust-slider","value")
-         ]
+         ],
+        State("scatter-sent", "data")
     )
-    def update_scatter(n_intervals,datatype_selection, station_a, station_b,slider_values):
+    def update_scatter(n_intervals,datatype_selection, station_a, station_b,slider_values, sent):
         """
         main update logic for all the plots. Triggered either by the 60second interval, or a selection of different
-        detectors and/or reading_type in the historic scatter plot
+        detectors and/or reading_type in the historic scatter plot. The 60 second ticks only send the readings that
+        arrived since the figure was drawn, through extendData, the figure is redrawn in full when the selection changes
         :param slider_values:
         :param _:
         :param selection_1:
         :param selection_2:
         :param selection_0:
+        :param sent (dict): selection and CustomScatter.sent of the figure in the browser
         :return:
         """
         ctx = dash.callback_context
         trigger = ctx.triggered[0]["prop_id"]
 
-        [idx_left, idx_right] = slider_values
+        params = [datatype_selection, station_a, station_b, slider_values]
 
+        if "minute-interval" in trigger and sent is not None and sent["params"] == params:
+            update = cache.get("scatter-extend", [params, sent["scatter"]],
+                               lambda: render_scatter_extension(params, sent["scatter"]))
+            if update is not None:
+                extend_data, scatter_sent = update
+                if not extend_data[1]:
+                    return dash.no_update, dash.no_update, dash.no_update
+                return dash.no_update, extend_data, {"params": params, "scatter": scatter_sent}
+
+        figure, scatter_sent = cache.get("scatter", params, lambda: render_scatter(params))
+        return figure, dash.no_update, {"params": params, "scatter": scatter_sent}
+
+    def selected_type(datatype_selection):
         if datatype_selection == "speed":
-            datatype = "vehicle-speed"
-            unit = "kmh"
+            return "vehicle-speed", "kmh"
         elif datatype_selection == "count":
-            datatype = "vehicle-count"
-            unit = "cars"
+            return "vehicle-count", "cars"
         else:
-            datatype = "vehicle-gap-time"
-            unit = "seconds"
+            return "vehicle-gap-time", "seconds"
+
+    def load_scatter(datatype_selection, station_a, station_b):
+        datatype, unit = selected_type(datatype_selection)
 
-        new_times_utc = db.n_latest_readings("time", n)[0]
-        new_data = db.n_latest_readings(datatype, n)
+        # every station on the same minutes, with gaps where a detector missed one
+        grid = db.grid(datatype, n)
+        new_times_utc = grid["time"]
+        new_data = gridtools.as_lists(grid["values"], grid["mask"])
         new_hist_dict = {s: l for s, l in zip(stations, new_data)}
 
         new_primary_values = new_hist_dict[station_a]
         new_secondary_values = new_hist_dict[station_b]
 
+        new_forecasts = {s: f for s, f in zip(stations, db.latest_forecasts(datatype))}
+
         scatter.set_unit(unit)
         scatter.set_labels(new_times_utc)
+        scatter.set_forecasts(new_forecasts[station_a], new_forecasts[station_b])
 
         scatter.update_primary_fig(new_primary_values)
         scatter.update_secondary_fig(new_secondary_values)
 
+    def render_scatter(params):
+        [datatype_selection, station_a, station_b, [idx_left, idx_right]] = params
+        load_scatter(datatype_selection, station_a, station_b)
         scatter.zoom_in(idx_left,idx_right)
+        return scatter.base_fig, scatter.sent
+
+    def render_scatter_extension(params, sent):
+        [datatype_selection, station_a, station_b, [idx_left, idx_right]] = params
+        load_scatter(datatype_selection, station_a, station_b)
+        return scatter.extension(idx_left, idx_right, sent)
+
+    @app.callback(
+        Output("heatmap-graph", "figure"),
+        [Input("minute-interval", "n_intervals"),
+         Input("drop-heat", "value")]
+    )
+    def update_heatmap(_, datatype_selection):
+        """
+        redraws the heatmap of every station over the last 24h. The matrix behind it is only shifted by the newest
+        5 minute column on a minute tick, see gridtools.ShiftingMatrix
+        :param _:
+        :param datatype_selection:
+        :return:
+        """
+        return cache.get("heatmap", datatype_selection, lambda: render_heatmap(datatype_selection))
+
+    def render_heatmap(datatype_selection):
+        datatype, unit = selected_type(datatype_selection)
+        matrix = db.heatmap(datatype)
+        heatmap.set_data(matrix["values"], matrix["time"], stations, unit)
+        return heatmap.fig
+
+    @app.callback(
+        Output("lag-graph", "figure"),
+        Input("minute-interval", "n_intervals")
+    )
+    def update_lags(_):
+        """
+        redraws the lags between adjacent stations over the last rounds of ../backend/workers/lag_worker.py
+        :param _:
+        :return:
+        """
+        return cache.get("lags", None, render_lags)
+
+    def render_lags():
+        lags = db.lags()
+        names = dict(zip(db.keys, stations))
+        segments = ["{} > {}".format(*[names.get(d, "detector {}".format(d)) for d in s]) for s in lags["segments"]]
+        lag_chart.set_data(lags["lag"], lags["correlation"], lags["time"], segments)
+        return lag_chart.fig
+
+    @app.callback(
+        Output("map-markers", "data"),
+        [Input("minute-interval", "n_intervals"),
+         Input("scatter_map", "relayoutData"),
+         Input("replay-state", "data")]
+    )
+    def update_map_markers(_, relayout_data, state):
+        """
+        computes the colors and sizes of the markers inside the map's viewport. Coordinates are only sent again when
+        the viewport changed, a minute refresh only sends the new colors and sizes
+        :param _:
+        :param relayout_data:
+        :return:
+        """
+        ctx = dash.callback_context
+        trigger = ctx.triggered[0]["prop_id"]
+
+        visible = live_map.visible(relayout_data)
+        with_positions = "minute-interval" not in trigger and "replay-state" not in trigger
+
+        frame = replay_frame(state)
+        if frame is not None:
+            return live_map.markers(visible, shown(frame["vehicle-speed"]), shown(frame["vehicle-count"]),
+                                    with_positions)
 
-        return scatter.base_fig
+        def render():
+            new_speed_values = db.latest_readings("vehicle-speed")
+            new_count_values = db.latest_readings("vehicle-count")
+            return live_map.markers(visible, new_speed_values, new_count_values, with_positions)
+
+        return cache.get("map", [visible, with_positions], render)
+
+    # patches the marker props of the map figure in the browser, so the figure itself never goes over the wire
+    app.clientside_callback(
+        """
+        function(markers, figure) {
+            if (!markers || !figure) {
+                return window.dash_clientside.no_update;
+            }
+            var trace = Object.assign({}, figure.data[0]);
+            ["lat", "lon", "text", "hovertext"].forEach(function(k) {
+                if (markers[k] !== undefined) {
+                    trace[k] = markers[k];
+                }
+            });
+            trace.marker = Object.assign({}, trace.marker, {color: markers.color, size: markers.size});
+            return Object.assign({}, figure, {data: [trace].concat(figure.data.slice(1))});
+        }
+        """,
+        Output("scatter_map", "figure"),
+        Input("map-markers", "data"),
+        State("scatter_map", "figure")
+    )
 
     @app.callback(
         [Output("left-marker", "style"),
@@ -151,7 +422,10 @@ def init_callbacks(app, elements):
         :param n_intervals:
         :return:
         """
-        new_times_utc = db.n_latest_readings("time", n)[0]
+        return cache.get("slider", slider_values, lambda: render_slider(slider_values))
+
+    def render_slider(slider_values):
+        new_times_utc = db.grid("vehicle-speed", n)["time"]
         slider.set_labels(new_times_utc)
 
         [idx_left, idx_right] = slider_values
@@ -218,7 +492,7 @@ def init_callbacks(app, elements):
 
         if "next" in trigger:
             new_selection_num = int(selection.split(" ")[-1]) + 1
-            if new_selection_num > 9:
+            if new_selection_num > n_cameras:
                 new_selection_num = 1
 
             new_selection = "station " + str(new_selection_num)
@@ -233,7 +507,7 @@ def init_callbacks(app, elements):
 
             new_selection_num = int(selection.split(" ")[-1]) - 1
             if new_selection_num < 1:
-                new_selection_num = 9
+                new_selection_num = n_cameras
 
             new_selection = "station " + str(new_selection_num)
             camera_id = cam_ids[new_selection]
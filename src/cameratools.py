@@ -0,0 +1,237 @@
+"""Traffic Camera Proxy Utilities
+
+Serves the city's traffic camera images from the dashboard's own server instead of having every viewer's browser fetch
+them from www1.ville.montreal.qc.ca:
+
+- a background thread refreshes the images of every camera of the detector datasheet on the cameras' ~5 minute
+  cadence, fetching them in parallel on a small thread pool
+- refreshes are conditional GETs (If-None-Match / If-Modified-Since), an unchanged image costs a 304 and no download
+- images are shrunk once to thumbnails the size the modal shows them at, and kept for `ttl` seconds, so a camera that
+  stops answering disappears instead of showing a stale image forever
+- the route /camera/<id>.jpeg serves the thumbnails with ETag and Cache-Control headers, browsers revalidate with the
+  proxy until the next refresh is due
+
+The dashboard runs in several gunicorn workers, each with its own proxy, but the city's server is only polled by one of
+them. The thumbnails are shared through redis:
+
+- camera:<id>, a hash with the thumbnail, its digest, the city server's validators and the last time the camera
+  answered, expiring `ttl` seconds after that
+- camera:leader, a short lease (see hatools.py) held by the worker that refreshes the cameras. the other workers try to
+  take it every few seconds, so one of them takes over within `lease_ttl` seconds when the leader's process goes away
+
+Every worker serves the thumbnails from redis, keeping the last one it read of each camera in memory so that only its
+digest is read again when it didn't change.
+
+With the cache warm, the previous/next carousel of the camera modal never waits on the city's server.
+
+"""
+import io
+import os
+import time
+import socket
+import hashlib
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from flask import Response, request
+import hatools
+
+camera_link = "http://www1.ville.montreal.qc.ca/Circulation-Cameras/GEN{}.jpeg"
+route = "/camera/<cam_id>.jpeg"
+proxy_link = "/camera/{}.jpeg"
+key_template = "camera:{}"
+lease_key = "camera:leader"
+
+
+def make_thumbnail(raw, size):
+    """
+    :param raw (bytes): jpeg image
+    :param size (tuple): (width, height) the image is shrunk to fit in, keeping its aspect ratio
+    :return: bytes of the resized jpeg
+    """
+    img = Image.open(io.BytesIO(raw))
+    img.thumbnail(size)
+    out = io.BytesIO()
+    img.convert("RGB").save(out, format="JPEG", quality=80, optimize=True)
+    return out.getvalue()
+
+
+class CameraProxy:
+    def __init__(self, camera_ids, db, link=camera_link, refresh=300, ttl=900, size=(300, 300), workers=4, timeout=10,
+                 lease_ttl=30, name=None):
+        """
+        :param camera_ids (list): ids of the cameras to keep, e.g. the id_camera column of the detector datasheet
+        :param db: Redis instance from redis the thumbnails are shared through
+        :param link (str): url template of the camera images
+        :param refresh (float): seconds between refreshes of all cameras
+        :param ttl (float): seconds an image is served after the last time the camera answered
+        :param size (tuple): (width, height) of the thumbnails
+        :param workers (int): number of cameras fetched at once
+        :param timeout (float): seconds before a fetch is given up
+        :param lease_ttl (int): seconds the refreshing lease outlives the worker holding it
+        :param name (str): name the lease is held under, defaults to <host>-<pid>
+        """
+        self.camera_ids = list(dict.fromkeys(str(i) for i in camera_ids if i is not None))
+        self.db = db
+        self.link = link
+        self.refresh = refresh
+        self.ttl = ttl
+        self.size = size
+        self.timeout = timeout
+        self.lease_ttl = lease_ttl
+        self.name = name or "{}-{}".format(socket.gethostname(), os.getpid())
+        self.lease_script = db.register_script(hatools.lease_script)
+
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=workers))
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=workers))
+
+        # cam_id -> {"image", "digest"}, the thumbnail last read from redis, read again when its digest changes
+        self.local = {}
+        self.lock = threading.Lock()
+        self.next_refresh = time.time()
+        self.stats = {"fetched": 0, "not-modified": 0, "failed": 0}
+        self.thread = None
+
+    def fetch(self, cam_id):
+        """
+        refreshes the thumbnail of one camera in redis, with a conditional GET when an image is already there
+
+        :param cam_id (str):
+        :return: True if the camera answered
+        """
+        key = key_template.format(cam_id)
+        etag, last_modified = self.db.hmget(key, "etag", "last-modified")
+
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag.decode()
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified.decode()
+
+        try:
+            r = self.session.get(self.link.format(cam_id), headers=headers, timeout=self.timeout)
+            if r.status_code == 304 and headers:
+                pipe = self.db.pipeline(transaction=False)
+                pipe.hset(key, "checked", time.time())
+                pipe.expire(key, int(self.ttl))
+                pipe.execute()
+                self.stats["not-modified"] += 1
+                return True
+
+            r.raise_for_status()
+            image = make_thumbnail(r.content, self.size)
+        except (requests.RequestException, OSError) as e:
+            print("camera {} could not be refreshed: {}".format(cam_id, e))
+            self.stats["failed"] += 1
+            return False
+
+        pipe = self.db.pipeline(transaction=False)
+        pipe.hset(key, mapping={"image": image,
+                                "digest": hashlib.md5(image).hexdigest()[:16],
+                                "etag": r.headers.get("ETag", ""),
+                                "last-modified": r.headers.get("Last-Modified", ""),
+                                "checked": time.time()})
+        pipe.expire(key, int(self.ttl))
+        pipe.execute()
+        self.stats["fetched"] += 1
+        return True
+
+    def refresh_all(self):
+        """
+        refreshes every camera on the thread pool
+
+        :return: number of cameras that answered
+        """
+        self.next_refresh = time.time() + self.refresh
+        return sum(self.pool.map(self.fetch, self.camera_ids))
+
+    def lead(self):
+        """
+        takes or renews the lease of the worker that refreshes the cameras
+
+        :return: True if this worker holds it
+        """
+        return self.lease_script(keys=[lease_key], args=[self.name, self.lease_ttl]) == 1
+
+    def _run(self):
+        while True:
+            try:
+                if self.lead() and time.time() >= self.next_refresh:
+                    start = time.time()
+                    answered = self.refresh_all()
+                    print("refreshed {}/{} cameras in {:.1f} s".format(answered, len(self.camera_ids),
+                                                                       time.time() - start))
+            except Exception as e:
+                # e.g. redis restarting, the lease is tried again on the next round
+                print("camera refresh failed: {}".format(e))
+            time.sleep(self.lease_ttl / 3)
+
+    def start(self):
+        """
+        starts the background thread that refreshes the cameras while this worker holds the lease
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def get(self, cam_id):
+        """
+        :param cam_id (str):
+        :return: {"image", "digest", "checked"} of the camera, or None if it's unknown or hasn't answered within the
+        ttl
+        """
+        key = key_template.format(cam_id)
+        digest, checked = self.db.hmget(key, "digest", "checked")
+
+        # a camera requested before the leader got to it is fetched right away
+        if digest is None and cam_id in self.camera_ids:
+            self.fetch(cam_id)
+            digest, checked = self.db.hmget(key, "digest", "checked")
+
+        if digest is None or time.time() - float(checked) > self.ttl:
+            return None
+
+        digest = digest.decode()
+        with self.lock:
+            entry = self.local.get(cam_id)
+        if entry is None or entry["digest"] != digest:
+            image, digest = self.db.hmget(key, "image", "digest")
+            if image is None:
+                return None
+            entry = {"image": image, "digest": digest.decode()}
+            with self.lock:
+                self.local[cam_id] = entry
+        return dict(entry, checked=float(checked))
+
+    def serve(self, cam_id):
+        """
+        flask view of the /camera/<cam_id>.jpeg route
+        """
+        if cam_id not in self.camera_ids:
+            return Response("unknown camera", status=404)
+
+        entry = self.get(cam_id)
+        if entry is None:
+            return Response("camera unavailable", status=503, headers={"Retry-After": "60"})
+
+        # browsers may reuse the image until the next refresh, then revalidate it against the etag
+        max_age = max(int(entry["checked"] + self.refresh - time.time()), 0)
+        etag = '"{}-{}"'.format(cam_id, entry["digest"])
+        headers = {"ETag": etag, "Cache-Control": "public, max-age={}".format(max_age)}
+
+        if request.headers.get("If-None-Match") == etag:
+            return Response(status=304, headers=headers)
+        return Response(entry["image"], mimetype="image/jpeg", headers=headers)
+
+    def register(self, server):
+        """
+        adds the /camera/<cam_id>.jpeg route to a flask server, e.g. the `server` attribute of a Dash app
+
+        :param server (Flask):
+        :return:
+        """
+        server.add_url_rule(route, "camera", self.serve)
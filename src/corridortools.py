@@ -0,0 +1,134 @@
+"""Corridor Travel Time Utilities
+
+Derives the travel time along Rue Notre-Dame from the speed measured at each station. The stations are ordered along
+the corridor (which runs south-west to north-east, so by latitude), the haversine distance between consecutive
+stations is computed once, and the travel time of each segment is its distance divided by the mean of the speeds at
+its two ends. The total corridor travel time is the sum of the segment times.
+
+Everything is updated incrementally: a new speed reading at a station only touches the (at most two) segments it
+bounds, and the total is adjusted by the difference. The collector writes:
+
+- corridor:segments, a hash with the latest travel time in seconds of the segment starting at each station
+- corridor:total and corridor:time, lists with one total travel time in seconds per minute, in time order. readings
+  arriving late for an earlier minute update the entry of the latest minute
+
+"""
+import math
+
+segments_key = "corridor:segments"
+total_key = "corridor:total"
+time_key = "corridor:time"
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    great circle distance in km between two points given in degrees
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(a))
+
+
+def corridor_order(lats):
+    """
+    :param lats (list): latitude of each station
+    :return: indices of the stations in their order along the corridor, south-west first
+    """
+    return sorted(range(len(lats)), key=lambda i: lats[i])
+
+
+class CorridorTracker:
+    def __init__(self, det_ids, lats, lons, min_speed=5, maxsize=1440):
+        """
+        :param det_ids (list): ids of the stations on the corridor
+        :param lats (list): latitude of each station
+        :param lons (list): longitude of each station
+        :param min_speed (float): km/h floor applied to speeds so a stopped station doesn't give an infinite time
+        :param maxsize (int): number of minutes kept in the corridor:total series
+        """
+        order = corridor_order(lats)
+        self.det_ids = [det_ids[i] for i in order]
+        self.position = {det_id: p for p, det_id in enumerate(self.det_ids)}
+        self.distances = [haversine(lats[a], lons[a], lats[b], lons[b]) for a, b in zip(order[:-1], order[1:])]
+
+        self.min_speed = min_speed
+        self.maxsize = maxsize
+        self.speeds = [None] * len(self.det_ids)
+        self.segment_times = [None] * len(self.distances)
+        self.known = 0
+        self.total = 0.0
+        self.last_time = None
+
+    def _segment_time(self, i):
+        a = self.speeds[i]
+        b = self.speeds[i + 1]
+        if a is None or b is None:
+            return None
+        speed = max((a + b) / 2, self.min_speed)
+        return 3600 * self.distances[i] / speed
+
+    def update(self, pipe, det_id, speed, time):
+        """
+        recomputes the segments bounded by `det_id` and queues the corridor writes on `pipe`
+
+        :param pipe: redis pipeline the reading itself is written with
+        :param det_id (str):
+        :param speed (float): km/h
+        :param time (str): CreateUtc of the reading
+        :return: total corridor travel time in seconds, or None until every segment has a time
+        """
+        p = self.position.get(det_id)
+        if p is None:
+            return None
+
+        self.speeds[p] = speed
+
+        for i in [p - 1, p]:
+            if i < 0 or i >= len(self.distances):
+                continue
+
+            old = self.segment_times[i]
+            new = self._segment_time(i)
+            self.segment_times[i] = new
+
+            if old is not None:
+                self.total -= old
+                self.known -= 1
+            if new is not None:
+                self.total += new
+                self.known += 1
+                pipe.hset(segments_key, self.det_ids[i], round(new, 1))
+
+        if self.known < len(self.distances):
+            return None
+
+        total = round(self.total, 1)
+        # a late reading of an earlier minute updates the latest entry rather than pushing one out of order, CreateUtc
+        # compare as strings
+        if self.last_time is not None and time[:16] <= self.last_time:
+            pipe.lset(total_key, -1, total)
+        else:
+            self.last_time = time[:16]
+            pipe.rpush(total_key, total)
+            pipe.rpush(time_key, time)
+            pipe.ltrim(total_key, -self.maxsize, -1)
+            pipe.ltrim(time_key, -self.maxsize, -1)
+
+        return total
+
+
+def read_corridor(db, n):
+    """
+    :param db: Redis instance from redis
+    :param n (int): number of latest minutes of the total series to return
+    :return: {"segments": {det_id: seconds}, "total": [seconds], "time": [CreateUtc]}
+    """
+    pipe = db.pipeline(transaction=False)
+    pipe.hgetall(segments_key)
+    pipe.lrange(total_key, -n, -1)
+    pipe.lrange(time_key, -n, -1)
+    segments, total, times = pipe.execute()
+
+    return {"segments": {k.decode(): float(v) for k, v in segments.items()},
+            "total": [float(v) for v in total],
+            "time": [t.decode() for t in times]}
@@ -0,0 +1,312 @@
+"""Historic Reading Export Utilities
+
+Bulk export of the readings of all detectors for analysts, as gzip CSV, Arrow IPC (stream format) or Parquet.
+
+Exports are a pipeline of generators, so memory stays the same whatever the number of detectors or the time range:
+
+    source    reads `batch` detectors at a time from redis (one pipeline of lane rings, or one archive read) and yields
+              their rows in the time range as a chunk of numpy columns
+    encoder   turns each chunk into bytes of the output format as soon as it arrives, e.g. a Parquet row group
+
+Three sources are available:
+
+    readings  one row per detector and minute: id, time, vehicle-gap-time, vehicle-count, vehicle-speed. the lanes of
+              a minute are combined from their raw readings like in the json series (lanetools.combined). the json
+              series aren't read as they only keep the times of the minutes, not of each reading type, so a reading
+              type that missed a minute would be paired with the wrong times
+    lanes     one row per raw lane reading kept by lanetools.py: id, lane, type, time, value
+    archive   one row per reading of the weeks kept compressed by archivetools.py: id, type, time, value
+
+Arrow and Parquet need pyarrow, which the dashboard doesn't otherwise depend on ('pip install pyarrow'). gzip CSV works
+without it.
+
+"""
+import io
+import gzip
+import time
+import numpy as np
+import pandas as pd
+
+import lanetools
+import archivetools
+import registrytools
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+value_types = ["vehicle-gap-time", "vehicle-count", "vehicle-speed"]
+formats = {"csv": ("text/csv", ".csv.gz"),
+           "arrow": ("application/vnd.apache.arrow.stream", ".arrows"),
+           "parquet": ("application/vnd.apache.parquet", ".parquet")}
+
+# column kinds of each source, in output order
+columns = {"readings": [("id", "str"), ("time", "time")] + [(t, "float") for t in value_types],
+           "lanes": [("id", "str"), ("lane", "str"), ("type", "str"), ("time", "time"), ("value", "float")],
+           "archive": [("id", "str"), ("type", "str"), ("time", "time"), ("value", "float")]}
+
+
+def parse_time(created, name="time"):
+    """
+    :param created (str): CreateUtc, e.g. 2021-01-15T08:00:00 or 2021-01-15, or None
+    :param name (str): what the time is, for the error message
+    :return: epoch seconds, or None
+    """
+    if created is None:
+        return None
+    try:
+        # CreateUtc may carry fractional seconds or a zone suffix, only whole seconds are kept
+        return int(np.datetime64(created[:19], "s").astype(np.int64))
+    except ValueError:
+        raise ValueError("invalid {} {!r}, expected a CreateUtc such as 2021-01-15T08:00:00".format(name, created))
+
+
+def _in_range(times, start, end):
+    mask = np.ones(len(times), dtype=bool)
+    if start is not None:
+        mask &= times >= np.datetime64(start, "s")
+    if end is not None:
+        mask &= times < np.datetime64(end, "s")
+    return mask
+
+
+def _read_rings(db, fields):
+    """
+    :param db: Redis instance from redis
+    :param fields (list): (field of lane:counts, readings ever written) of the rings to read, in one round trip
+    :return: list of (field split into detector, lane and reading type, records in time order) of the non empty rings
+    """
+    pipe = db.pipeline(transaction=False)
+    for field, _ in fields:
+        pipe.get(lanetools.key_template.format(*field.split(":")))
+    raws = pipe.execute()
+
+    parts = []
+    for (field, count), raw in zip(fields, raws):
+        records = np.frombuffer(raw or b"", dtype=lanetools.record)[:min(count, len(raw or b"") // 8)]
+        # a ring that wrapped holds its oldest record right after the latest one
+        records = np.roll(records, -(count % len(records))) if count > len(records) > 0 else records
+        if len(records):
+            parts.append((field.split(":"), records))
+    return parts
+
+
+def _lane_fields(db):
+    return sorted((k.decode(), int(v)) for k, v in db.hgetall(lanetools.counts_key).items())
+
+
+def read_readings(db, start=None, end=None, batch=64):
+    """
+    rows of every detector and minute, its lanes combined from their raw readings, see lanetools.py
+
+    :param db: Redis instance from redis
+    :param start (int): epoch seconds of the first reading included, see parse_time, or None from the oldest reading
+    :param end (int): epoch seconds of the first reading excluded, or None up to the latest reading
+    :param batch (int): detectors read per round trip
+    :return: generator of {column: array} chunks
+    """
+    detectors = {}
+    for field, count in _lane_fields(db):
+        det_id, _, value_type = field.split(":")
+        if value_type in value_types:
+            detectors.setdefault(det_id, []).append((field, count))
+
+    det_ids = sorted(detectors)
+    for i in range(0, len(det_ids), batch):
+        parts = _read_rings(db, [f for det_id in det_ids[i:i + batch] for f in detectors[det_id]])
+        if not parts:
+            continue
+
+        index = {det_id: j for j, det_id in enumerate(det_ids[i:i + batch])}
+        n = [len(records) for _, records in parts]
+        owners = np.repeat(np.array([index[f[0]] for f, _ in parts], dtype=np.int64), n)
+        types = np.repeat(np.array([value_types.index(f[2]) for f, _ in parts], dtype=np.int64), n)
+        minutes = np.concatenate([r["t"] for _, r in parts]).astype(np.int64) // 60 * 60
+        values = np.concatenate([r["v"] for _, r in parts]).astype(np.float64)
+
+        mask = _in_range(minutes.astype("datetime64[s]"), start, end)
+        if not mask.any():
+            continue
+        owners, types, minutes, values = owners[mask], types[mask], minutes[mask], values[mask]
+
+        # one row per detector and minute, in that order, summing the lanes of every reading type into it
+        rows, row = np.unique(owners * 2 ** 32 + minutes, return_inverse=True)
+        sums = np.zeros((len(value_types), len(rows)))
+        counts = np.zeros((len(value_types), len(rows)))
+        np.add.at(sums, (types, row), values)
+        np.add.at(counts, (types, row), 1)
+
+        chunk = {"id": np.array(det_ids[i:i + batch], dtype=object)[rows // 2 ** 32],
+                 "time": (rows % 2 ** 32).astype("datetime64[s]")}
+        for j, t in enumerate(value_types):
+            combined = sums[j] if lanetools.combined.get(t) == "sum" else np.divide(sums[j], np.maximum(counts[j], 1))
+            chunk[t] = np.where(counts[j] > 0, combined, np.nan)
+        yield chunk
+
+
+def read_lanes(db, start=None, end=None, batch=256):
+    """
+    rows of the raw lane readings, see lanetools.py
+
+    :param db: Redis instance from redis
+    :param start (int): epoch seconds of the first reading included, or None
+    :param end (int): epoch seconds of the first reading excluded, or None
+    :param batch (int): lane rings read per round trip
+    :return: generator of {column: array} chunks
+    """
+    fields = _lane_fields(db)
+    for i in range(0, len(fields), batch):
+        parts = _read_rings(db, fields[i:i + batch])
+        if not parts:
+            continue
+        n = [len(records) for _, records in parts]
+        chunk = {"id": np.repeat(np.array([f[0] for f, _ in parts], dtype=object), n),
+                 "lane": np.repeat(np.array([f[1] for f, _ in parts], dtype=object), n),
+                 "type": np.repeat(np.array([f[2] for f, _ in parts], dtype=object), n),
+                 "time": np.concatenate([r["t"] for _, r in parts]).astype("datetime64[s]"),
+                 "value": np.concatenate([r["v"] for _, r in parts]).astype(np.float64)}
+
+        mask = _in_range(chunk["time"], start, end)
+        if mask.any():
+            yield {k: v[mask] for k, v in chunk.items()}
+
+
+def read_archive(db, start=None, end=None, batch=64):
+    """
+    rows of the compressed archive, see archivetools.py
+
+    :param db: Redis instance from redis
+    :param start (int): epoch seconds of the first reading included, or None
+    :param end (int): epoch seconds of the first reading excluded, or None
+    :param batch (int): detectors read and decoded at once
+    :return: generator of {column: array} chunks
+    """
+    archive = archivetools.ArchiveDB(db)
+
+    keys = registrytools.detector_keys(db)
+    for i in range(0, len(keys), batch):
+        pairs = [(det_id, t) for det_id in keys[i:i + batch] for t in value_types]
+        owners, times, values = archive.read(pairs, start, end)
+        if len(times) == 0:
+            continue
+        yield {"id": np.array([det_id for det_id, _ in pairs], dtype=object)[owners],
+               "type": np.array([t for _, t in pairs], dtype=object)[owners],
+               "time": times.astype("datetime64[s]"),
+               "value": values}
+
+
+sources = {"readings": read_readings, "lanes": read_lanes, "archive": read_archive}
+
+
+class _Spool(io.RawIOBase):
+    # write-only file the encoders write to, emptied by the pipeline after every chunk
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.parts.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def _schema(source):
+    kinds = {"str": pa.string(), "time": pa.timestamp("s"), "float": pa.float64()}
+    return pa.schema([(name, kinds[kind]) for name, kind in columns[source]])
+
+
+def _encode_csv(chunks, source, spool):
+    with gzip.GzipFile(fileobj=spool, mode="wb") as gz:
+        text = io.TextIOWrapper(gz, encoding="utf-8", newline="")
+        text.write(",".join(name for name, _ in columns[source]) + "\n")
+        text.flush()
+        yield
+        for chunk in chunks:
+            pd.DataFrame(chunk).to_csv(text, header=False, index=False, date_format="%Y-%m-%dT%H:%M:%S")
+            text.flush()
+            yield len(chunk["id"])
+        text.detach()
+
+
+def _encode_arrow(chunks, source, spool):
+    schema = _schema(source)
+    with pa.ipc.new_stream(spool, schema) as writer:
+        yield
+        for chunk in chunks:
+            writer.write_batch(pa.record_batch([chunk[name] for name in schema.names], schema=schema))
+            yield len(chunk["id"])
+
+
+def _encode_parquet(chunks, source, spool):
+    schema = _schema(source)
+    with pq.ParquetWriter(spool, schema, compression="snappy") as writer:
+        yield
+        for chunk in chunks:
+            # every chunk becomes a row group, written out right away
+            writer.write_table(pa.table([chunk[name] for name in schema.names], schema=schema))
+            yield len(chunk["id"])
+
+
+encoders = {"csv": _encode_csv, "arrow": _encode_arrow, "parquet": _encode_parquet}
+
+
+def export(db, fmt="csv", source="readings", start=None, end=None, stats=None):
+    """
+    streams an export, e.g. to write to a file or as the body of an http response
+
+    :param db: Redis instance from redis
+    :param fmt (str): one of `formats`
+    :param source (str): one of `sources`
+    :param start (str): first CreateUtc included, or None
+    :param end (str): first CreateUtc excluded, or None
+    :param stats (dict): if given, kept up to date with the rows, bytes and seconds of the export so far
+    :return: generator of bytes
+    """
+    if fmt not in formats:
+        raise ValueError("unknown export format {}, expected one of {}".format(fmt, list(formats)))
+    if source not in sources:
+        raise ValueError("unknown export source {}, expected one of {}".format(source, list(sources)))
+    if fmt != "csv" and pa is None:
+        raise ImportError("pyarrow is required for {} exports, install with 'pip install pyarrow'".format(fmt))
+
+    start = parse_time(start, "start")
+    end = parse_time(end, "end")
+
+    # checked and parsed above rather than in the generator, so that bad arguments raise when export is called
+    return _stream(db, fmt, source, start, end, {} if stats is None else stats)
+
+
+def _stream(db, fmt, source, start, end, stats):
+    stats.update({"rows": 0, "bytes": 0, "seconds": 0.0})
+    began = time.perf_counter()
+
+    spool = _Spool()
+    for rows in encoders[fmt](sources[source](db, start, end), source, spool):
+        stats["rows"] += rows or 0
+        data = spool.drain()
+        stats["bytes"] += len(data)
+        stats["seconds"] = time.perf_counter() - began
+        if data:
+            yield data
+
+    # what the encoder wrote while closing, e.g. the parquet footer
+    data = spool.drain()
+    stats["bytes"] += len(data)
+    stats["seconds"] = time.perf_counter() - began
+    if data:
+        yield data
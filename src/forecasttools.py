@@ -0,0 +1,111 @@
+"""Short Horizon Forecasting Utilities
+
+Forecasts the next readings of every detector with Holt's linear exponential smoothing (level + trend). The recursion
+runs once over time, with every step vectorized across all detectors in a single NumPy operation, so the cost of a
+forecast round grows with the history length used and barely with the number of detectors.
+
+Series of different lengths are right-aligned into one detectors x time matrix padded with NaN, and missing readings
+simply leave the level and trend of that detector unchanged. Readings are 60 seconds apart, so a horizon of h minutes
+is h steps ahead.
+
+The forecasts are produced by ../backend/workers/forecast_worker.py once per minute and stored under forecast:<det_id>
+next to the readings, nothing is computed inside the Dash callbacks.
+
+"""
+import json
+import numpy as np
+import rendertools
+
+key_template = "forecast:{}"
+horizons = [5, 15, 30]
+
+
+def to_matrix(series, window):
+    """
+    right-aligns the last `window` readings of every series into a float matrix padded with NaN on the left
+
+    :param series (list): list of lists of readings, one per detector
+    :param window (int):
+    :return: np.ndarray of shape (len(series), window)
+    """
+    matrix = np.full((len(series), window), np.nan)
+    for i, s in enumerate(series):
+        s = s[-window:]
+        if s:
+            matrix[i, window - len(s):] = s
+    return matrix
+
+
+def holt_forecast(matrix, horizons=horizons, alpha=0.3, beta=0.05):
+    """
+    Holt's linear exponential smoothing of every row of `matrix` at once
+
+    :param matrix (np.ndarray): detectors x time, NaN where there is no reading
+    :param horizons (list): steps ahead to forecast
+    :param alpha (float): level smoothing factor
+    :param beta (float): trend smoothing factor
+    :return: np.ndarray of shape (detectors, len(horizons)), NaN for detectors without any reading
+    """
+    n_det, n_time = matrix.shape
+    level = np.full(n_det, np.nan)
+    trend = np.zeros(n_det)
+
+    for t in range(n_time):
+        x = matrix[:, t]
+        seen = ~np.isnan(x)
+
+        # the first reading of a detector initializes its level
+        first = seen & np.isnan(level)
+        level[first] = x[first]
+
+        update = seen & ~first
+        new_level = alpha * x + (1 - alpha) * (level + trend)
+        new_trend = beta * (new_level - level) + (1 - beta) * trend
+        level = np.where(update, new_level, level)
+        trend = np.where(update, new_trend, trend)
+
+    steps = np.asarray(horizons, dtype=float)
+    forecast = level[:, None] + trend[:, None] * steps[None, :]
+
+    # readings are non-negative
+    return np.clip(forecast, 0, None)
+
+
+def write_forecasts(db, det_ids, base_times, forecasts):
+    """
+    stores the forecasts of each detector under forecast:<det_id> in a single round trip
+
+    :param db: Redis instance from redis
+    :param det_ids (list):
+    :param base_times (list): time of the latest reading each forecast starts from
+    :param forecasts (dict): {reading type: np.ndarray of shape (detectors, horizons)}
+    :return:
+    """
+    pipe = db.pipeline(transaction=False)
+    for i, det_id in enumerate(det_ids):
+        entry = {"time": base_times[i], "horizons": horizons}
+        for value_type, values in forecasts.items():
+            row = values[i]
+            entry[value_type] = None if np.isnan(row).any() else np.round(row, 1).tolist()
+        pipe.set(key_template.format(det_id), json.dumps(entry))
+    pipe.incr(rendertools.version_key)
+    pipe.execute()
+
+
+def read_forecasts(db, det_ids, value_type):
+    """
+    :param db: Redis instance from redis
+    :param det_ids (list):
+    :param value_type (str):
+    :return: list with (horizons, values) for each detector, or None where there is no forecast
+    """
+    raw = db.mget([key_template.format(det_id) for det_id in det_ids])
+
+    forecasts = []
+    for r in raw:
+        entry = None if r is None else json.loads(r)
+        if entry is None or entry.get(value_type) is None:
+            forecasts.append(None)
+        else:
+            forecasts.append((entry["horizons"], entry[value_type]))
+    return forecasts
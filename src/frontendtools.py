@@ -6,11 +6,20 @@ The methods exist to perform simple data processing
 
 """
 import json
-import redis
+import time
+import redistools
 import pytz
 import datetime
 import numpy as np
 import pandas as pd
+import anomalytools
+import forecasttools
+import corridortools
+import registrytools
+import lanetools
+import gridtools
+import replaytools
+import lagtools
 
 
 def generate_table_data(df, speed_values, count_values, gap_values):
@@ -28,6 +37,17 @@ def generate_table_data(df, speed_values, count_values, gap_values):
     return table_data
 
 
+def extend_table_data(table_data, df):
+    """
+    :param table_data (DataFrame): from generate_table_data
+    :param df (DataFrame): datasheet of the detectors to add, see RedisDB.detector_sheet
+    :return: the table with a row without readings for each added detector, numbered after the existing stations
+    """
+    first = len(table_data)
+    rows = pd.DataFrame({"station": (np.arange(len(df)) + first + 1).tolist(), "corner": df["corner_st2"].values})
+    return pd.concat([table_data, rows], ignore_index=True)[table_data.columns]
+
+
 def date_convert(utc_time_str, source_tz="America/New_York",target_tz="America/New_York"):
     [date, time] = utc_time_str.split("T")
 
@@ -49,37 +69,202 @@ def date_convert(utc_time_str, source_tz="America/New_York",target_tz="America/N
 
 
 class RedisDB:
-    def __init__(self, host="localhost", port=6379, dbid=0):
+    def __init__(self, host=None, port=None, dbid=None, client=None, local_cache=None, key_refresh=60):
         """
         wrapper class around the Redis component of native redis to facilitate extracting the last readings of every
         detector and the last n readings of every detector
-        :param host:
-        :param port:
-        :param dbid:
+        :param host: defaults to the MTL_REDIS_HOST environment variable, see redistools.py
+        :param port: defaults to MTL_REDIS_PORT
+        :param dbid: defaults to MTL_REDIS_DB
+        :param client (Redis): optional already connected client to use instead of opening a new one, e.g. a
+        fakeredis instance when benchmarking
+        :param local_cache (bool): keep the decoded readings in memory until redis announces they changed, defaults
+        to MTL_REDIS_LOCAL_CACHE
+        :param key_refresh (float): seconds between two reads of the registry by refresh_keys
         """
-        self.db = redis.Redis(host=host, port=port, db=dbid)
-        self.keys = [k.decode() for k in self.db.keys()]
-        self.keys.sort()
+        if client is None:
+            client = redistools.connect(host, port, dbid)
+        self.db = client
+
+        self.lane_db = lanetools.LaneDB(self.db)
+        self.grid_db = gridtools.GridDB(self.db)
+        self.rollups = gridtools.ShiftingMatrix(self.db)
+
+        self.cache = None
+        if redistools.setting("local_cache", local_cache):
+            self.cache = redistools.LocalCache(self.db, json.loads)
+
+        self.key_refresh = key_refresh
+        self.keys_read = time.monotonic()
+        self.keys = registrytools.detector_keys(self.db)
         self.readings = {}
 
+        self.replay = replaytools.Prefetcher(replaytools.ReplayFrames(self.db, self.keys))
+
+    def refresh_keys(self):
+        """
+        reads the registry again, at most every `key_refresh` seconds, for the detectors registered since. they're
+        appended after the known ones, so that every detector keeps its position in the lists returned
+
+        :return: list of the detectors added
+        """
+        now = time.monotonic()
+        if now - self.keys_read < self.key_refresh:
+            return []
+        self.keys_read = now
+
+        known = set(self.keys)
+        added = [k for k in registrytools.detector_keys(self.db) if k not in known]
+        if added:
+            self.keys = self.keys + added
+            self.replay.set_keys(self.keys)
+        return added
+
     def _update(self):
-        for k in self.keys:
-            self.readings[k] = json.loads(self.db.get(k))
+        if not self.keys:
+            return
+        if self.cache is not None:
+            readings = self.cache.mget(self.keys)
+        else:
+            readings = [json.loads(r) for r in self.db.mget(self.keys)]
+        self.readings = dict(zip(self.keys, readings))
 
     def latest_readings(self, value_type):
+        """
+        :param value_type (str): reading type, or "time"
+        :return: latest reading of every detector, None for a detector without any yet
+        """
         self._update()
         values = []
 
         for k in self.keys:
-            values.append(self.readings[k][value_type][-1])
+            readings = self.readings.get(k, {}).get(value_type)
+            values.append(readings[-1] if readings else None)
 
         return values
 
+    def detector_sheet(self, df, keys=None):
+        """
+        datasheet with one row per detector in the db, in the same order as latest_readings. detectors missing from
+        `df` are described by the meta:<det_id> hash their collector registered, or left without location
+        :param df (DataFrame): detector datasheet with id read as str
+        :param keys (list): detectors to describe, all of them by default
+        :return: DataFrame with the columns of `df`
+        """
+        if keys is None:
+            keys = self.keys
+        rows = df.set_index("id")
+        missing = [k for k in keys if k not in rows.index]
+        metas = dict(zip(missing, registrytools.read_metadata(self.db, missing)))
+
+        sheet = []
+        for k in keys:
+            if k in rows.index:
+                row = rows.loc[k].to_dict()
+            else:
+                meta = metas[k]
+                row = {"corner_st1": meta.get("corner_st1", "unknown"),
+                       "corner_st2": meta.get("corner_st2", "detector {}".format(k)),
+                       "latitude": float(meta.get("latitude", "nan")),
+                       "longitude": float(meta.get("longitude", "nan")),
+                       "id_camera": meta.get("id_camera")}
+            row["id"] = k
+            sheet.append(row)
+
+        return pd.DataFrame(sheet, columns=df.columns).reset_index(drop=True)
+
+    def latest_flags(self, value_type):
+        """
+        anomaly flags written by the collector for the latest reading of every detector, see anomalytools.py
+        :param value_type (str):
+        :return: list of bools in the same order as latest_readings
+        """
+        return anomalytools.read_flags(self.db, self.keys, value_type)
+
+    def latest_forecasts(self, value_type):
+        """
+        forecasts written by ../backend/workers/forecast_worker.py, see forecasttools.py
+        :param value_type (str):
+        :return: list with (horizons, values) or None for every detector, in the same order as latest_readings
+        """
+        return forecasttools.read_forecasts(self.db, self.keys, value_type)
+
+    def corridor(self, n=1):
+        """
+        travel times along the corridor written by the collector, see corridortools.py
+        :param n (int): number of latest minutes of the total travel time series
+        :return: {"segments": {det_id: seconds}, "total": [seconds], "time": [CreateUtc]}
+        """
+        return corridortools.read_corridor(self.db, n)
+
+    def lags(self, n=120):
+        """
+        minutes a change of speed takes to travel each segment of the corridor, written by
+        ../backend/workers/lag_worker.py, see lagtools.py
+        :param n (int): number of latest rounds
+        :return: {"segments": [[upstream, downstream]], "window": minutes, "time": [CreateUtc], "lag": rounds x
+        segments, "correlation": rounds x segments}
+        """
+        return lagtools.read_lags(self.db, n)
+
+    def lane_readings(self, value_type, how="mean", n=240):
+        """
+        readings combined from the raw lane readings at query time rather than at ingest, see lanetools.py
+        :param value_type (str):
+        :param how (str): "mean", "sum" or "max" across the lanes of a detector
+        :param n (int): number of latest timestamps
+        :return: {det_id: {"time": [CreateUtc], value_type: [values]}}
+        """
+        return self.lane_db.aggregate(value_type, how, n)
+
+    def grid(self, value_type, n, fill=False):
+        """
+        readings of every detector on a shared grid of the last n minutes, see gridtools.py. unlike n_latest_readings,
+        a given column holds the readings of the same minute for every detector
+        :param value_type (str):
+        :param n (int): number of minutes
+        :param fill (bool): interpolate the minutes a detector didn't report
+        :return: {"time": [CreateUtc of each minute], "values": detectors x n array, "mask": detectors x n bools}
+        """
+        if self.grid_db.available():
+            return self.grid_db.grid(self.keys, value_type, n, fill)
+
+        # written by a collector without a grid, put the json series on one
+        return gridtools.from_series(self.n_latest_readings("time", n), self.n_latest_readings(value_type, n), n, fill)
+
+    def heatmap(self, value_type):
+        """
+        5 minute means of every detector over the last 24h, see gridtools.ShiftingMatrix
+        :param value_type (str):
+        :return: {"time": [CreateUtc of each bucket], "values": detectors x buckets array, "mask": detectors x buckets
+        bools}, not to be modified
+        """
+        if self.rollups.available():
+            return self.rollups.matrix(self.keys, value_type)
+
+        # written by a collector without rollups, fall back to the minutes of the grid
+        return self.grid(value_type, gridtools.rollup_ring)
+
+    def replay_bounds(self):
+        """
+        :return: (first, last) epoch seconds the archive holds readings for, or None while it's empty
+        """
+        return self.replay.bounds()
+
+    def replay_frame(self, t):
+        """
+        readings of every detector at a past minute, from the archive through the replay prefetcher, see replaytools.py
+        :param t (int): epoch seconds
+        :return: {"time": epoch seconds of the minute, "utc": its CreateUtc, reading type: [reading or None]}, readings
+        in the same order as latest_readings
+        """
+        return self.replay.frame(t)
+
     def n_latest_readings(self, value_type, n):
         self._update()
         values = []
         for k in self.keys:
-            complete_readings = self.readings[k][value_type]
+            complete_readings = self.readings.get(k, {}).get(value_type, [])
             leng = len(complete_readings)
             if leng <= n:
                 subreadings = complete_readings
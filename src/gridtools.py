@@ -0,0 +1,415 @@
+"""Regular Time Grid Utilities
+
+The json series of a detector hold its readings in arrival order, next to a list of the distinct CreateUtc it reported.
+A detector missing a minute or reporting one twice ends up with series of other lengths than its neighbours, so
+lining up the series of several detectors by position (e.g. on the times of the first detector) misplaces readings.
+
+This module keeps every detector on a shared grid of minutes instead. The collector writes each reading to the cell of
+its minute, in a ring per reading type holding a row of `ring` cells per detector. The lanes of a detector share its
+cell, which holds their combined reading (lanetools.MinuteCombiner, the mean speed and gap time and the total count)
+and is rewritten as each lane comes in:
+
+- grid:<reading type>, a string of rows * ring records of 8 bytes (int32 epoch seconds of the minute, float32 reading).
+  the reading of minute m of the detector in row r is written with SETRANGE at offset 8 * (r * ring + (m / 60) % ring)
+- grid:rows, a hash with the row of each detector, assigned the first time the collector writes one of its readings.
+  rows are allocated by `row_script` in redis rather than in memory, so that collectors running side by side (see
+  hatools.py) agree on them, and are never removed
+
+A cell whose minute isn't the one expected at its position holds a reading from `ring` minutes earlier, or nothing, and
+is a gap.
+
+GridDB reads a whole ring in one GET and turns it into a detectors x minutes matrix with numpy indexing, together with
+the mask of the cells holding a reading. Gaps can optionally be filled by linear interpolation between the readings
+around them, for all detectors at once. from_series builds the same matrix from the json series, for databases written
+without a grid.
+
+Coarser rollups, the mean of the minutes of every 5 minutes over the last 24h for the dashboard's heatmap, are kept by
+bucket rather than by detector, so that the newest buckets can be read on their own:
+
+- rollup:<reading type>:<bucket>, a string of one record per row (int32 epoch seconds of the bucket start, float32
+  running mean of its minutes) for each 5 minute bucket, expiring once out of the 24h
+- rollup:rows, the row of each detector allocated like grid:rows, and rollup:latest, the start of the latest bucket
+  written
+
+ShiftingMatrix keeps the full detectors x buckets matrix up to date from these: on a new data version it shifts its
+columns left by the number of buckets that started since and only reads the newest ones again.
+
+"""
+import numpy as np
+import rendertools
+import lanetools
+
+step = 60
+key_template = "grid:{}"
+rows_key = "grid:rows"
+record = lanetools.record
+
+rollup_step = 300
+rollup_ring = 288
+rollup_template = "rollup:{}:{}"
+rollup_rows_key = "rollup:rows"
+rollup_latest_key = "rollup:latest"
+
+# KEYS: rows hash. ARGV: detector id. the row already assigned to the detector, or the next one
+row_script = """
+local row = redis.call('HGET', KEYS[1], ARGV[1])
+if row then
+    return tonumber(row)
+end
+row = redis.call('HLEN', KEYS[1])
+redis.call('HSET', KEYS[1], ARGV[1], row)
+return row
+"""
+
+
+class GridRecorder:
+    def __init__(self, db, ring=300):
+        """
+        :param db: Redis instance from redis, read once to resume the rows of a previous run, and to allocate the row
+        of a new detector
+        :param ring (int): minutes kept per detector
+        """
+        self.ring = ring
+        self.rows = {k.decode(): int(v) for k, v in db.hgetall(rows_key).items()}
+        self.row_script = db.register_script(row_script)
+        self.combiner = lanetools.MinuteCombiner()
+
+    def update(self, pipe, det_id, subj, reading, time):
+        """
+        queues the write of the lanes of a detector combined so far to the cell of their minute on `pipe`
+
+        :param pipe: redis pipeline the reading itself is written with
+        :param det_id (str):
+        :param subj (str): reading type
+        :param reading (float):
+        :param time (str): CreateUtc of the reading
+        :return:
+        """
+        row = self.rows.get(det_id)
+        if row is None:
+            row = self.rows[det_id] = int(self.row_script(keys=[rows_key], args=[det_id]))
+
+        minute = lanetools.to_epoch(time) // step * step
+        value, _ = self.combiner.update(det_id, subj, reading, minute)
+        packed = lanetools.packer.pack(minute, value)
+        cell = row * self.ring + (minute // step) % self.ring
+        pipe.setrange(key_template.format(subj), record.itemsize * cell, packed)
+
+
+class RollupRecorder:
+    def __init__(self, db, ring=rollup_ring, step=rollup_step):
+        """
+        :param db: Redis instance from redis, read once to resume the rows and latest bucket of a previous run, and
+        to allocate the row of a new detector
+        :param ring (int): buckets kept
+        :param step (int): seconds per bucket
+        """
+        self.ring = ring
+        self.step = step
+        self.rows = {k.decode(): int(v) for k, v in db.hgetall(rollup_rows_key).items()}
+        self.row_script = db.register_script(row_script)
+        self.latest = int(db.get(rollup_latest_key) or 0)
+
+        # the current bucket of each detector and reading type, and the reading of each of its minutes with the lanes
+        # combined like on the grid
+        self.combiner = lanetools.MinuteCombiner()
+        self.sums = {}
+
+    def update(self, pipe, det_id, subj, reading, time):
+        """
+        queues the write of the mean of the minutes of the bucket of a reading on `pipe`
+
+        :param pipe: redis pipeline the reading itself is written with
+        :param det_id (str):
+        :param subj (str): reading type
+        :param reading (float):
+        :param time (str): CreateUtc of the reading
+        :return:
+        """
+        row = self.rows.get(det_id)
+        if row is None:
+            row = self.rows[det_id] = int(self.row_script(keys=[rollup_rows_key], args=[det_id]))
+
+        epoch = lanetools.to_epoch(time)
+        minute = epoch // step * step
+        bucket = epoch // self.step * self.step
+        value, _ = self.combiner.update(det_id, subj, reading, minute)
+
+        total = self.sums.get((det_id, subj))
+        if total is None or total[0] != bucket:
+            # a collector restarted in the middle of a bucket only averages the minutes it received
+            total = [bucket, {}]
+            self.sums[(det_id, subj)] = total
+        first = not total[1]
+        total[1][minute] = value
+
+        key = rollup_template.format(subj, bucket)
+        mean = sum(total[1].values()) / len(total[1])
+        pipe.setrange(key, record.itemsize * row, lanetools.packer.pack(bucket, mean))
+        if first:
+            pipe.expire(key, self.step * (self.ring + 1))
+
+        if bucket > self.latest:
+            self.latest = bucket
+            pipe.set(rollup_latest_key, bucket)
+
+
+def minutes(end, n, step=step):
+    """
+    :param end (int): epoch seconds of the last minute
+    :param n (int):
+    :param step (int): seconds between two columns, e.g. rollup_step for the rollups
+    :return: int64 array of the epoch seconds of the n minutes up to `end`
+    """
+    return end - step * np.arange(n - 1, -1, -1, dtype=np.int64)
+
+
+def labels(grid_minutes):
+    return [lanetools.from_epoch(m) for m in grid_minutes]
+
+
+def interpolate(values, mask):
+    """
+    fills the gaps of every row linearly between the readings around them, the gaps before the first or after the last
+    reading of a row take that reading, like np.interp. rows without any reading are left as they are
+
+    :param values (ndarray): detectors x minutes
+    :param mask (ndarray): bools of the same shape, True where `values` holds a reading
+    :return: new filled array
+    """
+    n_rows, n = values.shape
+    columns = np.arange(n)
+
+    # column of the last reading at or before, and of the first reading at or after, each cell
+    previous = np.maximum.accumulate(np.where(mask, columns, -1), axis=1)
+    following = np.minimum.accumulate(np.where(mask, columns, n)[:, ::-1], axis=1)[:, ::-1]
+
+    has_previous = previous >= 0
+    has_following = following < n
+    previous = np.where(has_previous, previous, following)
+    following = np.where(has_following, following, previous)
+
+    empty = ~mask.any(axis=1)
+    previous[empty] = 0
+    following[empty] = 0
+
+    rows = np.arange(n_rows)[:, None]
+    left = values[rows, previous]
+    right = values[rows, following]
+    span = following - previous
+    weight = np.divide(columns - previous, span, out=np.zeros(values.shape), where=span > 0)
+
+    filled = left + weight * (right - left)
+    filled[empty] = np.nan
+    return np.where(mask, values, filled)
+
+
+def as_lists(values, mask):
+    """
+    :return: list of lists of readings per detector, with None in the gaps, e.g. for plotly to break its lines on
+    """
+    return [[v if m else None for v, m in zip(row, row_mask)] for row, row_mask in zip(values.tolist(), mask.tolist())]
+
+
+def _result(grid_minutes, values, mask, fill):
+    if fill:
+        values = interpolate(values, mask)
+    return {"time": labels(grid_minutes), "values": values, "mask": mask}
+
+
+def empty_grid(n_rows):
+    return {"time": [], "values": np.zeros((n_rows, 0)), "mask": np.zeros((n_rows, 0), dtype=bool)}
+
+
+def from_series(times, series, n, fill=False):
+    """
+    puts json series on the grid of the n minutes up to the latest one
+
+    :param times (list): list of the CreateUtc of every detector
+    :param series (list): list of the readings of every detector, aligned with its times on their latest entries
+    :param n (int): number of minutes
+    :param fill (bool): interpolate the gaps
+    :return: {"time": [CreateUtc of each minute], "values": detectors x n array, "mask": detectors x n bools}
+    """
+    rows, cells, readings = [], [], []
+    for r, (t, s) in enumerate(zip(times, series)):
+        k = min(len(t), len(s))
+        if k == 0:
+            continue
+        rows.append(np.full(k, r))
+        cells.append(np.array([c[:19] for c in t[len(t) - k:]], dtype="datetime64[s]").astype(np.int64) // step * step)
+        readings.append(np.asarray(s[len(s) - k:], dtype=np.float64))
+
+    if not rows:
+        return empty_grid(len(series))
+
+    rows = np.concatenate(rows)
+    cells = np.concatenate(cells).astype(np.int64)
+    readings = np.concatenate(readings)
+
+    end = cells.max()
+    column = (cells - end) // step + n - 1
+    inside = column >= 0
+
+    values = np.full((len(series), n), np.nan)
+    mask = np.zeros((len(series), n), dtype=bool)
+    # later readings of a same minute overwrite earlier ones, as in the collector's grid
+    values[rows[inside], column[inside]] = readings[inside]
+    mask[rows[inside], column[inside]] = True
+    return _result(minutes(end, n), values, mask, fill)
+
+
+class GridDB:
+    def __init__(self, db, ring=300, cache_size=8):
+        """
+        :param db: Redis instance from redis
+        :param ring (int): ring size the collector writes with
+        :param cache_size (int): number of grids kept for the current data version
+        """
+        self.db = db
+        self.ring = ring
+        self.cache_size = cache_size
+        self.cache = {}
+        self.cache_version = None
+
+    def available(self):
+        return self.db.exists(rows_key) > 0
+
+    def grid(self, keys, value_type, n, fill=False):
+        """
+        the readings of `keys` over the n minutes up to the latest one of any detector. the arrays are shared between
+        callers until the next data version, and must not be modified
+
+        :param keys (list): detector ids, in the order of the rows of the result
+        :param value_type (str):
+        :param n (int): number of minutes, at most the ring size
+        :param fill (bool): interpolate the gaps
+        :return: {"time": [CreateUtc of each minute], "values": detectors x n array, "mask": detectors x n bools}
+        """
+        n = min(n, self.ring)
+
+        version = self.db.get(rendertools.version_key)
+        if version is None or version != self.cache_version:
+            self.cache = {}
+            self.cache_version = version
+
+        query = (tuple(keys), value_type, n, fill)
+        if version is not None and query in self.cache:
+            return self.cache[query]
+
+        pipe = self.db.pipeline(transaction=False)
+        pipe.hgetall(rows_key)
+        pipe.get(key_template.format(value_type))
+        rows, raw = pipe.execute()
+        rows = {k.decode(): int(v) for k, v in rows.items()}
+
+        cells = np.zeros((max(rows.values(), default=-1) + 1) * self.ring, dtype=record)
+        raw = np.frombuffer(raw or b"", dtype=record)[:len(cells)]
+        cells[:len(raw)] = raw
+        cells = cells.reshape(-1, self.ring)
+
+        if not cells["t"].any():
+            result = empty_grid(len(keys))
+        else:
+            end = int(cells["t"].max())
+            grid_minutes = minutes(end, n)
+
+            # rows of detectors the collector never wrote point past the last row, at an empty cell
+            cells = np.concatenate([cells, np.zeros((1, self.ring), dtype=record)])
+            row_index = np.array([rows.get(k, len(cells) - 1) for k in keys], dtype=np.int64)
+            picked = cells[row_index[:, None], (grid_minutes // step) % self.ring]
+
+            mask = picked["t"] == grid_minutes
+            values = np.where(mask, picked["v"].astype(np.float64), np.nan)
+            result = _result(grid_minutes, values, mask, fill)
+
+        if version is not None:
+            if len(self.cache) >= self.cache_size:
+                self.cache.pop(next(iter(self.cache)))
+            self.cache[query] = result
+        return result
+
+
+class ShiftingMatrix:
+    def __init__(self, db, ring=rollup_ring, step=rollup_step, refresh=2):
+        """
+        the rollups of a RollupRecorder as a detectors x buckets matrix per reading type, kept up to date without
+        reading them all again: on a new data version the matrix is shifted left by the number of buckets that started
+        since, and only its last columns (the new buckets, and the `refresh` latest ones whose means may have changed)
+        are read, in one MGET. everything is only read again when detectors were added or the whole ring went by
+
+        :param db: Redis instance from redis
+        :param ring (int): buckets kept by the collector
+        :param step (int): seconds per bucket the collector writes with
+        :param refresh (int): number of latest buckets read again on every update, to pick up late readings
+        """
+        self.db = db
+        self.ring = ring
+        self.step = step
+        self.refresh = refresh
+        self.state = {}
+        self.reads = {"full": 0, "shift": 0}
+
+    def available(self):
+        return self.db.exists(rollup_latest_key) > 0
+
+    def _read(self, state, value_type, buckets):
+        # the column of every bucket, detectors missing from a bucket or from the rows stay gaps
+        raws = self.db.mget([rollup_template.format(value_type, b) for b in buckets])
+        values = np.full((len(state["row_index"]), len(buckets)), np.nan)
+        mask = np.zeros(values.shape, dtype=bool)
+        for j, (bucket, raw) in enumerate(zip(buckets, raws)):
+            cells = np.zeros(state["n_rows"] + 1, dtype=record)
+            raw = np.frombuffer(raw or b"", dtype=record)[:state["n_rows"]]
+            cells[:len(raw)] = raw
+            picked = cells[state["row_index"]]
+            mask[:, j] = picked["t"] == bucket
+            values[mask[:, j], j] = picked["v"][mask[:, j]]
+        return values, mask
+
+    def matrix(self, keys, value_type):
+        """
+        :param keys (list): detector ids, in the order of the rows of the result
+        :param value_type (str):
+        :return: {"time": [CreateUtc of each bucket], "values": detectors x ring array, "mask": detectors x ring bools},
+        the arrays are updated in place on the next data version and must not be modified
+        """
+        pipe = self.db.pipeline(transaction=False)
+        pipe.get(rendertools.version_key)
+        pipe.get(rollup_latest_key)
+        pipe.hgetall(rollup_rows_key)
+        version, latest, rows = pipe.execute()
+
+        state = self.state.get(value_type)
+        if state is not None and version is not None and state["version"] == version and state["keys"] == keys:
+            return state["result"]
+        if latest is None:
+            return empty_grid(len(keys))
+        end = int(latest)
+
+        rows = {k.decode(): int(v) for k, v in rows.items()}
+        n_rows = max(rows.values(), default=-1) + 1
+        if (state is None or state["keys"] != keys or state["n_rows"] != n_rows or end < state["end"] or
+                end - state["end"] >= self.step * self.ring):
+            # detectors the collector never wrote point at the extra empty cell after the last row
+            state = {"keys": keys, "n_rows": n_rows, "end": end,
+                     "row_index": np.array([rows.get(k, n_rows) for k in keys], dtype=np.int64)}
+            state["values"], state["mask"] = self._read(state, value_type, minutes(end, self.ring, self.step))
+            self.reads["full"] += 1
+        else:
+            shift = (end - state["end"]) // self.step
+            values, mask = state["values"], state["mask"]
+            if shift > 0:
+                values[:, :-shift] = values[:, shift:]
+                mask[:, :-shift] = mask[:, shift:]
+
+            k = min(shift + self.refresh, self.ring)
+            values[:, -k:], mask[:, -k:] = self._read(state, value_type, minutes(end, k, self.step))
+            state["end"] = end
+            self.reads["shift"] += 1
+
+        state["version"] = version
+        state["result"] = {"time": labels(minutes(end, self.ring, self.step)),
+                           "values": state["values"], "mask": state["mask"]}
+        self.state[value_type] = state
+        return state["result"]
@@ -0,0 +1,210 @@
+"""High Availability Collector Utilities
+
+Lets several collectors consume the same topics at once, so that readings keep being written when one of them dies.
+With the plain read-modify-write of backendtools.on_message, two collectors would append every reading twice and
+overwrite each other's json.
+
+Each reading is instead written by a Lua script that redis runs atomically:
+
+1. HSETNX of the field <lane>:<reading type>:<CreateUtc> in seen:<det_id>:<minute>, a hash of the readings of a
+   detector's minute that expires after `ttl` seconds. if the field already exists, another collector (or a QoS 1
+   redelivery) already wrote the reading, and nothing else is done
+2. otherwise the reading is combined with the other lanes of its minute, whose running sum and number are kept in the
+   same hash, and written to the detector's json series exactly like on_message does: appended for a new minute,
+   rewriting the latest entry for a later lane of the same minute, trimming included. series:<det_id> holds the
+   minute of the latest entry of each reading type
+
+so every reading is written once, by whichever collector gets it first, and a standby never waits on the collector it
+backs up: as soon as one stops, the others' writes go through. The extra cost in redis is a small hash per detector and
+minute, kept for `ttl` seconds.
+
+The collectors that didn't win a reading still update their in-memory state from it (anomaly statistics, corridor,
+lane and rollup positions) with their writes dropped by a DiscardPipeline, so they take over with the same state.
+Ingest accounting counts the same stream on every collector, so only the holder of a short lease (ha:leader) flushes
+its counters.
+
+"""
+import os
+import socket
+import lanetools
+
+marker_template = "seen:{}:{}"
+series_template = "series:{}"
+lease_key = "ha:leader"
+
+# KEYS: detector json, marker hash, series minutes hash. ARGV: marker field, marker ttl, reading type, reading,
+# CreateUtc, maxsize, minsize, how the lanes are combined (sum or mean), minute, then the keys of the json in the order
+# the collector writes them
+append_script = """
+if redis.call('HSETNX', KEYS[2], ARGV[1], 1) == 0 then
+    return 0
+end
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+
+local total = tonumber(redis.call('HINCRBYFLOAT', KEYS[2], 'sum:' .. ARGV[3], ARGV[4]))
+local lanes = redis.call('HINCRBY', KEYS[2], 'lanes:' .. ARGV[3], 1)
+local value = total
+if ARGV[8] ~= 'sum' then
+    value = total / lanes
+end
+
+-- a lane of a minute older than the latest entry leaves the series as they are
+local minute = ARGV[9]
+local last = redis.call('HGET', KEYS[3], ARGV[3])
+if last and minute < last then
+    return 1
+end
+
+local order = {}
+for i = 10, #ARGV do
+    order[#order + 1] = ARGV[i]
+end
+
+local raw = redis.call('GET', KEYS[1])
+local data = {}
+if raw then
+    data = cjson.decode(raw)
+end
+for _, k in ipairs(order) do
+    if type(data[k]) ~= 'table' then
+        data[k] = {}
+    end
+end
+
+local maxsize = tonumber(ARGV[6])
+local minsize = tonumber(ARGV[7])
+local smallest = nil
+for _, k in ipairs(order) do
+    if smallest == nil or #data[k] < smallest then
+        smallest = #data[k]
+    end
+end
+if smallest == maxsize then
+    for _, k in ipairs(order) do
+        local kept = {}
+        for i = #data[k] - minsize + 2, #data[k] do
+            kept[#kept + 1] = data[k][i]
+        end
+        data[k] = kept
+    end
+end
+
+local readings = data[ARGV[3]]
+if last == minute and #readings > 0 then
+    readings[#readings] = value
+else
+    readings[#readings + 1] = value
+    redis.call('HSET', KEYS[3], ARGV[3], minute)
+
+    local times = data['time']
+    local known = false
+    for _, t in ipairs(times) do
+        if t == ARGV[5] then
+            known = true
+            break
+        end
+    end
+    if not known then
+        times[#times + 1] = ARGV[5]
+    end
+end
+
+-- encoded by hand, cjson would turn the empty lists into objects and change the key order json.dumps writes
+local parts = {}
+for _, k in ipairs(order) do
+    local items = {}
+    for i, v in ipairs(data[k]) do
+        if type(v) == 'string' then
+            items[i] = cjson.encode(v)
+        elseif v == math.floor(v) and math.abs(v) < 1e15 then
+            items[i] = string.format('%d', v)
+        else
+            items[i] = string.format('%.14g', v)
+        end
+    end
+    parts[#parts + 1] = cjson.encode(k) .. ': [' .. table.concat(items, ', ') .. ']'
+end
+redis.call('SET', KEYS[1], '{' .. table.concat(parts, ', ') .. '}')
+return 1
+"""
+
+# ARGV: collector name, lease ttl
+lease_script = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+
+class DiscardPipeline:
+    """
+    stands in for a redis pipeline whose commands must not be sent, every method call is ignored
+    """
+    def __getattr__(self, name):
+        return self._ignore
+
+    def _ignore(self, *args, **kwargs):
+        return self
+
+
+class IdempotentWriter:
+    def __init__(self, db, data_template, name=None, ttl=3600, lease_ttl=15, maxsize=300, minsize=240):
+        """
+        :param db: Redis instance from redis
+        :param data_template (dict): the collector's data template, whose keys give the order of the json
+        :param name (str): identifies this collector in the lease, defaults to <host>-<pid>
+        :param ttl (int): seconds a reading is remembered as written, longer than any redelivery or clock skew
+        :param lease_ttl (int): seconds the accounting lease outlives its holder
+        :param maxsize (int): same trimming of the json series as backendtools.on_message
+        :param minsize (int):
+        """
+        self.db = db
+        self.order = list(data_template)
+        self.name = name if name is not None else "{}-{}".format(socket.gethostname(), os.getpid())
+        self.ttl = ttl
+        self.lease_ttl = lease_ttl
+        self.maxsize = maxsize
+        self.minsize = minsize
+
+        self.append_script = db.register_script(append_script)
+        self.lease_script = db.register_script(lease_script)
+        self.discard = DiscardPipeline()
+        self.written = 0
+        self.skipped = 0
+
+    def append(self, det_id, lane, subj, reading, time):
+        """
+        combines a lane reading into the json series of its detector, unless any collector already did
+
+        :param det_id (str):
+        :param lane (str):
+        :param subj (str): reading type
+        :param reading (float):
+        :param time (str): CreateUtc of the reading
+        :return: True if this call wrote the reading
+        """
+        marker = marker_template.format(det_id, time[:16])
+        field = "{}:{}:{}".format(lane, subj, time)
+        how = "sum" if lanetools.combined.get(subj) == "sum" else "mean"
+        args = [field, self.ttl, subj, reading, time, self.maxsize, self.minsize, how, time[:16]] + self.order
+
+        keys = [det_id, marker, series_template.format(det_id)]
+        written = self.append_script(keys=keys, args=args) == 1
+        if written:
+            self.written += 1
+        else:
+            self.skipped += 1
+        return written
+
+    def lead(self):
+        """
+        takes or renews the lease of the collector that reports shared counters, e.g. the ingest accounting
+
+        :return: True if this collector holds the lease
+        """
+        return self.lease_script(keys=[lease_key], args=[self.name, self.lease_ttl]) == 1
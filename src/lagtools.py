@@ -0,0 +1,158 @@
+"""Congestion Wave Lag Utilities
+
+A slowdown on Rue Notre-Dame shows up at one station, then at the next one along the corridor a few minutes later. The
+delay between two adjacent stations is estimated from the cross-correlation of their speeds over a sliding window of
+the latest `window` minutes: the lag at which the correlation peaks is how long the wave took to travel the segment.
+
+Stations are ordered along the corridor as in corridortools.py, and their speeds are read from the shared grid of
+minutes (see gridtools.py), so the columns of every row are the same minutes. The cross-correlations of all segments
+are computed at once with FFTs over the rows of the matrix,
+
+    corr(a, b)[k] = irfft(conj(rfft(a)) * rfft(b))[k]
+
+zero padded to at least twice the window so that the correlation isn't circular, which costs O(window log window) per
+segment rather than O(window * lags) for correlating the series directly. The peak is refined below the minute with a
+parabola through its neighbours.
+
+The lags are produced by ../backend/workers/lag_worker.py once per minute and stored in redis:
+
+- lag:latest, json with the segments (pairs of detector ids, upstream first), their lag in minutes and the peak
+  correlation, of the latest window
+- lag:history, a list with the lags and correlations of every round, trimmed to the last `maxsize`
+
+A positive lag means the downstream station follows the upstream one. Segments whose peak correlation is weak don't
+carry a wave, their lag is noise and is stored as None.
+
+"""
+import json
+import numpy as np
+import rendertools
+
+latest_key = "lag:latest"
+history_key = "lag:history"
+
+
+def _fft_size(n):
+    size = 1
+    while size < n:
+        size *= 2
+    return size
+
+
+def standardize(matrix):
+    """
+    :param matrix (np.ndarray): ... x time, NaN where there is no reading
+    :return: the rows with their mean removed and scaled to unit variance, 0 where there was no reading or the row is
+    constant
+    """
+    seen = ~np.isnan(matrix)
+    count = seen.sum(axis=-1, keepdims=True)
+    mean = np.divide(np.where(seen, matrix, 0).sum(axis=-1, keepdims=True), count, out=np.zeros(count.shape),
+                     where=count > 0)
+    centered = np.where(seen, matrix - mean, 0)
+    std = np.sqrt(np.mean(centered ** 2, axis=-1, keepdims=True))
+    return np.divide(centered, std, out=np.zeros_like(centered), where=std > 0)
+
+
+def cross_correlation(upstream, downstream, max_lag):
+    """
+    normalized cross-correlation of every row of `upstream` with the same row of `downstream`
+
+    :param upstream (np.ndarray): ... x time, standardized, see standardize
+    :param downstream (np.ndarray): same shape
+    :param max_lag (int): largest lag in minutes, in both directions
+    :return: ... x (2 * max_lag + 1) array of the correlation at lags -max_lag to max_lag
+    """
+    n = upstream.shape[-1]
+    size = _fft_size(2 * n)
+    spectrum = np.conj(np.fft.rfft(upstream, size)) * np.fft.rfft(downstream, size)
+    corr = np.fft.irfft(spectrum, size)
+
+    # lag k compares upstream[t] with downstream[t + k], negative lags wrap around to the end
+    lags = np.arange(-max_lag, max_lag + 1)
+    return corr[..., lags % size] / n
+
+
+def estimate_lags(corr, max_lag, min_correlation=0.3):
+    """
+    :param corr (np.ndarray): ... x (2 * max_lag + 1), see cross_correlation
+    :param max_lag (int):
+    :param min_correlation (float): weaker peaks give NaN lags
+    :return: (lags in minutes, peak correlations), NaN lags where the peak is too weak
+    """
+    peak = np.argmax(corr, axis=-1)
+    best = np.take_along_axis(corr, peak[..., None], axis=-1)[..., 0]
+
+    # parabola through the peak and its neighbours, peaks on the edges aren't refined
+    left = np.take_along_axis(corr, np.clip(peak - 1, 0, None)[..., None], axis=-1)[..., 0]
+    right = np.take_along_axis(corr, np.clip(peak + 1, None, corr.shape[-1] - 1)[..., None], axis=-1)[..., 0]
+    curvature = left - 2 * best + right
+    inside = (peak > 0) & (peak < corr.shape[-1] - 1) & (curvature < 0)
+    shift = np.divide(left - right, 2 * curvature, out=np.zeros_like(best), where=inside)
+
+    lags = peak - max_lag + shift
+    return np.where(best >= min_correlation, lags, np.nan), best
+
+
+def segment_lags(matrix, max_lag=15, min_correlation=0.3):
+    """
+    lags between every pair of adjacent rows of `matrix`
+
+    :param matrix (np.ndarray): stations x minutes, rows ordered along the corridor, NaN where there is no reading
+    :param max_lag (int): largest lag in minutes
+    :param min_correlation (float): weaker peaks give NaN lags
+    :return: (lags, correlations) arrays with one entry per segment, len(matrix) - 1
+    """
+    standardized = standardize(matrix)
+    corr = cross_correlation(standardized[:-1], standardized[1:], max_lag)
+    return estimate_lags(corr, max_lag, min_correlation)
+
+
+def _rounded(values, decimals):
+    return [None if np.isnan(v) else round(v, decimals) for v in values.tolist()]
+
+
+def write_lags(db, segments, time, lags, correlations, window, maxsize=1440):
+    """
+    :param db: Redis instance from redis
+    :param segments (list): (upstream, downstream) detector ids of each segment
+    :param time (str): CreateUtc of the last minute of the window
+    :param lags (np.ndarray): lag of each segment in minutes, NaN where unknown
+    :param correlations (np.ndarray): peak correlation of each segment
+    :param window (int): minutes the lags were estimated over
+    :param maxsize (int): rounds kept in lag:history
+    :return:
+    """
+    entry = {"time": time, "lag": _rounded(lags, 2), "correlation": _rounded(correlations, 3)}
+
+    pipe = db.pipeline(transaction=False)
+    pipe.set(latest_key, json.dumps(dict(entry, window=window, segments=[list(s) for s in segments])))
+    pipe.rpush(history_key, json.dumps(entry))
+    pipe.ltrim(history_key, -maxsize, -1)
+    pipe.incr(rendertools.version_key)
+    pipe.execute()
+
+
+def read_lags(db, n=120):
+    """
+    :param db: Redis instance from redis
+    :param n (int): number of latest rounds of the history
+    :return: {"segments": [[upstream, downstream]], "window": minutes, "time": [CreateUtc], "lag": rounds x segments,
+    "correlation": rounds x segments}, with no rounds until the worker ran. rounds from before the segments last
+    changed are left out
+    """
+    pipe = db.pipeline(transaction=False)
+    pipe.get(latest_key)
+    pipe.lrange(history_key, -n, -1)
+    latest, history = pipe.execute()
+
+    if latest is None:
+        return {"segments": [], "window": None, "time": [], "lag": [], "correlation": []}
+    latest = json.loads(latest)
+    rounds = [r for r in map(json.loads, history) if len(r["lag"]) == len(latest["segments"])]
+
+    return {"segments": latest["segments"],
+            "window": latest["window"],
+            "time": [r["time"] for r in rounds],
+            "lag": [r["lag"] for r in rounds],
+            "correlation": [r["correlation"] for r in rounds]}
@@ -0,0 +1,225 @@
+"""Per-Lane Raw Reading Utilities
+
+The detectors' json series hold one reading per minute per detector, combined across lanes by the collector (see
+MinuteCombiner below). This module keeps the raw reading of every lane next to them, so lane level detail is kept and
+the way lanes are combined can be chosen when reading.
+
+The collector writes each (detector, lane, reading type) to its own fixed size ring of packed records:
+
+- lane:<det_id>:<lane>:<reading type>, a string of `ring` records of 8 bytes (int32 epoch seconds of the CreateUtc,
+  float32 reading), reading number i being written with SETRANGE at offset 8 * (i % ring)
+- lane:counts, a hash with the number of readings ever written to each ring, field <det_id>:<lane>:<reading type>
+
+Both go out in the pipeline of the reading itself, and neither ever needs to be trimmed.
+
+LaneDB reads all the rings of a reading type in one round trip and combines the lanes of each detector per timestamp
+with a vectorized mean, sum or max over all detectors at once. Results are cached per data version (the data:version
+counter of rendertools.py), so repeated queries between two sensor updates are free.
+
+The json series, minute grid, rollups and archive (backendtools.py, hatools.py, gridtools.py, archivetools.py) hold a
+single reading per detector and minute. MinuteCombiner combines the lanes of a detector into that reading as they
+arrive, the mean of the lanes for the speed and gap time and their sum for the count (`combined`), so all of them
+agree. Detectors with a single lane, such as the
+simulated ones, are unaffected.
+
+"""
+import struct
+import datetime
+import calendar
+import numpy as np
+import rendertools
+
+key_template = "lane:{}:{}:{}"
+counts_key = "lane:counts"
+record = np.dtype([("t", "<i4"), ("v", "<f4")])
+# packs a single record on the collector's message path, much cheaper than going through a numpy array
+packer = struct.Struct("<if")
+time_format = "%Y-%m-%dT%H:%M:%S"
+aggregations = ["mean", "sum", "max"]
+# how the lanes of a detector are combined into its reading of a minute, reading types not listed take the mean
+combined = {"vehicle-speed": "mean", "vehicle-gap-time": "mean", "vehicle-count": "sum"}
+
+
+def to_epoch(created):
+    return calendar.timegm(datetime.datetime.strptime(created[:19], time_format).timetuple())
+
+
+def from_epoch(seconds):
+    return datetime.datetime.utcfromtimestamp(int(seconds)).strftime(time_format)
+
+
+class MinuteCombiner:
+    def __init__(self, keep=3):
+        """
+        running sum and count of the lane readings of the latest minutes of each detector and reading type. A collector
+        restarted in the middle of a minute only combines the lanes it received
+
+        :param keep (int): minutes kept per detector and reading type, so that a lane reporting a minute late is still
+        combined with the others
+        """
+        self.keep = keep
+        self.minutes = {}
+
+    def update(self, det_id, subj, reading, minute):
+        """
+        :param det_id (str):
+        :param subj (str): reading type
+        :param reading (float): reading of one lane
+        :param minute (int): epoch seconds of the minute of the reading
+        :return: (reading of the detector for the minute from its lanes so far, number of lanes so far)
+        """
+        totals = self.minutes.get((det_id, subj))
+        if totals is None:
+            totals = self.minutes[(det_id, subj)] = {}
+
+        total = totals.get(minute)
+        if total is None:
+            total = totals[minute] = [0.0, 0]
+            if len(totals) > self.keep:
+                del totals[min(totals)]
+        total[0] += reading
+        total[1] += 1
+
+        if combined.get(subj) == "sum":
+            return total[0], total[1]
+        return total[0] / total[1], total[1]
+
+
+class LaneRecorder:
+    def __init__(self, db, ring=300):
+        """
+        :param db: Redis instance from redis, read once to resume the ring positions of a previous run
+        :param ring (int): readings kept per lane and reading type
+        """
+        self.ring = ring
+        self.counts = {k.decode(): int(v) for k, v in db.hgetall(counts_key).items()}
+
+    def update(self, pipe, det_id, lane, subj, reading, time):
+        """
+        queues the write of a raw lane reading on `pipe`
+
+        :param pipe: redis pipeline the reading itself is written with
+        :param det_id (str):
+        :param lane (str): e.g. "02" for det-00773-02
+        :param subj (str): reading type
+        :param reading (float):
+        :param time (str): CreateUtc of the reading
+        :return:
+        """
+        field = "{}:{}:{}".format(det_id, lane, subj)
+        count = self.counts.get(field, 0)
+
+        packed = packer.pack(to_epoch(time), reading)
+        pipe.setrange(key_template.format(det_id, lane, subj), record.itemsize * (count % self.ring), packed)
+        pipe.hset(counts_key, field, count + 1)
+        self.counts[field] = count + 1
+
+
+class LaneDB:
+    def __init__(self, db, ring=300, cache_size=8):
+        """
+        :param db: Redis instance from redis
+        :param ring (int): ring size the collector writes with
+        :param cache_size (int): number of query results kept for the current data version
+        """
+        self.db = db
+        self.ring = ring
+        self.cache_size = cache_size
+        self.cache = {}
+        self.cache_version = None
+
+    def lanes(self):
+        """
+        :return: {det_id: sorted list of lanes} of every detector with raw lane readings
+        """
+        lanes = {}
+        for field in self.db.hkeys(counts_key):
+            det_id, lane, _ = field.decode().split(":")
+            lanes.setdefault(det_id, set()).add(lane)
+        return {k: sorted(v) for k, v in lanes.items()}
+
+    def _read(self, value_type):
+        """
+        :return: (detector ids, detector index of each record, records) of every lane of `value_type`
+        """
+        counts = {}
+        for field, count in self.db.hgetall(counts_key).items():
+            det_id, lane, subj = field.decode().split(":")
+            if subj == value_type:
+                counts[(det_id, lane)] = int(count)
+
+        rings = sorted(counts)
+        pipe = self.db.pipeline(transaction=False)
+        for det_id, lane in rings:
+            pipe.get(key_template.format(det_id, lane, value_type))
+        raws = pipe.execute()
+
+        det_ids = sorted({det_id for det_id, _ in rings})
+        position = {det_id: i for i, det_id in enumerate(det_ids)}
+
+        chunks, owners = [], []
+        for (det_id, lane), raw in zip(rings, raws):
+            # only the first `count` records of a ring that hasn't wrapped yet hold readings
+            records = np.frombuffer(raw or b"", dtype=record)[:min(counts[(det_id, lane)], self.ring)]
+            chunks.append(records)
+            owners.append(np.full(len(records), position[det_id]))
+
+        if not chunks:
+            return det_ids, np.zeros(0, dtype=int), np.zeros(0, dtype=record)
+        return det_ids, np.concatenate(owners), np.concatenate(chunks)
+
+    def aggregate(self, value_type, how="mean", n=240):
+        """
+        combines the lanes of every detector per timestamp
+
+        :param value_type (str):
+        :param how (str): one of `aggregations`
+        :param n (int): number of latest timestamps kept per detector
+        :return: {det_id: {"time": [CreateUtc], value_type: [values]}}
+        """
+        if how not in aggregations:
+            raise ValueError("unknown aggregation {}, expected one of {}".format(how, aggregations))
+
+        version = self.db.get(rendertools.version_key)
+        if version is None or version != self.cache_version:
+            self.cache = {}
+            self.cache_version = version
+
+        query = (value_type, how, n)
+        if version is not None and query in self.cache:
+            return self.cache[query]
+
+        det_ids, owners, records = self._read(value_type)
+        if len(records) == 0:
+            return {det_id: {"time": [], value_type: []} for det_id in det_ids}
+
+        # one group per (detector, timestamp), in detector then time order
+        group_keys = (owners.astype(np.int64) << 32) | records["t"].astype(np.int64)
+        order = np.argsort(group_keys, kind="stable")
+        group_keys = group_keys[order]
+        values = records["v"][order].astype(np.float64)
+
+        starts = np.flatnonzero(np.r_[True, group_keys[1:] != group_keys[:-1]])
+        if how == "max":
+            combined = np.maximum.reduceat(values, starts)
+        else:
+            combined = np.add.reduceat(values, starts)
+            if how == "mean":
+                combined = combined / np.diff(np.r_[starts, len(values)])
+
+        group_owner = group_keys[starts] >> 32
+        group_time = group_keys[starts] & 0xffffffff
+        bounds = np.searchsorted(group_owner, np.arange(len(det_ids) + 1))
+
+        result = {}
+        for i, det_id in enumerate(det_ids):
+            lo = max(bounds[i], bounds[i + 1] - n)
+            hi = bounds[i + 1]
+            result[det_id] = {"time": [from_epoch(t) for t in group_time[lo:hi]],
+                              value_type: np.round(combined[lo:hi], 2).tolist()}
+
+        if version is not None:
+            if len(self.cache) >= self.cache_size:
+                self.cache.pop(next(iter(self.cache)))
+            self.cache[query] = result
+        return result
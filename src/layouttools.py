@@ -17,6 +17,9 @@ import dash_bootstrap_components as dbc
 import json
 import os
 import datetime
+import functools
+import spatialtools
+import gridtools
 
 class CustomTable:
     def __init__(self, config, card_title, target_card):
@@ -32,11 +35,21 @@ class CustomTable:
         self.table = None
         self.table_div = html.Div(id="table-div")
         self.df = None
+        self.flags = {}
+
+    def set_flags(self, flags):
+        """
+        :param flags (dict): {column name: list of bools, one per row} marking the cells to highlight as anomalous
+        """
+        self.flags = flags
 
     def set_data(self, df=None):
         if df is not None:
             self.df = df
         c = [{"name": i, "id": i} for i in self.df.columns]
+        highlighted = [{'if': {'row_index': i, 'column_id': col}, 'color': self.config['anomaly-color'],
+                        'fontWeight': 'bold'}
+                       for col, col_flags in self.flags.items() for i, f in enumerate(col_flags) if f]
         self.table = dash_table.DataTable(data=self.df.to_dict('records'),
                                           columns=c,
                                           id="table",
@@ -48,6 +61,7 @@ class CustomTable:
                                           cell_selectable=False,
                                           style_cell_conditional=[{'if': {'column_id': c}, 'textAlign': 'left'} for c in
                                                                   ['corner']],
+                                          style_data_conditional=highlighted,
                                           ),
 
         self.table_div.children = self.table
@@ -178,14 +192,24 @@ class CustomScatter:
         self.base_fig.add_trace(self.primary_fig)
         self.base_fig.add_trace(self.secondary_fig)
 
+        # dashed extensions drawn from the forecasts written by ../backend/workers/forecast_worker.py
+        self.base_fig.add_trace(self._make_forecast_fig("primary-forecast", "capcolor"))
+        self.base_fig.add_trace(self._make_forecast_fig("secondary-forecast", "comp-color-bright"))
+
         self.graph.figure = self.base_fig
 
+        # what the browser was last sent, so minute ticks can extend its traces instead of redrawing them
+        self.store = dcc.Store(id="scatter-sent")
+
         self.primary_data = None
         self.secondary_data = None
+        self.primary_forecast = None
+        self.secondary_forecast = None
         self.x = None
 
         self.start = None
         self.end = None
+        self.sent = None
 
     def set_unit(self, unit):
         self.unit = unit
@@ -202,6 +226,14 @@ class CustomScatter:
     def set_labels(self, labels):
         self.labels = labels
 
+    def set_forecasts(self, primary, secondary):
+        """
+        :param primary (tuple): (horizons in minutes, forecast values) for the primary station, or None
+        :param secondary (tuple): same for the secondary station
+        """
+        self.primary_forecast = primary
+        self.secondary_forecast = secondary
+
     def update_primary_fig(self, data):
         self.primary_data = data
         self.x = np.arange(len(data))
@@ -223,16 +255,22 @@ class CustomScatter:
                                     hovertemplate='Time: %{customdata}<br>Reading: %{y} ' + self.unit,
                                     )
 
-    def zoom_in(self, start, end):
+    def _window(self, start, end):
         end += 1
         end = min(end, len(self.primary_data))
+        return end, self.primary_data[start:end], self.secondary_data[start:end], self.labels[start:end]
+
+    def _forecasts_drawn(self, end, windowed_label):
+        # forecasts only make sense to extend the window when it reaches the latest reading
+        show = end == len(self.primary_data) and len(windowed_label) > 0
+        return [show and self.primary_forecast is not None, show and self.secondary_forecast is not None]
+
+    def zoom_in(self, start, end):
+        end, windowed_primary, windowed_secondary, windowed_label = self._window(start, end)
 
         self.start = start
         self.end = end
 
-        windowed_primary = self.primary_data[start:end]
-        windowed_secondary = self.secondary_data[start:end]
-        windowed_label = self.labels[start:end]
         windowed_x = np.arange(len(windowed_label))
 
         self.base_fig.update_traces(selector=dict(marker_color="#00a99d"),
@@ -247,6 +285,88 @@ class CustomScatter:
                                     customdata=windowed_label
                                     )
 
+        drawn = self._forecasts_drawn(end, windowed_label)
+        self._draw_forecast("primary-forecast", self.primary_forecast, windowed_x, windowed_primary, drawn[0])
+        self._draw_forecast("secondary-forecast", self.secondary_forecast, windowed_x, windowed_secondary, drawn[1])
+
+        self.sent = {"label": windowed_label[-1] if windowed_label else None,
+                     "x": len(windowed_label) - 1,
+                     "forecasts": drawn}
+
+    def extension(self, start, end, sent):
+        """
+        extendData update bringing a figure last drawn as described by `sent` up to the window [start, end] of the
+        current data, with just the readings that arrived since. Has to be called after the same set_labels,
+        update_primary_fig, update_secondary_fig and set_forecasts calls as zoom_in
+
+        :param start (int):
+        :param end (int):
+        :param sent (dict): the `sent` attribute after the zoom_in or extension that produced the figure
+        :return: ([data, trace indices, maxPoints], new sent dict), with no trace indices if there's nothing to update,
+        or None when only a full redraw can bring the figure up to date, e.g. when the last drawn reading is no longer
+        in the window
+        """
+        end, windowed_primary, windowed_secondary, windowed_label = self._window(start, end)
+
+        drawn = self._forecasts_drawn(end, windowed_label)
+        if sent["label"] not in windowed_label or drawn != sent["forecasts"]:
+            return None
+
+        p = len(windowed_label) - 1 - windowed_label[::-1].index(sent["label"])
+        new_x = list(range(sent["x"] + 1, sent["x"] + len(windowed_label) - p))
+        last_x = sent["x"] + len(new_x)
+
+        data = {"x": [], "y": [], "customdata": []}
+        indices = []
+        max_points = []
+
+        # maxPoints caps each trace to the window length, so the oldest readings slide out as new ones come in
+        if new_x:
+            data = {"x": [new_x, new_x],
+                    "y": [windowed_primary[p + 1:], windowed_secondary[p + 1:]],
+                    "customdata": [windowed_label[p + 1:], windowed_label[p + 1:]]}
+            indices = [0, 1]
+            max_points = [len(windowed_label), len(windowed_label)]
+
+        # a forecast trace is replaced by extending it with as many points as it holds
+        forecasts = [(2, self.primary_forecast, windowed_primary), (3, self.secondary_forecast, windowed_secondary)]
+        for (i, forecast, values), show in zip(forecasts, drawn):
+            if show:
+                x, y, labels = self._forecast_points(forecast, last_x, values[-1])
+                data["x"].append(x)
+                data["y"].append(y)
+                data["customdata"].append(labels)
+                indices.append(i)
+                max_points.append(len(x))
+
+        sent = {"label": windowed_label[-1], "x": last_x, "forecasts": drawn}
+        return [data, indices, max_points], sent
+
+    def _draw_forecast(self, name, forecast, windowed_x, windowed_values, show):
+        if not show:
+            x, y, labels = [], [], []
+        else:
+            x, y, labels = self._forecast_points(forecast, int(windowed_x[-1]), windowed_values[-1])
+
+        self.base_fig.update_traces(selector=dict(name=name), x=x, y=y, customdata=labels)
+
+    def _forecast_points(self, forecast, last_x, last_value):
+        horizons, values = forecast
+        x = [last_x] + [last_x + h for h in horizons]
+        y = [last_value] + list(values)
+        labels = ["latest reading"] + ["+{} min".format(h) for h in horizons]
+        return x, y, labels
+
+    def _make_forecast_fig(self, name, linecolor_key):
+        fig = go.Scatter(
+            mode="lines",
+            line=dict(color=self.config[linecolor_key], dash="dash"),
+            hovertemplate='Forecast: %{customdata}<br>Reading: %{y}<extra></extra>',
+            name=name
+        )
+
+        return fig
+
     def _make_fig(self, linecolor_key, markercolor_key):
         fig = go.Scatter(
             textfont_color=self.config["textcolor"],
@@ -276,16 +396,27 @@ class CustomBar:
         self.card.children = [self.cardheader, self.graph]
         self.fig = None
 
-    def set_data(self, values, names, unit):
+    def set_data(self, values, names, unit, flags=None):
+        """
+        :param values (list): latest reading of each detector
+        :param names (list): station names shown as tick labels
+        :param unit (str):
+        :param flags (list): optional anomaly flag of each detector, flagged bars are drawn in the config's anomaly-color
+        :return:
+        """
         x = np.arange(len(values))
         cap = np.ones(len(values)) * self.config['capsize'] * np.max(values)
         threshold = 0.2 * np.max(values)
         inside_ticktext = [str(i) + " " + unit if i > threshold else "" for i in values]
         outside_ticktext = [str(i) + " " + unit if i <= threshold else "" for i in values]
 
+        barcolor = self.config['barcolor']
+        if flags is not None:
+            barcolor = [self.config['anomaly-color'] if f else self.config['barcolor'] for f in flags]
+
         self.fig = px.bar(x=x, y=values)
-        self.fig.update_traces(marker_color=self.config['barcolor'],
-                               marker_line_color=self.config['barcolor'],
+        self.fig.update_traces(marker_color=barcolor,
+                               marker_line_color=barcolor,
                                text=inside_ticktext,
                                textposition="outside",
                                textfont_color=self.config["textcolor"],
@@ -319,6 +450,181 @@ class CustomBar:
         self.graph.figure = self.fig
 
 
+class CustomHeatmap:
+    def __init__(self, config, card_title, target_card, graph_id="heatmap-graph", controls=None):
+        """
+        wrapper class for a plotly Heatmap of a reading type of every station over time, one row per station, so that
+        patterns moving along the corridor (e.g. congestion waves) show up as diagonals. Integrates display and update
+        logic
+        :param config (dict): key-value parameters to control plot appearance. see example in ./assets/bar_config.json
+        :param card_title (str): title of the card that contains this plot
+        :param target_card (Card): dash-bootstrap-component Card that this plot appears on
+        :param graph_id (str): unique id associated with the underlying html element that the plot appears on
+        :param controls: optional layout shown left of the reading type dropdown, e.g. ReplayControls.layout
+        """
+        self.config = config
+        self.card = target_card
+        self.cardheader = make_header(card_title, config)
+        self.graph = dcc.Graph(className="graphs", id=graph_id)
+        self.dropdown = dcc.Dropdown(
+            id="drop-heat",
+            value="speed",
+            options=[{"label": o, "value": o} for o in ["speed", "count", "gap time"]],
+            clearable=False,
+        )
+        if controls is None:
+            row = dbc.Row(dbc.Col(self.dropdown, width={"size": 2, "offset": 10}))
+        else:
+            row = dbc.Row([dbc.Col(controls, width=10), dbc.Col(self.dropdown, width=2)])
+        self.card.children = [self.cardheader, row, self.graph]
+        self.fig = None
+
+    def set_data(self, values, labels, names, unit):
+        """
+        :param values (ndarray): stations x time buckets, NaN where a station has no reading
+        :param labels (list): CreateUtc of each time bucket
+        :param names (list): station names, one per row of `values`
+        :param unit (str):
+        :return:
+        """
+        # one decimal is plenty for colors and keeps the payload of hundreds of stations small
+        z = np.round(values, 1)
+
+        self.fig = go.Figure(go.Heatmap(
+            z=z,
+            x=labels,
+            y=names,
+            colorscale=[[0, self.config["bgcolor"]], [0.5, self.config["barcolor"]], [1, self.config["capcolor"]]],
+            hoverongaps=False,
+            colorbar=dict(title=unit, tickfont=dict(color=self.config["textcolor"])),
+            hovertemplate="%{y}<br>%{x}<br>%{z} " + unit + "<extra></extra>",
+        ))
+        self.fig.update_layout(margin=self.config["margin"],
+                               paper_bgcolor=self.config["bgcolor"],
+                               plot_bgcolor=self.config["bgcolor"],
+                               font_color=self.config["textcolor"],
+                               xaxis=dict(showgrid=False, nticks=12),
+                               yaxis=dict(showgrid=False, autorange="reversed"))
+        self.graph.figure = self.fig
+
+
+class CustomLagChart:
+    def __init__(self, config, card_title, target_card, graph_id="lag-graph"):
+        """
+        wrapper class for a plotly Heatmap of the lag of every segment of the corridor over the latest rounds of
+        ../backend/workers/lag_worker.py, one row per segment in their order along the corridor, so that a wave shows
+        up as the same lag moving down the rows. Integrates display and update logic
+        :param config (dict): key-value parameters to control plot appearance. see example in ./assets/bar_config.json
+        :param card_title (str): title of the card that contains this plot
+        :param target_card (Card): dash-bootstrap-component Card that this plot appears on
+        :param graph_id (str): unique id associated with the underlying html element that the plot appears on
+        """
+        self.config = config
+        self.card = target_card
+        self.cardheader = make_header(card_title, config)
+        self.graph = dcc.Graph(className="graphs", id=graph_id)
+        self.card.children = [self.cardheader, self.graph]
+        self.fig = None
+
+    def set_data(self, lags, correlations, labels, names):
+        """
+        :param lags (list): rounds x segments, lag in minutes or None where the segment carried no wave
+        :param correlations (list): rounds x segments, peak correlation
+        :param labels (list): CreateUtc of each round
+        :param names (list): name of each segment
+        :return:
+        """
+        z = np.array(lags, dtype=float).reshape(len(labels), len(names)).T
+        corr = np.array(correlations, dtype=float).reshape(len(labels), len(names)).T
+
+        self.fig = go.Figure(go.Heatmap(
+            z=z,
+            x=labels,
+            y=names,
+            customdata=corr,
+            zmid=0,
+            colorscale=[[0, self.config["capcolor"]], [0.5, self.config["bgcolor"]], [1, self.config["barcolor"]]],
+            hoverongaps=False,
+            colorbar=dict(title="min", tickfont=dict(color=self.config["textcolor"])),
+            hovertemplate="%{y}<br>%{x}<br>%{z:.1f} min, correlation %{customdata:.2f}<extra></extra>",
+        ))
+        self.fig.update_layout(margin=self.config["margin"],
+                               paper_bgcolor=self.config["bgcolor"],
+                               plot_bgcolor=self.config["bgcolor"],
+                               font_color=self.config["textcolor"],
+                               xaxis=dict(showgrid=False, nticks=12),
+                               yaxis=dict(showgrid=False, autorange="reversed"))
+        self.graph.figure = self.fig
+
+
+class ReplayControls:
+    speeds = [1, 10, 60, 300]
+
+    def __init__(self, config, bounds, interval=500):
+        """
+        controls of the time-travel replay, see replaytools.py: a slider to scrub to any minute the archive holds,
+        play/pause, the playback speed and a button back to the live readings. The playhead is kept in the
+        replay-state Store, advanced by the replay-interval while playing
+        :param config (dict): key-value parameters to control plot appearance. see example in ./assets/bar_config.json
+        :param bounds (tuple): (first, last) epoch seconds the archive holds, None while it's empty
+        :param interval (int): milliseconds between two frames while playing
+        """
+        self.config = config
+        self.interval = interval
+        self.slider = dcc.Slider(id="replay-slider", step=1, updatemode="mouseup")
+        self.set_bounds(bounds)
+        self.slider.value = self.slider.max
+
+        self.play = dbc.Button("play", id="replay-play", size="sm")
+        self.live = dbc.Button("live", id="replay-live", size="sm", style={"marginLeft": "4px"})
+        self.speed = dcc.Dropdown(
+            id="replay-speed",
+            value=60,
+            options=[{"label": "{}x".format(s), "value": s} for s in self.speeds],
+            clearable=False,
+        )
+        self.position = html.Span("live", id="replay-position",
+                                  style={"color": self.config["textcolor"], "fontSize": "0.65rem"})
+
+        self.layout = dbc.Row([
+            dbc.Col([self.play, self.live], width=3),
+            dbc.Col(self.speed, width=2),
+            dbc.Col(self.slider, width=5),
+            dbc.Col(self.position, width=2)
+        ])
+
+        self.store = dcc.Store(id="replay-state", data={"time": None, "playing": False, "speed": 60})
+        self.timer = dcc.Interval(id="replay-interval", interval=self.interval, n_intervals=0, disabled=True)
+
+    def set_bounds(self, bounds):
+        """
+        :param bounds (tuple): (first, last) epoch seconds the archive holds, None while it's empty
+        :return: min, max and marks of the slider, whose values are epoch minutes
+        """
+        if bounds is None:
+            now = int(datetime.datetime.now().timestamp())
+            bounds = (now, now)
+        first, last = bounds[0] // 60, bounds[1] // 60
+        marks = {int(m): datetime.datetime.utcfromtimestamp(int(m) * 60).strftime("%m-%d")
+                 for m in np.linspace(first, last, 5)} if last > first else {}
+
+        self.slider.min = first
+        self.slider.max = last
+        self.slider.marks = marks
+        return first, last, marks
+
+    def describe(self, state, utc):
+        """
+        :param state (dict): data of the replay-state Store
+        :param utc (str): CreateUtc of the frame shown
+        :return: text of the replay-position span
+        """
+        if state is None or state["time"] is None:
+            return "live"
+        playback = "{}x".format(state["speed"]) if state["playing"] else "paused"
+        return "{} {}".format(utc.replace("T", " ")[5:16], playback)
+
+
 class CountdownSpinner:
     def __init__(self, config, card_title, target_card, graph_id):
         """
@@ -379,8 +685,12 @@ class TimeStamp:
         self.card = target_card
         self.cardheader = make_header(card_title, config)
         self.stamp = ""
+        self.corridor_stamp = ""
         self.text = html.H4(children=self.stamp, id="timestamp-text", style={"textAlign": "center", "height": "100%"})
-        self.card.children = [self.cardheader, html.Div(self.text, style={"margin": "auto"})]
+        self.corridor_text = html.P(children=self.corridor_stamp, id="corridor-text",
+                                    style={"textAlign": "center", "color": self.config["textcolor"],
+                                           "fontSize": "0.65rem", "marginBottom": 0})
+        self.card.children = [self.cardheader, html.Div([self.text, self.corridor_text], style={"margin": "auto"})]
 
     def update_time(self, newstamp):
         # newstamp = frontend_utils.date_convert(newstamp)
@@ -388,6 +698,15 @@ class TimeStamp:
         newstamp = newstamp.strftime("%H:%M:%S")
         self.stamp = newstamp
 
+    def update_corridor(self, total_seconds):
+        """
+        :param total_seconds (list): latest total travel time along the corridor, empty until every segment has one
+        """
+        if total_seconds:
+            self.corridor_stamp = "Notre-Dame corridor travel time: {:.1f} min".format(total_seconds[-1] / 60)
+        else:
+            self.corridor_stamp = ""
+
 
 class LeftColumn:
     def __init__(self):
@@ -428,8 +747,10 @@ class RightColumn:
         stat4 = dbc.Row(card(), className="substat-row", id="stat-4")
         mapp = MapPane()
         hist = HistoricPlot()
+        heat = HeatmapPlot()
+        lag = LagPlot()
         self.subpanels = [title.get_layout(), stat2, stat3, stat4, mapp.get_layout(),
-                          hist.get_layout()]
+                          hist.get_layout(), heat.get_layout(), lag.get_layout()]
 
         self.layout = dbc.Col([
             dbc.Row([
@@ -449,7 +770,9 @@ class RightColumn:
                     width=7),
                 mapp.get_layout(),
             ], className="title-stat-map-row"),
-            hist.get_layout()
+            hist.get_layout(),
+            heat.get_layout(),
+            lag.get_layout()
         ],
             className='full-vh-cols')
 
@@ -486,6 +809,28 @@ class HistoricPlot:
         return self.layout
 
 
+class HeatmapPlot:
+    def __init__(self):
+        """
+        utility class for grouping the layout elements of the heatmap of all stations, below the historic scatter plot
+        """
+        self.layout = dbc.Row(card(), className="heatmap-plot", id="heat-pane")
+
+    def get_layout(self):
+        return self.layout
+
+
+class LagPlot:
+    def __init__(self):
+        """
+        utility class for grouping the layout elements of the lags between adjacent stations, below the heatmap
+        """
+        self.layout = dbc.Row(card(), className="lag-plot", id="lag-pane")
+
+    def get_layout(self):
+        return self.layout
+
+
 class TitlePane:
     """
     utility class for grouping the layout elements of the title the dashboard
@@ -515,16 +860,39 @@ def init_layout():
     return layout, left_column, right_column
 
 
-def init_map(df):
+@functools.lru_cache(maxsize=None)
+def load_map_token():
+    """
+    the Mapbox access token, read from ../frontend/cred/mpbx.txt once per process. None if the file is missing, in
+    which case the map is drawn without its Mapbox tiles
+    """
     curdir = os.path.dirname(__file__)
     basedir = os.path.abspath(os.path.join(curdir, os.pardir))
     creddir = os.path.join(basedir, "frontend/cred")
 
-    with open(os.path.join(creddir, "mpbx.txt"), "r") as f:
-        token = f.readline()
+    try:
+        with open(os.path.join(creddir, "mpbx.txt"), "r") as f:
+            return f.readline().strip()
+    except FileNotFoundError:
+        print("no Mapbox token found in {}, map tiles won't load".format(creddir))
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def load_map_config():
+    """
+    map appearance parameters from ../frontend/assets/mapdata.json, read once per process
+    """
+    curdir = os.path.dirname(__file__)
+    basedir = os.path.abspath(os.path.join(curdir, os.pardir))
+
+    with open(os.path.join(basedir, "frontend/assets/mapdata.json"), "r") as f:
+        return json.load(f)
 
-    with open("assets/mapdata.json", "r") as f:
-        mdata = json.load(f)
+
+def init_map(df):
+    token = load_map_token()
+    mdata = load_map_config()
 
     px.set_mapbox_access_token(token)
 
@@ -552,15 +920,75 @@ def init_map(df):
                                   color=mcolor
                                   ),
                       mode="markers+text",
-                      text=["station {}".format(i + 1) for i in range(9)],
+                      text=["station {}".format(i + 1) for i in range(len(df))],
                       textposition="middle right",
                       textfont_color="#ffffff"
                       )
-    fig.update_layout(margin=dict(l=16, r=16, t=16, b=16))
+
+    # keeps the user's pan and zoom when the markers are updated
+    fig.update_layout(margin=dict(l=16, r=16, t=16, b=16), uirevision="map")
 
     return fig, mdata
 
 
+class LiveMap:
+    def __init__(self, df):
+        """
+        wrapper around the detector map that colors the markers by live speed and sizes them by live count. Only the
+        detectors inside the current viewport, found with a spatial grid index, are sent to the browser, and on a
+        refresh only their colors and sizes are: the figure itself is patched client-side by the clientside callback
+        registered in callbackcollection.py from the payload in the map-markers Store
+        :param df (DataFrame): detector datasheet, rows in the same order as RedisDB.keys
+        """
+        self.df = df
+        self.fig, self.mdata = init_map(df)
+        self.fig.update_traces(marker=dict(colorscale=self.mdata.get("colorscale", "RdYlGn"),
+                                           cmin=self.mdata.get("speed-min", 0),
+                                           cmax=self.mdata.get("speed-max", 80),
+                                           showscale=False))
+
+        self.lats = df["latitude"].values.tolist()
+        self.lons = df["longitude"].values.tolist()
+        self.labels = ["station {}".format(i + 1) for i in range(len(df))]
+        self.names = df["corner_st2"].values.tolist()
+        self.index = spatialtools.GridIndex(self.lats, self.lons)
+        self.store = dcc.Store(id="map-markers")
+
+    def visible(self, relayout_data):
+        """
+        :param relayout_data (dict): relayoutData of the map graph
+        :return: indices of the detectors inside the viewport, all of them while it's unknown
+        """
+        bounds = spatialtools.viewport_bounds(relayout_data)
+        if bounds is None:
+            return self.index.all()
+        return self.index.query(*bounds)
+
+    def markers(self, visible, speeds, counts, with_positions):
+        """
+        payload for the map-markers Store
+
+        :param visible (list): indices of the detectors to draw
+        :param speeds (list): latest speed of every detector, None for detectors without readings yet
+        :param counts (list): latest count of every detector, or None
+        :param with_positions (bool): include coordinates and labels, only needed when the visible set changes
+        :return: dict
+        """
+        base = self.mdata["marker-size"]
+        counts = [counts[i] or 0 for i in visible]
+        top = max(counts + [1])
+
+        payload = {"color": [speeds[i] for i in visible],
+                   "size": [round(base * (0.5 + c / top), 1) for c in counts]}
+
+        if with_positions:
+            payload.update({"lat": [self.lats[i] for i in visible],
+                            "lon": [self.lons[i] for i in visible],
+                            "text": [self.labels[i] for i in visible],
+                            "hovertext": [self.names[i] for i in visible]})
+        return payload
+
+
 def make_title():
     intro_desc = html.P(
         [
@@ -667,10 +1095,9 @@ def make_modal(plot_config, stations):
 
 
 def init_scatter(scatter, slider, dropdown, db, n, stations, config):
-    hist_data = db.n_latest_readings("vehicle-speed", n)
-    n = len(hist_data[0])
-
-    hist_utc = db.n_latest_readings("time", n)[0]
+    hist_grid = db.grid("vehicle-speed", n)
+    hist_data = gridtools.as_lists(hist_grid["values"], hist_grid["mask"])
+    hist_utc = hist_grid["time"]
     hist_dict = {s: l for s, l in zip(stations, hist_data)}
 
     primary_values = hist_dict["station 1"]
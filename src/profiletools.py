@@ -0,0 +1,189 @@
+"""Collector Profiling Utilities
+
+Lightweight instrumentation for the mqtt collectors. StageTimers keeps always-on wall time and call counters for each
+stage of the message path in backendtools.on_message (payload decoding, topic parsing, json (de)serialization, redis
+i/o) so it's possible to tell which one is to blame when a collector falls behind. It costs one perf_counter call and a
+few dict updates per stage.
+
+OnDemandProfiler captures a full cProfile of the collector for N seconds when asked to, either by a signal (SIGUSR1 by
+default, e.g. 'kill -USR1 <pid>') or by publishing the number of seconds to the control topic, and dumps the stats to
+disk for inspection with pstats or snakeviz, all without restarting the collector.
+
+The control topic lives on the same public broker as the readings, so anyone can publish to it. The collectors only
+subscribe to it when started with --profile-topic, payloads that aren't a number of seconds are ignored and durations
+are capped at `max_seconds`.
+
+"""
+import os
+import json
+import time
+import signal
+import cProfile
+import datetime
+
+control_topic = "mtl-realtime-traffic/collector/profile"
+
+
+class StageTimers:
+    def __init__(self, report_every=60):
+        """
+        accumulates the number of calls, total and maximum wall time of named stages
+
+        :param report_every (float): seconds between the summaries returned by due()
+        """
+        self.report_every = report_every
+        self.counts = {}
+        self.totals = {}
+        self.maxima = {}
+        self.last_report = time.perf_counter()
+        self.started = None
+        self.mark = None
+
+    def start(self):
+        """
+        marks the beginning of a message, the following lap() calls time consecutive stages from here
+        """
+        self.started = self.mark = time.perf_counter()
+
+    def lap(self, stage):
+        """
+        adds the time since the previous lap (or start) to `stage`
+        """
+        now = time.perf_counter()
+        self.add(stage, now - self.mark)
+        self.mark = now
+
+    def stop(self):
+        """
+        adds the time since start() to the "total" stage
+        """
+        self.add("total", time.perf_counter() - self.started)
+
+    def add(self, stage, seconds):
+        if stage in self.counts:
+            self.counts[stage] += 1
+            self.totals[stage] += seconds
+            if seconds > self.maxima[stage]:
+                self.maxima[stage] = seconds
+        else:
+            self.counts[stage] = 1
+            self.totals[stage] = seconds
+            self.maxima[stage] = seconds
+
+    def summary(self):
+        """
+        :return: {stage: {"count": int, "total_ms": float, "mean_us": float, "max_us": float}}
+        """
+        summary = {}
+        for stage, count in self.counts.items():
+            summary[stage] = {"count": count,
+                              "total_ms": 1e3 * self.totals[stage],
+                              "mean_us": 1e6 * self.totals[stage] / count,
+                              "max_us": 1e6 * self.maxima[stage]}
+        return summary
+
+    def reset(self):
+        self.counts = {}
+        self.totals = {}
+        self.maxima = {}
+
+    def due(self):
+        now = time.perf_counter()
+        if now - self.last_report >= self.report_every:
+            self.last_report = now
+            return True
+        return False
+
+    def report(self, db=None, key="collector:stages"):
+        """
+        prints the per-stage summary since the last reset() and, given a Redis instance, writes it as json under
+        `key` so it can be read without attaching to the collector's terminal
+
+        :param db: Redis instance from redis
+        :param key (str):
+        :return:
+        """
+        summary = self.summary()
+        for stage, s in summary.items():
+            print("stage {:<12} {:>9} calls  {:>9.1f} us mean  {:>9.1f} us max".format(
+                stage, s["count"], s["mean_us"], s["max_us"]))
+
+        if db is not None:
+            db.set(key, json.dumps(summary))
+
+
+class OnDemandProfiler:
+    def __init__(self, outdir="profiles", default_seconds=30, max_seconds=120):
+        """
+        captures a cProfile of the thread that runs the mqtt loop for a limited time. Profiling is started by
+        request() and stopped, with the stats dumped to `outdir`, by the first tick() after the deadline
+
+        :param outdir (str): directory the .prof files are written to
+        :param default_seconds (float): duration used when a request doesn't specify one
+        :param max_seconds (float): longest duration accepted from the control topic
+        """
+        self.outdir = outdir
+        self.default_seconds = default_seconds
+        self.max_seconds = max_seconds
+        self.profile = None
+        self.deadline = None
+
+    def request(self, seconds=None):
+        if self.profile is not None:
+            return
+
+        if seconds is None:
+            seconds = self.default_seconds
+
+        self.deadline = time.perf_counter() + seconds
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        print("profiling collector for {} s".format(seconds))
+
+    def tick(self):
+        if self.profile is None or time.perf_counter() < self.deadline:
+            return None
+
+        self.profile.disable()
+        os.makedirs(self.outdir, exist_ok=True)
+        fname = os.path.join(self.outdir, "collector-{}.prof".format(datetime.datetime.now().strftime("%Y%m%d-%H%M%S")))
+        self.profile.dump_stats(fname)
+        self.profile = None
+        print("profile written to {}".format(fname))
+        return fname
+
+    def handle_control(self, payload):
+        """
+        starts profiling for the number of seconds published on the control topic, or the default if empty. The
+        topic is public, anything that isn't a positive number of seconds is ignored and longer durations are capped at
+        max_seconds, the message is dropped rather than raising into the mqtt loop
+
+        :param payload (bytes): raw payload of the control message
+        :return:
+        """
+        try:
+            payload = payload.decode().strip()
+            seconds = float(payload) if payload else self.default_seconds
+        except (UnicodeDecodeError, ValueError):
+            print("ignored profiling request {!r}".format(payload[:32]))
+            return
+
+        if not seconds > 0:
+            print("ignored profiling request {!r}".format(payload[:32]))
+            return
+        self.request(min(seconds, self.max_seconds))
+
+    def install_signal(self, signum=None):
+        """
+        starts profiling when the process receives `signum` (SIGUSR1 by default, where available). Must be called
+        from the main thread, which is also where client.loop_forever() runs the on_message callbacks
+
+        :param signum:
+        :return:
+        """
+        if signum is None:
+            signum = getattr(signal, "SIGUSR1", None)
+        if signum is None:
+            return
+
+        signal.signal(signum, lambda *_: self.request())
@@ -0,0 +1,142 @@
+"""Redis Connection Utilities
+
+One place to configure how every part of the project connects to redis, instead of each script opening its own
+`redis.Redis()` with a hard-coded host and port. Settings come from the arguments when given, otherwise from the
+environment, otherwise from the defaults below:
+
+    MTL_REDIS_HOST             localhost
+    MTL_REDIS_PORT             6379
+    MTL_REDIS_DB               0
+    MTL_REDIS_MAX_CONNECTIONS  16      size of the connection pool shared by all threads of a process
+    MTL_REDIS_POOL_TIMEOUT     5       seconds a thread waits for a free connection before raising
+    MTL_REDIS_LOCAL_CACHE      0       1 to enable the dashboard's client-side cache, see LocalCache
+
+Clients of a process share one bounded, blocking connection pool per (host, port, db), so the Dash request threads
+never open more than MTL_REDIS_MAX_CONNECTIONS connections between them.
+
+LocalCache keeps decoded values in process memory and drops a key as soon as redis announces it changed, through
+keyspace notifications (redis-py 3.5 has no RESP3 client tracking). Reads of unchanged keys then never leave the
+process.
+
+"""
+import os
+import functools
+import threading
+import redis
+
+defaults = {"host": "localhost", "port": 6379, "db": 0, "max_connections": 16, "pool_timeout": 5, "local_cache": 0}
+
+
+def setting(name, value=None):
+    """
+    :param name (str): key of `defaults`
+    :param value: value given explicitly, takes precedence when not None
+    :return: the value, the MTL_REDIS_<NAME> environment variable or the default, with the type of the default
+    """
+    if value is not None:
+        return value
+
+    env = os.environ.get("MTL_REDIS_" + name.upper())
+    if env is None:
+        return defaults[name]
+    return type(defaults[name])(env)
+
+
+@functools.lru_cache(maxsize=None)
+def _pool(host, port, dbid, max_connections, pool_timeout):
+    return redis.BlockingConnectionPool(host=host, port=port, db=dbid, max_connections=max_connections,
+                                        timeout=pool_timeout)
+
+
+def connect(host=None, port=None, dbid=None, max_connections=None):
+    """
+    :return: Redis client on the process wide connection pool of (host, port, dbid)
+    """
+    pool = _pool(setting("host", host), setting("port", port), setting("db", dbid),
+                 setting("max_connections", max_connections), setting("pool_timeout"))
+    return redis.Redis(connection_pool=pool)
+
+
+class LocalCache:
+    def __init__(self, db, decode=None):
+        """
+        client-side cache of string keys, invalidated by keyspace notifications
+
+        :param db: Redis instance from redis
+        :param decode (callable): applied once to the raw value of a key before it's cached, e.g. json.loads. the
+        decoded values are shared between callers, who must not modify them
+        """
+        self.db = db
+        self.decode = decode if decode is not None else (lambda raw: raw)
+        self.values = {}
+        self.invalidations = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.active = False
+        self.thread = None
+
+        dbid = db.connection_pool.connection_kwargs.get("db", 0)
+        self.prefix = "__keyspace@{}__:".format(dbid)
+
+        try:
+            # K: keyspace events, g: del/expire/rename..., $: string commands (set), x: expired
+            db.config_set("notify-keyspace-events", "Kg$x")
+            self.pubsub = db.pubsub()
+            self.pubsub.psubscribe(**{self.prefix + "*": self._invalidate})
+
+            # nothing may be cached before redis confirms the subscription, or a change could go unannounced
+            confirmed = None
+            for _ in range(5):
+                confirmed = self.pubsub.get_message(timeout=1)
+                if confirmed is not None and confirmed["type"] == "psubscribe":
+                    break
+            else:
+                self.pubsub.close()
+                raise redis.RedisError("subscription to {}* wasn't confirmed".format(self.prefix))
+            self.thread = self.pubsub.run_in_thread(sleep_time=0.1, daemon=True)
+            self.active = True
+        except redis.RedisError as e:
+            # e.g. a managed redis refusing CONFIG SET, reads then simply always go to redis
+            print("client-side cache disabled, keyspace notifications unavailable: {}".format(e))
+
+    def _invalidate(self, message):
+        key = message["channel"][len(self.prefix):]
+        with self.lock:
+            self.values.pop(key, None)
+            self.invalidations[key] = self.invalidations.get(key, 0) + 1
+
+    def mget(self, keys):
+        """
+        :param keys (list): str keys
+        :return: list with the decoded value of each key, None where the key doesn't exist
+        """
+        if not self.active or not self.thread.is_alive():
+            return [None if raw is None else self.decode(raw) for raw in self.db.mget(keys)]
+
+        with self.lock:
+            cached = [self.values.get(k.encode()) for k in keys]
+            missing = [k for k, v in zip(keys, cached) if v is None]
+            seen = {k: self.invalidations.get(k.encode(), 0) for k in missing}
+
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if not missing:
+            return cached
+
+        fetched = {}
+        for k, raw in zip(missing, self.db.mget(missing)):
+            fetched[k] = None if raw is None else self.decode(raw)
+
+        with self.lock:
+            for k, value in fetched.items():
+                # a change announced while the value was being read means it may already be stale, don't keep it
+                if value is not None and self.invalidations.get(k.encode(), 0) == seen[k]:
+                    self.values[k.encode()] = value
+
+        return [fetched[k] if v is None else v for k, v in zip(keys, cached)]
+
+    def close(self):
+        if self.thread is not None:
+            self.thread.stop()
+        self.active = False
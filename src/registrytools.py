@@ -0,0 +1,94 @@
+"""Detector Registry Utilities
+
+Lets the collectors discover detectors instead of only knowing the ones listed in the datasheets. With a single
+wildcard subscription to every detector topic, the first reading of an unseen detector registers it:
+
+- its id is added to the registry:detectors set, which drives the dashboard's station lists
+- its readings key is created lazily with the empty data template (SET NX, so existing data is never overwritten)
+- its metadata (corner streets, coordinates, camera) is copied to the meta:<det_id> hash when the datasheet has a row
+  for it
+
+Known detectors are cached in memory, so after the first reading a detector costs one set lookup per message.
+
+"""
+import json
+
+registry_key = "registry:detectors"
+meta_template = "meta:{}"
+meta_columns = ["corner_st1", "corner_st2", "latitude", "longitude", "id_camera"]
+
+
+class DetectorRegistry:
+    def __init__(self, db, data_template, metadata=None):
+        """
+        :param db: Redis instance from redis
+        :param data_template (dict): empty readings structure a new detector's key is initialized with
+        :param metadata (list): datasheet records with an id key, used to enrich newly registered detectors, see
+        sheettools.records
+        """
+        self.db = db
+        self.data_template = json.dumps(data_template)
+        self.metadata = {}
+        if metadata is not None:
+            for row in metadata:
+                self.metadata[row["id"]] = {c: str(row[c]) for c in meta_columns if row.get(c) is not None}
+
+        self.known = {k.decode() for k in db.smembers(registry_key)}
+
+    def ensure(self, det_id):
+        """
+        registers `det_id` on its first reading
+
+        :param det_id (str):
+        :return: True if the detector was new
+        """
+        if det_id in self.known:
+            return False
+
+        pipe = self.db.pipeline(transaction=False)
+        pipe.sadd(registry_key, det_id)
+        pipe.set(det_id, self.data_template, nx=True)
+        if det_id in self.metadata:
+            pipe.hset(meta_template.format(det_id), mapping=self.metadata[det_id])
+        pipe.execute()
+
+        self.known.add(det_id)
+        print("registered detector {}".format(det_id))
+        return True
+
+    def register_all(self, det_ids):
+        for det_id in det_ids:
+            self.ensure(det_id)
+
+
+def read_registry(db):
+    """
+    :param db: Redis instance from redis
+    :return: sorted list of registered detector ids, empty if no collector ran with a registry
+    """
+    return sorted(k.decode() for k in db.smembers(registry_key))
+
+
+def detector_keys(db):
+    """
+    :param db: Redis instance from redis
+    :return: sorted detector ids, from the registry or else from the keys. keys holding anything other than a
+    detector's readings, e.g. the collector's collector:stages summary, are namespaced with a colon. SCAN rather than
+    KEYS, which would block the collector's writes while it walks the whole keyspace
+    """
+    keys = read_registry(db)
+    if not keys:
+        keys = sorted(k.decode() for k in db.scan_iter(count=1000) if b":" not in k)
+    return keys
+
+
+def read_metadata(db, det_ids):
+    """
+    :param db: Redis instance from redis
+    :param det_ids (list):
+    :return: list with the meta:<det_id> hash of each detector as a dict of str, empty where there is none
+    """
+    pipe = db.pipeline(transaction=False)
+    for det_id in det_ids:
+        pipe.hgetall(meta_template.format(det_id))
+    return [{k.decode(): v.decode() for k, v in meta.items()} for meta in pipe.execute()]
@@ -0,0 +1,112 @@
+"""Shared Render Cache Utilities
+
+Lets the dashboard run as several processes (e.g. gunicorn workers) that share the work of rendering. The payload a
+callback returns (figures, table) only depends on the data in redis and on the view parameters of the callback
+(selected stations, reading type, slider range, ...), so it is cached in redis under
+
+    render:<callback name>:<data version>:<hash of the view parameters>
+
+The data version is the data:version counter the collectors and the forecast worker increment with every write, so a
+cached render is never served once newer data exists, and a render done by one worker is reused by every other worker
+until the next write. Entries expire after `ttl` seconds, superseded versions are simply left to expire.
+
+Only one worker renders a given entry: the first one to miss takes a short lived render:lock:<...> key (SET NX) and the
+others wait for its result instead of rendering the same thing concurrently.
+
+The wrapper classes in layouttools.py keep their figure in module level state, which Dash callbacks running on several
+threads of a same process would otherwise mutate concurrently, so renders are serialized within each process and
+callbacks return a json snapshot of the rendered payload.
+
+"""
+import json
+import time
+import hashlib
+import threading
+
+version_key = "data:version"
+key_template = "render:{}:{}:{}"
+lock_template = "render:lock:{}"
+
+
+def _encoder():
+    # imported when first rendering, the collectors import this module for version_key only and don't need plotly
+    from plotly.utils import PlotlyJSONEncoder
+    return PlotlyJSONEncoder
+
+
+class RenderCache:
+    def __init__(self, db, ttl=120, lock_timeout=5, poll=0.02):
+        """
+        :param db: Redis instance from redis
+        :param ttl (int): seconds a render is kept
+        :param lock_timeout (float): seconds a worker waits for another worker's render before rendering itself
+        :param poll (float): seconds between checks while waiting
+        """
+        self.db = db
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.poll = poll
+        self.local = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def version(self):
+        if self.db is None:
+            return None
+        v = self.db.get(version_key)
+        return None if v is None else v.decode()
+
+    def get(self, name, params, render):
+        """
+        returns the cached payload of callback `name` for `params`, rendering and caching it on a miss
+
+        :param name (str): callback name
+        :param params: json serializable view parameters the payload depends on
+        :param render (callable): renders the payload, called without arguments
+        :return: json form (dicts and lists) of the payload
+        """
+        version = self.version()
+        if version is None:
+            # no collector writing versions, nothing tells when a render goes stale
+            with self.local:
+                return json.loads(json.dumps(render(), cls=_encoder()))
+
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+        key = key_template.format(name, version, digest)
+
+        cached = self.db.get(key)
+        if cached is not None:
+            self.hits += 1
+            return json.loads(cached)
+
+        lock = lock_template.format(key)
+        owner = self.db.set(lock, 1, nx=True, px=int(self.lock_timeout * 1000))
+        if not owner:
+            deadline = time.time() + self.lock_timeout
+            while time.time() < deadline:
+                time.sleep(self.poll)
+                cached = self.db.get(key)
+                if cached is not None:
+                    self.hits += 1
+                    return json.loads(cached)
+
+        self.misses += 1
+        try:
+            with self.local:
+                payload = render()
+                serialized = json.dumps(payload, cls=_encoder())
+        except BaseException:
+            # released when the render fails too, so that the other workers don't wait out the lock for nothing
+            if owner:
+                self.db.delete(lock)
+            raise
+
+        pipe = self.db.pipeline(transaction=False)
+        pipe.set(key, serialized, ex=self.ttl)
+        if owner:
+            pipe.delete(lock)
+        pipe.execute()
+
+        # the json form rather than `payload` itself, whose figures may be mutated by the next render before Dash
+        # serializes them
+        return json.loads(serialized)
@@ -0,0 +1,239 @@
+"""Time-Travel Replay Utilities
+
+Lets the dashboard scrub back to any moment the archive still holds (see archivetools.py) and play it forward at an
+adjustable speed: the bars, table, timestamp card and map then show a frame of the past instead of the latest readings.
+
+A frame is the reading of every detector and reading type at one minute. Frames are read from the archive a block of
+`block` minutes at a time, with a single ArchiveDB.read for every detector and reading type of the block, and put on
+a minute grid like gridtools.GridDB does, several readings of a minute averaged. A detector that didn't report in a
+minute keeps showing its previous reading for up to `hold` minutes, as the live dashboard keeps showing the last
+reading it has.
+
+Playback at 60x moves a minute per second, so reading the archive for every frame would put a redis round trip and a
+decode in every tick. The Prefetcher keeps the blocks in a bounded LRU cache instead, and while a block is played a
+background thread loads the next `ahead` blocks, so playback only waits on redis when scrubbing somewhere new. Blocks
+that may still receive readings (the last minutes before now) are reloaded once they are `refresh` seconds old.
+
+"""
+import time
+import queue
+import threading
+import collections
+import numpy as np
+import archivetools
+import gridtools
+import lanetools
+
+value_types = ["vehicle-speed", "vehicle-count", "vehicle-gap-time"]
+step = gridtools.step
+
+
+class ReplayFrames:
+    def __init__(self, db, keys, block=60, hold=5):
+        """
+        :param db: Redis instance from redis
+        :param keys (list): detector ids, frames list their readings in this order
+        :param block (int): minutes read from the archive at once
+        :param hold (int): minutes a detector keeps showing its previous reading when it missed one
+        """
+        self.archive = archivetools.ArchiveDB(db)
+        self.block = block
+        self.hold = hold
+        self.span = block * step
+        self.set_keys(keys)
+
+    def set_keys(self, keys):
+        """
+        :param keys (list): detector ids, e.g. with the detectors registered since appended
+        """
+        self.keys = keys
+        self.pairs = [(k, value_type) for value_type in value_types for k in keys]
+
+    def block_start(self, t):
+        """
+        :param t (int): epoch seconds
+        :return: epoch seconds of the first minute of the block holding `t`
+        """
+        return int(t) // self.span * self.span
+
+    def load(self, start):
+        """
+        :param start (int): epoch seconds of the first minute of the block, see block_start
+        :return: float64 array of reading types x detectors x minutes of the block, NaN where there is no reading
+        """
+        # the keys may change while a block loads, see set_keys
+        keys = self.keys
+        pairs = [(k, value_type) for value_type in value_types for k in keys]
+
+        first = start - self.hold * step
+        n = self.hold + self.block
+        owners, times, values = self.archive.read(pairs, first, start + self.span)
+
+        # the archive holds a reading per detector and minute, but chunks from before it combined the lanes may hold
+        # several, which are averaged rather than one of them picked
+        columns = (times - first) // step
+        sums = np.zeros((len(pairs), n))
+        counts = np.zeros((len(pairs), n))
+        np.add.at(sums, (owners, columns), values)
+        np.add.at(counts, (owners, columns), 1)
+        grid = np.divide(sums, counts, out=np.full(sums.shape, np.nan), where=counts > 0)
+
+        # carries the previous reading forward into up to `hold` missing minutes
+        columns = np.arange(n)
+        latest = np.maximum.accumulate(np.where(np.isnan(grid), -1, columns), axis=1)
+        held = (latest >= 0) & (columns - latest <= self.hold)
+        filled = np.where(held, np.take_along_axis(grid, np.maximum(latest, 0), axis=1), np.nan)
+
+        return filled[:, self.hold:].reshape(len(value_types), len(keys), self.block)
+
+    def frame(self, block, start, t):
+        """
+        :param block (ndarray): a block returned by load
+        :param start (int): epoch seconds of the first minute of the block
+        :param t (int): epoch seconds inside the block
+        :return: {"time": epoch seconds of the minute, "utc": its CreateUtc, reading type: [reading or None]}
+        """
+        column = (int(t) - start) // step
+        minute = start + column * step
+        frame = {"time": minute, "utc": lanetools.from_epoch(minute)}
+        for i, value_type in enumerate(value_types):
+            # readings that were integers are shown as such, like the live ones
+            frame[value_type] = [None if np.isnan(v) else int(v) if v.is_integer() else v
+                                 for v in block[i, :, column].tolist()]
+        return frame
+
+    def bounds(self):
+        """
+        :return: (first, last) epoch seconds of the readings the archive holds, or None while it's empty
+        """
+        return self.archive.span(self.pairs[:len(self.keys)])
+
+
+class Prefetcher:
+    def __init__(self, frames, capacity=48, ahead=3, refresh=30):
+        """
+        :param frames (ReplayFrames):
+        :param capacity (int): blocks kept in memory, 48 blocks of 60 minutes hold two days of frames
+        :param ahead (int): blocks loaded ahead of the one being played
+        :param refresh (float): seconds before a block that may still receive readings is loaded again
+        """
+        self.frames = frames
+        self.capacity = capacity
+        self.ahead = ahead
+        self.refresh = refresh
+
+        self.blocks = collections.OrderedDict()
+        self.loading = {}
+        # bumped by set_keys, blocks loaded for the previous keys aren't kept
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.thread = None
+
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+
+    def _fresh(self, start):
+        entry = self.blocks.get(start)
+        if entry is None:
+            return False
+        _, loaded, complete = entry
+        return complete or time.time() - loaded < self.refresh
+
+    def _load(self, start):
+        """
+        loads a block into the cache, or waits for the thread already loading it
+        """
+        with self.lock:
+            event = self.loading.get(start)
+            owner = event is None
+            if owner:
+                event = self.loading[start] = threading.Event()
+        if not owner:
+            event.wait()
+            return
+
+        try:
+            generation = self.generation
+            loaded = time.time()
+            block = self.frames.load(start)
+            # readings come in up to a couple of minutes late, the blocks before that won't change anymore
+            complete = start + self.frames.span <= loaded - 2 * step
+            with self.lock:
+                if generation != self.generation:
+                    return
+                self.blocks[start] = (block, loaded, complete)
+                self.blocks.move_to_end(start)
+                while len(self.blocks) > self.capacity:
+                    self.blocks.popitem(last=False)
+        finally:
+            with self.lock:
+                del self.loading[start]
+            event.set()
+
+    def _run(self):
+        while True:
+            start = self.pending.get()
+            with self.lock:
+                fresh = self._fresh(start)
+            if not fresh:
+                try:
+                    self._load(start)
+                    self.prefetched += 1
+                except Exception as e:
+                    print("replay prefetch of {} failed: {}".format(lanetools.from_epoch(start), e))
+
+    def _schedule(self, start):
+        if start > time.time():
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="replay-prefetch", daemon=True)
+            self.thread.start()
+        self.pending.put(start)
+
+    def block(self, start):
+        """
+        :param start (int): epoch seconds of the first minute of a block
+        :return: the block, from the cache or loaded on a miss
+        """
+        with self.lock:
+            fresh = self._fresh(start)
+            if fresh:
+                self.blocks.move_to_end(start)
+                self.hits += 1
+                return self.blocks[start][0]
+        self.misses += 1
+        self._load(start)
+        with self.lock:
+            entry = self.blocks.get(start)
+        # evicted already, or the thread that was loading it failed
+        return self.frames.load(start) if entry is None else entry[0]
+
+    def frame(self, t):
+        """
+        frame of the minute holding `t`, and queues the blocks after it to be loaded in the background
+
+        :param t (int): epoch seconds
+        :return: see ReplayFrames.frame
+        """
+        start = self.frames.block_start(t)
+        block = self.block(start)
+        for i in range(1, self.ahead + 1):
+            self._schedule(start + i * self.frames.span)
+        return self.frames.frame(block, start, t)
+
+    def set_keys(self, keys):
+        """
+        switches to new detector ids and drops the blocks loaded so far, which don't have their rows. the background
+        thread keeps running
+
+        :param keys (list):
+        """
+        with self.lock:
+            self.frames.set_keys(keys)
+            self.blocks.clear()
+            self.generation += 1
+
+    def bounds(self):
+        return self.frames.bounds()
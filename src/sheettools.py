@@ -0,0 +1,83 @@
+"""Detector Datasheet Utilities
+
+The collectors only need a few columns of the detector datasheets in ../data (ids, topics, coordinates, the metadata
+the registry copies to redis), but reading them with pandas made pandas, and everything it imports, part of every
+collector start. Datasheets are instead compiled once to a compact columnar json next to their csv,
+e.g. detectors-simulated.csv to detectors-simulated.json:
+
+    {"source": <sha1 of the csv>, "columns": [names], "id": [...], "latitude": [...], ...}
+
+which loads with the json module alone. The sha1 tells when the csv was edited since, the sheet is then compiled again
+with the csv module (and the json rewritten if the directory is writable), so a stale compiled sheet is never used.
+Recompile all datasheets with ../backend/tools/compile_sheets.py.
+
+Columns are lists of str, except the ones in `numeric_columns`, which are floats. Empty cells are None.
+
+"""
+import os
+import io
+import csv
+import json
+import hashlib
+
+datadir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, "data"))
+numeric_columns = ["latitude", "longitude"]
+
+
+def _paths(fname):
+    csv_path = os.path.join(datadir, fname)
+    return csv_path, os.path.splitext(csv_path)[0] + ".json"
+
+
+def compile_sheet(fname, write=True):
+    """
+    :param fname (str): name of a csv in ../data, e.g. detectors-simulated.csv
+    :param write (bool): write the compiled sheet next to the csv
+    :return: the compiled sheet, a dict of columns
+    """
+    csv_path, json_path = _paths(fname)
+    with open(csv_path, "rb") as f:
+        raw = f.read()
+
+    rows = list(csv.reader(io.StringIO(raw.decode("utf-8"))))
+    columns = rows[0]
+    sheet = {"source": hashlib.sha1(raw).hexdigest(), "columns": columns}
+    for i, name in enumerate(columns):
+        values = [row[i] if i < len(row) and row[i] != "" else None for row in rows[1:]]
+        if name in numeric_columns:
+            values = [None if v is None else float(v) for v in values]
+        sheet[name] = values
+
+    if write:
+        try:
+            with open(json_path, "w") as f:
+                json.dump(sheet, f, separators=(",", ":"))
+        except OSError as e:
+            print("compiled datasheet not written: {}".format(e))
+    return sheet
+
+
+def load(fname):
+    """
+    :param fname (str): name of a csv in ../data, e.g. detectors-simulated.csv
+    :return: the compiled sheet of the csv, compiled first if it's missing or stale
+    """
+    csv_path, json_path = _paths(fname)
+    try:
+        with open(json_path, "r") as f:
+            sheet = json.load(f)
+        with open(csv_path, "rb") as f:
+            if sheet.get("source") == hashlib.sha1(f.read()).hexdigest():
+                return sheet
+    except (OSError, ValueError):
+        pass
+    return compile_sheet(fname)
+
+
+def records(sheet):
+    """
+    :param sheet (dict): compiled sheet
+    :return: list with a dict per detector, like DataFrame.to_dict("records")
+    """
+    columns = sheet["columns"]
+    return [dict(zip(columns, row)) for row in zip(*(sheet[c] for c in columns))]
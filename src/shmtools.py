@@ -0,0 +1,339 @@
+"""Shared Memory Store Utilities
+
+Storage backend for single host deployments (e.g. an edge box running both the collector and the dashboard) that
+replaces redis with a block of shared memory, so there is no server process, no socket round trip and no json on
+either side.
+
+The collector creates the block with ShmStore.create and is its only writer, the dashboard attaches to it by name with
+ShmDB, which offers the same read methods as frontendtools.RedisDB. The block holds, for a fixed set of detectors:
+
+    header    int64[4]                      magic, number of detectors, ring size, id width
+    ids       S<id width>[detectors]        detector ids
+    seq       int64[detectors]              seqlock of each detector
+    counts    int64[detectors, 4]           readings ever written, per reading type (and time)
+    values    float64[detectors, 3, ring]   ring buffers of vehicle-gap-time, vehicle-count and vehicle-speed
+    times     int64[detectors, ring]        ring buffer of the distinct CreateUtc of the readings, in epoch seconds
+
+The ring of a reading type holds its latest `ring` readings, the reading number i being at i % ring.
+
+Readers get consistent snapshots through the seqlock: the writer makes a detector's seq odd before touching its rings
+and even again after, a reader copies the rings of all detectors at once (a plain memcpy) and only retries the
+detectors whose seq was odd or changed in between. The copy is what makes a snapshot consistent, nothing is ever
+serialized. This relies on stores becoming visible in program order, which holds on x86.
+
+Only the readings are kept: anomaly flags, forecasts, the corridor travel time and the ingest counters need redis.
+
+"""
+import json
+import time
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+import backendtools
+import profiletools
+import gridtools
+from lanetools import to_epoch, from_epoch
+
+magic = 0x6d746c74726166
+value_types = ["vehicle-gap-time", "vehicle-count", "vehicle-speed"]
+time_column = len(value_types)
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+class ShmStore:
+    def __init__(self, shm):
+        """
+        use ShmStore.create or ShmStore.attach rather than this constructor
+
+        :param shm (SharedMemory):
+        """
+        self.shm = shm
+
+        header = np.ndarray((4,), dtype=np.int64, buffer=shm.buf)
+        if header[0] != magic:
+            raise ValueError("shared memory block {} is not a detector store".format(shm.name))
+        n_det, ring, id_width = int(header[1]), int(header[2]), int(header[3])
+
+        offset = header.nbytes
+        self.ids = np.ndarray((n_det,), dtype="S{}".format(id_width), buffer=shm.buf, offset=offset)
+        offset = _align(offset + self.ids.nbytes)
+        self.seq = np.ndarray((n_det,), dtype=np.int64, buffer=shm.buf, offset=offset)
+        offset += self.seq.nbytes
+        self.counts = np.ndarray((n_det, len(value_types) + 1), dtype=np.int64, buffer=shm.buf, offset=offset)
+        offset += self.counts.nbytes
+        self.values = np.ndarray((n_det, len(value_types), ring), dtype=np.float64, buffer=shm.buf, offset=offset)
+        offset += self.values.nbytes
+        self.times = np.ndarray((n_det, ring), dtype=np.int64, buffer=shm.buf, offset=offset)
+
+        self.ring = ring
+        self.keys = [i.decode() for i in self.ids]
+        self.position = {k: d for d, k in enumerate(self.keys)}
+
+    @staticmethod
+    def size(n_det, ring, id_width):
+        size = _align(4 * 8 + n_det * id_width)
+        return size + 8 * (n_det + n_det * (len(value_types) + 1) + n_det * len(value_types) * ring + n_det * ring)
+
+    @classmethod
+    def create(cls, name, det_ids, ring=300):
+        """
+        creates the shared memory block for `det_ids`. like a redis db, the block outlives the collector: a restarted
+        collector resumes on the existing block when it holds the same detectors, and only replaces it otherwise
+
+        :param name (str): name readers attach with
+        :param det_ids (list): detector ids
+        :param ring (int): readings kept per detector and reading type, the collectors keep up to 300
+        :return: ShmStore
+        """
+        try:
+            existing = cls.attach(name)
+            if existing.keys == list(det_ids) and existing.ring == ring:
+                return existing
+            existing.destroy()
+        except (FileNotFoundError, ValueError):
+            pass
+
+        id_width = max(len(i) for i in det_ids)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=cls.size(len(det_ids), ring, id_width))
+        cls._untrack(shm)
+
+        header = np.ndarray((4,), dtype=np.int64, buffer=shm.buf)
+        header[:] = [magic, len(det_ids), ring, id_width]
+        ids = np.ndarray((len(det_ids),), dtype="S{}".format(id_width), buffer=shm.buf, offset=header.nbytes)
+        ids[:] = [i.encode() for i in det_ids]
+
+        return cls(shm)
+
+    @classmethod
+    def attach(cls, name):
+        shm = shared_memory.SharedMemory(name=name)
+        cls._untrack(shm)
+        return cls(shm)
+
+    @staticmethod
+    def _untrack(shm):
+        # the resource tracker would otherwise unlink the block when the process that opened it exits
+        resource_tracker.unregister(shm._name, "shared_memory")
+
+    def append(self, det_id, subj, reading, created):
+        """
+        appends a reading, and its time if it isn't among the times kept yet. single writer only
+
+        :param det_id (str):
+        :param subj (str): reading type
+        :param reading (float):
+        :param created (str): CreateUtc of the reading
+        :return: False if the detector isn't in the store
+        """
+        d = self.position.get(det_id)
+        if d is None:
+            return False
+
+        t = value_types.index(subj)
+        epoch = to_epoch(created)
+        n_times = self.counts[d, time_column]
+        new_time = not (self.times[d, :min(n_times, self.ring)] == epoch).any()
+
+        self.seq[d] += 1
+        self.values[d, t, self.counts[d, t] % self.ring] = reading
+        self.counts[d, t] += 1
+        if new_time:
+            self.times[d, n_times % self.ring] = epoch
+            self.counts[d, time_column] += 1
+        self.seq[d] += 1
+        return True
+
+    def snapshot(self, column, retries=1000):
+        """
+        consistent copy of one ring of every detector
+
+        :param column (int): index of the reading type in value_types, or time_column
+        :param retries (int): attempts for detectors being written, before giving up
+        :return: (counts, rings) arrays of shape (detectors,) and (detectors, ring)
+        """
+        source = self.times if column == time_column else self.values[:, column]
+
+        before = self.seq.copy()
+        counts = self.counts[:, column].copy()
+        rings = source.copy()
+        after = self.seq.copy()
+
+        torn = np.flatnonzero((before != after) | (before % 2 == 1))
+        for d in torn:
+            for _ in range(retries):
+                s = self.seq[d]
+                if s % 2 == 0:
+                    counts[d] = self.counts[d, column]
+                    rings[d] = source[d]
+                    if self.seq[d] == s:
+                        break
+                time.sleep(0)
+            else:
+                raise RuntimeError("detector {} is being written for too long".format(self.keys[d]))
+
+        return counts, rings
+
+    def latest(self, column, n):
+        """
+        :param column (int): index of the reading type in value_types, or time_column
+        :param n (int):
+        :return: list with the last (up to) n readings of each detector as arrays, oldest first
+        """
+        counts, rings = self.snapshot(column)
+        series = []
+        for c, ring in zip(counts, rings):
+            k = min(c, self.ring, n)
+            series.append(ring[(c - k + np.arange(k)) % self.ring])
+        return series
+
+    def close(self):
+        # the views into the block have to go before the block can be closed
+        self.ids = self.seq = self.counts = self.values = self.times = None
+        self.shm.close()
+
+    def destroy(self):
+        """
+        removes the block from the system, readers still attached keep their mapping until they close it
+        """
+        self.close()
+        resource_tracker.register(self.shm._name, "shared_memory")
+        self.shm.unlink()
+
+
+def initialize_db(store, active_ids, data_template):
+    """
+    counterpart of backendtools.initialize_db, the store already has an empty ring for every detector it was created
+    with, so this only reports the detectors it lacks
+
+    :param store (ShmStore):
+    :param active_ids (list):
+    :param data_template (dict): unused, kept for the same signature
+    :return:
+    """
+    missing = [i for i in active_ids if i not in store.position]
+    if missing:
+        print("detectors not in the shared memory store, their readings are dropped: {}".format(missing))
+
+
+def on_message(client, userdata, msg):
+    """
+    counterpart of backendtools.on_message writing to a ShmStore, passed as userdata, instead of redis
+
+    :param client:
+    :param userdata (ShmStore):
+    :param msg:
+    :return:
+    """
+    if msg.topic == profiletools.control_topic:
+        backendtools.profiler.handle_control(msg.payload)
+        return
+
+    parsed = backendtools.parse_topic(msg.topic)
+    if parsed is None:
+        return
+    det_id, lane, subj = parsed
+
+    stages = backendtools.stages
+    stages.start()
+
+    value_dict = json.loads(msg.payload.decode())
+    reading = value_dict["Value"]
+    created = value_dict['CreateUtc']
+    stages.lap("decode")
+
+    userdata.append(det_id, subj, reading, created)
+    stages.lap("shm-write")
+
+    print("{:<6}  {:<4}  {:<20}  {:<16}".format(det_id, reading, created, subj))
+    stages.lap("log")
+    stages.stop()
+
+    if stages.due():
+        stages.report()
+        stages.reset()
+    backendtools.profiler.tick()
+
+
+def _as_readings(values):
+    # readings arrive as json numbers, keep the integral ones as ints like the redis backend does
+    if len(values) and np.array_equal(values, np.round(values)):
+        return values.astype(np.int64).tolist()
+    return values.tolist()
+
+
+class ShmDB:
+    def __init__(self, name):
+        """
+        read side of a ShmStore with the methods of frontendtools.RedisDB that the dashboard uses
+
+        :param name (str): name the collector created the store with
+        """
+        self.store = ShmStore.attach(name)
+        self.keys = self.store.keys
+
+        # no redis behind this backend, e.g. rendertools.RenderCache bypasses its cache when given None
+        self.db = None
+
+    def _column(self, value_type):
+        return time_column if value_type == "time" else value_types.index(value_type)
+
+    def n_latest_readings(self, value_type, n):
+        series = self.store.latest(self._column(value_type), n)
+        if value_type == "time":
+            return [[from_epoch(t) for t in s] for s in series]
+        return [_as_readings(s) for s in series]
+
+    def latest_readings(self, value_type):
+        return [s[-1] if s else None for s in self.n_latest_readings(value_type, 1)]
+
+    def grid(self, value_type, n, fill=False):
+        return gridtools.from_series(self.n_latest_readings("time", n), self.n_latest_readings(value_type, n), n, fill)
+
+    def heatmap(self, value_type):
+        # no rollups without redis, the heatmap shows the minutes kept in the store instead
+        return self.grid(value_type, self.store.ring)
+
+    def latest_flags(self, value_type):
+        return [False] * len(self.keys)
+
+    def latest_forecasts(self, value_type):
+        return [None] * len(self.keys)
+
+    def corridor(self, n=1):
+        return {"segments": {}, "total": [], "time": []}
+
+    def lags(self, n=120):
+        return {"segments": [], "window": None, "time": [], "lag": [], "correlation": []}
+
+    def replay_bounds(self):
+        # no archive without redis, nothing to replay
+        return None
+
+    def replay_frame(self, t):
+        return None
+
+    def refresh_keys(self):
+        # the detectors of a store are fixed when the collector creates it
+        return []
+
+    def detector_sheet(self, df, keys=None):
+        """
+        datasheet rows of the detectors in the store, in the same order as latest_readings
+        :param df (DataFrame): detector datasheet with id read as str
+        :param keys (list): detectors to describe, all of them by default
+        :return: DataFrame
+        """
+        # only the dashboard needs pandas, a collector writing to the store doesn't
+        import pandas as pd
+
+        rows = df.set_index("id")
+        sheet = []
+        for k in self.keys if keys is None else keys:
+            row = rows.loc[k].to_dict() if k in rows.index else {"corner_st2": "detector {}".format(k),
+                                                                  "latitude": np.nan, "longitude": np.nan}
+            row["id"] = k
+            sheet.append(row)
+        return pd.DataFrame(sheet, columns=df.columns).reset_index(drop=True)
@@ -0,0 +1,37 @@
+"""
+generators of the readings simulated by ../backend/mqtt_sim/pub_sim.py, split out of backendtools so that the
+collectors don't import what only the simulator needs
+
+"""
+import numpy as np
+
+
+class TwoPeaks:
+    def __init__(self):
+        self.minval = None
+        self.maxval = None
+        self.wl = np.pi / 15
+        self.noise = None
+        self.amplitude=None
+
+    def set_params(self, minval, maxval):
+        self.minval = minval
+        self.maxval = maxval
+        self.amplitude = (self.maxval - self.minval) / 2
+
+    def generate(self, x):
+        self.noise = np.random.randint(0, 0.25 * self.maxval, dtype=np.int16)
+        val = self.amplitude * np.sin(self.wl * (x - self.minval)) + self.amplitude + self.minval
+        val += self.noise
+        return int(val)
+
+
+class OneTrough (TwoPeaks):
+    def __init__(self):
+        super().__init__()
+
+    def generate(self, x):
+        self.noise = np.random.randint(0, 0.25 * self.maxval, dtype=np.int16)
+        val = self.amplitude * np.sin(0.5 * self.wl * (x + 2 * self.minval)) + self.amplitude + self.minval
+        val += self.noise
+        return int(val)
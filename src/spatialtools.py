@@ -0,0 +1,88 @@
+"""Spatial Index Utilities
+
+A uniform grid index over detector coordinates, so the map only has to be sent the detectors inside the current
+viewport. Detectors are bucketed once into cells of `cell_deg` degrees; a bounding box query visits only the cells it
+overlaps, then filters the candidates exactly. With thousands of detectors spread over the city, a viewport zoomed in
+on a corridor touches a handful of cells instead of every detector.
+
+"""
+import math
+import numpy as np
+
+
+class GridIndex:
+    def __init__(self, lats, lons, cell_deg=0.01):
+        """
+        :param lats (list): latitude of each detector, in degrees
+        :param lons (list): longitude of each detector, in degrees
+        :param cell_deg (float): size of the grid cells in degrees (0.01 is ~1.1 km of latitude)
+        """
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.cell_deg = cell_deg
+
+        self.cells = {}
+        for i, (lat, lon) in enumerate(zip(self.lats, self.lons)):
+            # a discovered detector without a datasheet row has no location and never shows in a viewport
+            if not (math.isfinite(lat) and math.isfinite(lon)):
+                continue
+            self.cells.setdefault(self._cell(lat, lon), []).append(i)
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
+
+    def query(self, lat_min, lat_max, lon_min, lon_max):
+        """
+        indices of the detectors inside a bounding box, in ascending order
+
+        :return: list of ints
+        """
+        i_min, j_min = self._cell(lat_min, lon_min)
+        i_max, j_max = self._cell(lat_max, lon_max)
+
+        # a box covering more cells than there are occupied ones is cheaper to answer by scanning the occupied cells
+        n_cells = (i_max - i_min + 1) * (j_max - j_min + 1)
+        if n_cells > len(self.cells):
+            keys = [k for k in self.cells if i_min <= k[0] <= i_max and j_min <= k[1] <= j_max]
+        else:
+            keys = [(i, j) for i in range(i_min, i_max + 1) for j in range(j_min, j_max + 1) if (i, j) in self.cells]
+
+        candidates = np.array([idx for k in keys for idx in self.cells[k]], dtype=int)
+        if len(candidates) == 0:
+            return []
+
+        lat = self.lats[candidates]
+        lon = self.lons[candidates]
+        inside = (lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)
+        return np.sort(candidates[inside]).tolist()
+
+    def all(self):
+        return np.flatnonzero(np.isfinite(self.lats) & np.isfinite(self.lons)).tolist()
+
+
+def viewport_bounds(relayout_data):
+    """
+    bounding box of the map viewport from the relayoutData of a mapbox dcc.Graph
+
+    :param relayout_data (dict): relayoutData of the map, None before the user first pans or zooms
+    :return: (lat_min, lat_max, lon_min, lon_max), or None when the viewport isn't known
+    """
+    if not relayout_data:
+        return None
+
+    derived = relayout_data.get("mapbox._derived")
+    if derived and "coordinates" in derived:
+        lons = [c[0] for c in derived["coordinates"]]
+        lats = [c[1] for c in derived["coordinates"]]
+        return min(lats), max(lats), min(lons), max(lons)
+
+    center = relayout_data.get("mapbox.center")
+    zoom = relayout_data.get("mapbox.zoom")
+    if center is None or zoom is None:
+        return None
+
+    # without the derived corners, over-approximate the viewport from the zoom level: a 512 px tile spans 360 degrees
+    # of longitude at zoom 0, assume up to 1024 px of map in every direction
+    half_lon = 360 / 2 ** zoom
+    half_lat = half_lon * math.cos(math.radians(center["lat"]))
+    return center["lat"] - half_lat, center["lat"] + half_lat, center["lon"] - half_lon, center["lon"] + half_lon
@@ -0,0 +1,235 @@
+"""Write-Ahead Log Utilities
+
+An on-disk log of the raw mqtt messages the collector receives, appended before anything is written to redis. When
+redis is down or restarted, readings that couldn't be written are still in the log and can be re-ingested from it,
+see ../backend/tools/replay_wal.py. The same log feeds benchmarks with real traffic.
+
+The log is a directory of segments named after the offset of their first record, e.g. 00000000000067108864.wal. The
+offset of a record is its position in the log as a whole, so it stays valid across segments. Each segment is created
+at its full size and memory-mapped: an append is a copy into the mapping, without a system call. A segment is sealed
+when the next record doesn't fit in it or when it's older than `max_age`. Sealing truncates the file to the records
+it holds and opens the next segment.
+
+Records are a header packed with `header` followed by the topic and the payload:
+
+    length      uint32   bytes of topic and payload
+    crc         uint32   crc32 of everything after this field
+    received    float64  epoch seconds the message was received at
+    topic size  uint16
+
+A zero length marks the end of the records of a segment that's still being written. A record whose crc doesn't match,
+e.g. one torn by a power loss, ends its segment as well.
+
+Records are in the page cache as soon as they're appended, so a crash of the collector loses none of them. Only a
+crash of the host loses what wasn't synced to disk yet, depending on the sync policy:
+
+    always  msync after every record
+    batch   group commit: msync once `sync_every` records or `sync_interval` seconds have piled up
+    never   leave it to the kernel's writeback
+
+"""
+import os
+import mmap
+import time
+import zlib
+import struct
+import collections
+
+header = struct.Struct("<IIdH")
+segment_template = "{:020d}.wal"
+sync_policies = ["always", "batch", "never"]
+
+Message = collections.namedtuple("Message", ["offset", "received", "topic", "payload"])
+
+
+def segments(directory):
+    """
+    :param directory (str):
+    :return: sorted list of (base offset, path) of the segments of a log
+    """
+    found = []
+    for name in os.listdir(directory):
+        if name.endswith(".wal") and name[:-4].isdigit():
+            found.append((int(name[:-4]), os.path.join(directory, name)))
+    return sorted(found)
+
+
+def _scan(buf, position, size):
+    """
+    :return: offset within the segment right after the last valid record from `position`
+    """
+    while position + header.size <= size:
+        length, crc, _, _ = header.unpack_from(buf, position)
+        end = position + header.size + length
+        if length == 0 or end > size or zlib.crc32(buf[position + 8:end]) != crc:
+            break
+        position = end
+    return position
+
+
+class WriteAheadLog:
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, max_age=3600, sync="batch", sync_every=256,
+                 sync_interval=0.05, keep=None):
+        """
+        opens the log in `directory`, creating it if needed. appends always go to a new segment, the last segment of
+        a previous run is sealed at its last valid record
+
+        :param directory (str):
+        :param segment_size (int): bytes of a segment
+        :param max_age (float): seconds after which a segment is sealed even if it isn't full, so that each hour (by
+        default) can be replayed or deleted on its own
+        :param sync (str): one of `sync_policies`
+        :param sync_every (int): records per group commit with the batch policy
+        :param sync_interval (float): seconds between group commits with the batch policy
+        :param keep (int): number of sealed segments kept, older ones are deleted when a segment is sealed. None to
+        keep them all
+        """
+        if sync not in sync_policies:
+            raise ValueError("unknown sync policy {}, expected one of {}".format(sync, sync_policies))
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_age = max_age
+        self.sync_policy = sync
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.keep = keep
+
+        self.file = None
+        self.map = None
+        self.base = 0
+        self.position = 0
+        self.opened = 0.0
+        self.synced = 0
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+        os.makedirs(directory, exist_ok=True)
+        existing = segments(directory)
+        if existing:
+            base, path = existing[-1]
+            self.base = base + self._seal_existing(path)
+        self._open_segment()
+
+    def _seal_existing(self, path):
+        with open(path, "r+b") as f:
+            size = os.fstat(f.fileno()).st_size
+            end = 0
+            if size > 0:
+                with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as m:
+                    end = _scan(m, 0, size)
+            f.truncate(end)
+        return end
+
+    def _open_segment(self):
+        path = os.path.join(self.directory, segment_template.format(self.base))
+        self.file = open(path, "w+b")
+        self.file.truncate(self.segment_size)
+        self.map = mmap.mmap(self.file.fileno(), self.segment_size)
+        self.position = 0
+        self.synced = 0
+        self.opened = time.monotonic()
+
+    def _seal(self):
+        self.sync()
+        self.map.close()
+        self.file.truncate(self.position)
+        self.file.close()
+        self.base += self.position
+
+        if self.keep is not None:
+            sealed = segments(self.directory)
+            for _, path in sealed[:max(len(sealed) - self.keep, 0)]:
+                os.remove(path)
+
+    def append(self, topic, payload, received=None):
+        """
+        :param topic (str):
+        :param payload (bytes):
+        :param received (float): epoch seconds, defaults to now
+        :return: offset of the record in the log
+        """
+        topic = topic.encode() if isinstance(topic, str) else topic
+        length = len(topic) + len(payload)
+        size = header.size + length
+        if size > self.segment_size:
+            raise ValueError("message of {} bytes doesn't fit in a segment of {}".format(size, self.segment_size))
+
+        if self.position + size > self.segment_size or \
+                (self.position > 0 and time.monotonic() - self.opened >= self.max_age):
+            self._seal()
+            self._open_segment()
+
+        received = time.time() if received is None else received
+        start = self.position
+        body = start + header.size
+        self.map[body:body + len(topic)] = topic
+        self.map[body + len(topic):body + length] = payload
+        # the header goes in after the record and its length last of all, so a reader never sees a partial record
+        struct.pack_into("<dH", self.map, start + 8, received, len(topic))
+        crc = zlib.crc32(self.map[start + 8:body + length])
+        struct.pack_into("<I", self.map, start + 4, crc)
+        struct.pack_into("<I", self.map, start, length)
+        self.position = body + length
+
+        self.unsynced += 1
+        if self.sync_policy == "always":
+            self.sync()
+        elif self.sync_policy == "batch" and (self.unsynced >= self.sync_every or
+                                              time.monotonic() - self.last_sync >= self.sync_interval):
+            self.sync()
+        return self.base + start
+
+    def sync(self):
+        """
+        writes the records appended since the last sync to disk
+        """
+        if self.position > self.synced:
+            # msync works on whole pages
+            start = self.synced - self.synced % mmap.PAGESIZE
+            self.map.flush(start, self.position - start)
+            self.synced = self.position
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def tell(self):
+        """
+        :return: offset the next record will be written at
+        """
+        return self.base + self.position
+
+    def close(self):
+        self._seal()
+
+
+def read(directory, start=0, since=None):
+    """
+    reads the records of a log in order, including the ones of a segment that's still being written
+
+    :param directory (str):
+    :param start (int): offset of the first record, as returned by WriteAheadLog.append, 0 for the oldest kept
+    :param since (float): epoch seconds, records received earlier are skipped
+    :return: generator of Message
+    """
+    found = segments(directory)
+    for i, (base, path) in enumerate(found):
+        following = found[i + 1][0] if i + 1 < len(found) else None
+        if following is not None and following <= start:
+            continue
+
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                continue
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as m:
+                position = max(start - base, 0)
+                while position + header.size <= size:
+                    length, crc, received, topic_size = header.unpack_from(m, position)
+                    body = position + header.size
+                    end = body + length
+                    if length == 0 or end > size or zlib.crc32(m[position + 8:end]) != crc:
+                        break
+                    if since is None or received >= since:
+                        yield Message(base + position, received, m[body:body + topic_size].decode(),
+                                      m[body + topic_size:end])
+                    position = end